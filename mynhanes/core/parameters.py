@@ -12,3 +12,16 @@ config = load_config()
 
 # Exemplo de como acessar as configurações
 database_name = config['database']['name']
+
+
+def get_parameter(section, key, default=None):
+    """
+    Return config[section][key], or default when the key is missing or empty.
+    """
+    try:
+        value = config[section][key]
+    except (KeyError, TypeError):
+        return default
+    if value is None:
+        return default
+    return value
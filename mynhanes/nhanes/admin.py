@@ -1,5 +1,7 @@
 import json
 from django.contrib import admin, messages
+from django.db.models import Exists, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.utils.html import format_html
 from .models import (
     Version,
@@ -10,6 +12,8 @@ from .models import (
     VariableCycle,
     DatasetCycle,
     Data,
+    DataManifest,
+    VariableCode,
     QueryColumns,
     QueryStructure,
     QueryFilter,
@@ -37,6 +41,7 @@ from nhanes.workprocess.transformation_manager import TransformationManager
 # from django.shortcuts import redirect
 # from django.urls import path
 from nhanes.workprocess.ingestion_nhanes import ingestion_nhanes
+from nhanes.workprocess.data_storage import bump_data_generation
 from django.contrib.admin import SimpleListFilter
 
 # ----------------------------------
@@ -178,16 +183,64 @@ class DatasetCycleAdmin(admin.ModelAdmin):
 
 
 class DataAdmin(admin.ModelAdmin):
-    list_display = ('version', 'cycle', 'dataset', 'variable', 'sample', 'sequence', 'rule_id', 'value')  # noqa E501
+    list_display = ('version', 'cycle', 'dataset', 'variable', 'sample', 'sequence', 'rule_id', 'decoded_value')  # noqa E501
     search_fields = ('dataset__dataset', 'cycle__cycle', 'variable__variable', 'value')
     list_filter = ('cycle', 'dataset', 'version', 'variable', 'variable__tags')  # noqa E501
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
         queryset = queryset.select_related('version', 'dataset', 'cycle', 'variable')
+        # encoded rows show the value of their code
+        code_value = VariableCode.objects.filter(
+            variable=OuterRef('variable'),
+            code=OuterRef('value_code')
+            ).values('value')[:1]
+        return queryset.annotate(
+            decoded_value=Coalesce(Subquery(code_value), F('value'))
+            )
+
+    def get_search_results(self, request, queryset, search_term):
+        results, may_have_duplicates = super().get_search_results(
+            request,
+            queryset,
+            search_term
+            )
+        if search_term:
+            # the value of encoded rows is in VariableCode
+            results |= queryset.filter(Exists(
+                VariableCode.objects.filter(
+                    variable=OuterRef('variable'),
+                    code=OuterRef('value_code'),
+                    value__icontains=search_term
+                    )
+                ))
+        return results, may_have_duplicates
+
+    def decoded_value(self, obj):
+        return obj.decoded_value
+
+    decoded_value.short_description = 'Value'
+    decoded_value.admin_order_field = 'decoded_value'
+
+
+class DataManifestAdmin(admin.ModelAdmin):
+    list_display = ('version', 'cycle', 'dataset', 'rule', 'rows', 'n_samples', 'n_variables', 'load_time', 'loaded_at')  # noqa E501
+    search_fields = ('dataset__dataset', 'cycle__cycle', 'source_hash')
+    list_filter = ('cycle', 'version', 'rule')
+    readonly_fields = ('source_hash', 'loaded_at')
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        queryset = queryset.select_related('version', 'dataset', 'cycle', 'rule')
         return queryset
 
 
+class VariableCodeAdmin(admin.ModelAdmin):
+    list_display = ('variable', 'code', 'value')
+    search_fields = ('variable__variable', 'value')
+    raw_id_fields = ('variable',)
+
+
 class TagAdmin(admin.ModelAdmin):
     list_display = ("tag", "description")
 
@@ -410,6 +463,7 @@ class WorkProcessNhanesAdmin(admin.ModelAdmin):
         'set_status_pending',
         'set_status_standby',
         'set_status_delete',
+        'set_status_delta',
         'set_download_true',
         'set_download_false',
         'run_ingestion_data',
@@ -469,6 +523,14 @@ class WorkProcessNhanesAdmin(admin.ModelAdmin):
             message_bit = f"{rows_updated} work process nhanes were"
         self.message_user(request, f"{message_bit} successfully deleted.")
 
+    def set_status_delta(self, request, queryset):
+        rows_updated = queryset.update(status='delta')
+        if rows_updated == 1:
+            message_bit = "1 work process nhanes was"
+        else:
+            message_bit = f"{rows_updated} work process nhanes were"
+        self.message_user(request, f"{message_bit} successfully marked for delta re-ingestion.")  # noqa: E501
+
     def set_download_true(self, request, queryset):
         rows_updated = queryset.update(is_download=True)
         if rows_updated == 1:
@@ -494,6 +556,7 @@ class WorkProcessNhanesAdmin(admin.ModelAdmin):
     set_status_pending.short_description = "Set selected workprocess as standby"
     set_status_standby.short_description = "Set selected workprocess to pending"
     set_status_delete.short_description = "Set selected workprocess to delete"
+    set_status_delta.short_description = "Set selected workprocess to delta re-ingestion"  # noqa: E501
     set_download_true.short_description = "Set selected workprocess as download"
     set_download_false.short_description = "Set selected workprocess as not download"
     run_ingestion_data.short_description = "Run all ingestion data process"
@@ -554,6 +617,8 @@ class WorkProcessRuleAdmin(admin.ModelAdmin):
         for work_process_rule in queryset:
             # drop all data associated with the rule in the Data table
             Data.objects.filter(rule_id=work_process_rule.rule).delete()
+            DataManifest.objects.filter(rule=work_process_rule.rule).delete()
+            bump_data_generation()
             # update the status of the WorkProcessRule to 'pending'
             msg = "Data deleted and status reset to pending."
             work_process_rule.status = 'pending'
@@ -576,6 +641,8 @@ admin.site.register(Variable, VariableAdmin)
 admin.site.register(VariableCycle, VariableCycleAdmin)
 admin.site.register(DatasetCycle, DatasetCycleAdmin)
 admin.site.register(Data, DataAdmin)
+admin.site.register(DataManifest, DataManifestAdmin)
+admin.site.register(VariableCode, VariableCodeAdmin)
 admin.site.register(QueryColumns, QueryColumnAdmin)
 admin.site.register(QueryStructure, QueryStructureAdmin)
 # admin.site.register(QueryFilter, QueryFilterAdmin)
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
-from nhanes.models import Data  # Substitua 'myapp' pelo nome do seu app
+from nhanes.models import Data, DataManifest  # Substitua 'myapp' pelo nome do seu app
+from nhanes.workprocess.data_storage import bump_data_generation, delete_data  # noqa E501
 
 
 class Command(BaseCommand):
@@ -7,7 +8,12 @@ class Command(BaseCommand):
 
     def handle(self, *args, **kwargs):
         try:
+            # the Parquet files of the loads kept outside the database
+            delete_data(DataManifest.objects.filter(storage='parquet'))
             deleted_count, _ = Data.objects.all().delete()
+            DataManifest.objects.all().delete()
+            # the cached query results are stale
+            bump_data_generation()
             self.stdout.write(self.style.SUCCESS(
                 f'Successfully deleted {deleted_count} entries from the Logs table.'
                 ))
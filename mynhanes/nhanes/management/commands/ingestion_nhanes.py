@@ -9,11 +9,16 @@ class Command(BaseCommand):
         parser.add_argument(
             '--type',
             type=str,
-            help='csv to only save the files or db to load on db'  # noqa E501
+            help='csv, parquet or feather to only save the files or db to load on db'  # noqa E501
+        )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='drop the Data indexes during the load and rebuild them at the end (full-refresh loads)'  # noqa E501
         )
 
     def handle(self, *args, **options):
         type_load = options['type'] if 'type' in options else 'db'
         self.stdout.write(self.style.SUCCESS('Starting download...'))
-        ingestion_nhanes(type_load)
+        ingestion_nhanes(type_load, bulk=options.get('bulk', False))
         self.stdout.write(self.style.SUCCESS('Download completed!'))
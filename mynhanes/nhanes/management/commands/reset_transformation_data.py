@@ -2,7 +2,8 @@
 
 from django.core.management.base import BaseCommand
 from django.db import connection
-from nhanes.models import Data
+from nhanes.models import Data, DataManifest
+from nhanes.workprocess.data_storage import bump_data_generation
 
 
 class Command(BaseCommand):
@@ -11,6 +12,9 @@ class Command(BaseCommand):
     def handle(self, *args, **kwargs):
         # Deletar todos os dados do modelo NormalizedData
         Data.objects.filter(version=4).delete()
+        DataManifest.objects.filter(version=4).delete()
+        # the cached query results are stale
+        bump_data_generation()
         self.stdout.write(self.style.SUCCESS('All data deleted from NormalizedData.'))
 
         # Reiniciar o índice auto-increment para a tabela NormalizedData
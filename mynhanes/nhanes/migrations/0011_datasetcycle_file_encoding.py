@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nhanes', '0010_alter_cycle_dataset_url_pattern'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasetcycle',
+            name='file_encoding',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_manifest(apps, schema_editor):
+    # one aggregate over the Data already loaded, so the manifest knows
+    # every dataset loaded before it existed
+    Data = apps.get_model('nhanes', 'Data')
+    DataManifest = apps.get_model('nhanes', 'DataManifest')
+    groups = Data.objects.values(
+        'version_id', 'cycle_id', 'dataset_id', 'rule_id_id'
+        ).annotate(
+            rows=Count('id'),
+            n_samples=Count('sample', distinct=True),
+            n_variables=Count('variable', distinct=True),
+            ).order_by()
+    DataManifest.objects.bulk_create(
+        [
+            DataManifest(
+                version_id=group['version_id'],
+                cycle_id=group['cycle_id'],
+                dataset_id=group['dataset_id'],
+                rule_id=group['rule_id_id'],
+                rows=group['rows'],
+                n_samples=group['n_samples'],
+                n_variables=group['n_variables'],
+                )
+            for group in groups.iterator()
+        ],
+        batch_size=500
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nhanes', '0011_datasetcycle_file_encoding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataManifest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rows', models.BigIntegerField(default=0)),
+                ('n_samples', models.IntegerField(default=0)),
+                ('n_variables', models.IntegerField(default=0)),
+                ('source_hash', models.CharField(blank=True, default='', max_length=64)),
+                ('load_time', models.FloatField(default=0)),
+                ('loaded_at', models.DateTimeField(auto_now=True)),
+                ('cycle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nhanes.cycle')),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nhanes.dataset')),
+                ('rule', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='nhanes.rule')),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nhanes.version')),
+            ],
+            options={
+                'verbose_name_plural': 'Moviment: Data Manifest',
+                'indexes': [models.Index(fields=['cycle', 'dataset'], name='nhanes_data_cycle_i_5a85d9_idx')],
+                'unique_together': {('version', 'cycle', 'dataset', 'rule')},
+            },
+        ),
+        migrations.RunPython(backfill_manifest, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nhanes', '0012_datamanifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workprocessnhanes',
+            name='delta_deleted',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='workprocessnhanes',
+            name='delta_inserted',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='workprocessnhanes',
+            name='delta_updated',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='workprocessnhanes',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('complete', 'Complete'), ('error', 'Error'), ('delete', 'Delete'), ('delta', 'Delta'), ('standby', 'Stand By'), ('no_file', 'No File')], default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nhanes', '0013_workprocessnhanes_delta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datamanifest',
+            name='skipped_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='datamanifest',
+            name='skipped_rows',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='workprocessnhanes',
+            name='sparse_saved_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='workprocessnhanes',
+            name='sparse_skipped_rows',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
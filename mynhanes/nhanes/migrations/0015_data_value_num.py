@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nhanes', '0014_sparse_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='value_num',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='queryfilter',
+            name='filter_name',
+            field=models.CharField(choices=[('variable__variable', 'Variable Code'), ('variable__description', 'Variable Name'), ('cycle__cycle', 'Cycle'), ('dataset__group__group', 'Group'), ('dataset__dataset', 'Dataset Code'), ('dataset__description', 'Dataset Name'), ('version__version', 'Version'), ('variable__tags__tag', 'Tag'), ('value', 'Value')], default='variable', max_length=30),
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:00
+
+import pandas as pd
+from django.db import migrations, transaction
+
+# Data rows updated per transaction
+BATCH_SIZE = 50000
+# columns of a load of one variable; the ingestion sets value_num for the
+# whole column or for none of it
+COLUMN_KEY = ['version_id', 'cycle_id', 'dataset_id', 'rule_id', 'variable_id']  # noqa E501
+
+
+def _batches(Data, last_id, fields):
+    for start in range(0, last_id + 1, BATCH_SIZE):
+        rows = Data.objects.filter(
+            id__gte=start,
+            id__lt=start + BATCH_SIZE,
+            value_num__isnull=True
+            ).values_list(*fields)
+        df = pd.DataFrame.from_records(rows, columns=fields)
+        if df.empty:
+            continue
+        # the missing values of numeric columns are stored as 'nan'
+        df = df[df['value'] != 'nan']
+        df['value_num'] = pd.to_numeric(df['value'], errors='coerce')
+        yield df
+
+
+def backfill_value_num(apps, schema_editor):
+    # as the ingestion, only the numeric columns get value_num: columns of
+    # XPT type 'string' and columns with a value that is not a number are
+    # skipped, even where some of their values look like numbers ('01').
+    # The table is walked by id ranges, one short transaction per batch, so
+    # it is never locked for the whole backfill
+    Data = apps.get_model('nhanes', 'Data')
+    VariableCycle = apps.get_model('nhanes', 'VariableCycle')
+    connection = schema_editor.connection
+    table = connection.ops.quote_name(Data._meta.db_table)
+    sql = f"UPDATE {table} SET value_num = %s WHERE id = %s"
+
+    last_id = Data.objects.order_by('-id').values_list('id', flat=True).first()
+    if last_id is None:
+        return
+    fields = ['id', 'value'] + COLUMN_KEY
+
+    # first pass: the columns that are not numeric
+    text_columns = set()
+    for df in _batches(Data, last_id, fields):
+        text = df.loc[df['value_num'].isna(), COLUMN_KEY]
+        text = text.astype(object).where(text.notna(), None)
+        text_columns.update(text.itertuples(index=False, name=None))
+    string_variables = set(
+        VariableCycle.objects.filter(type='string').values_list(
+            'version_id',
+            'cycle_id',
+            'dataset_id',
+            'variable_id'
+            )
+        )
+
+    def numeric(key):
+        return key not in text_columns and \
+            (key[0], key[1], key[2], key[4]) not in string_variables
+
+    # second pass: the values of the numeric columns
+    for df in _batches(Data, last_id, fields):
+        keys = df[COLUMN_KEY].astype(object)
+        keys = keys.where(keys.notna(), None)
+        df = df[[
+            numeric(key) for key in keys.itertuples(index=False, name=None)
+            ]]
+        if df.empty:
+            continue
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    sql,
+                    zip(df['value_num'].tolist(), df['id'].tolist())
+                    )
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('nhanes', '0015_data_value_num'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_value_num, migrations.RunPython.noop),
+    ]
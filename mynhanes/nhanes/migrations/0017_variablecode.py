@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nhanes', '0016_backfill_value_num'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='data',
+            name='value_code',
+            field=models.IntegerField(blank=True, default=None, null=True),
+        ),
+        migrations.CreateModel(
+            name='VariableCode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.IntegerField()),
+                ('value', models.CharField(max_length=255)),
+                ('variable', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='codes', to='nhanes.variable')),
+            ],
+            options={
+                'verbose_name_plural': 'Moviment: Variable Codes',
+                'unique_together': {('variable', 'code'), ('variable', 'value')},
+            },
+        ),
+    ]
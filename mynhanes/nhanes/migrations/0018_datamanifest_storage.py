@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nhanes', '0017_variablecode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datamanifest',
+            name='storage',
+            field=models.CharField(choices=[('db', 'Database'), ('parquet', 'Parquet')], default='db', max_length=10),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nhanes', '0018_datamanifest_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Moviment: Data Generation',
+            },
+        ),
+    ]
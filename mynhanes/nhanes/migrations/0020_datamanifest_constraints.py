@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:20
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def drop_duplicate_raw_manifests(apps, schema_editor):
+    # the old unique_together did not cover the raw loads (rule is NULL);
+    # keep the last manifest of each partition loaded more than once
+    DataManifest = apps.get_model('nhanes', 'DataManifest')
+    latest = DataManifest.objects.filter(rule__isnull=True).values(
+        'version_id', 'cycle_id', 'dataset_id'
+        ).annotate(last_id=Max('id')).order_by()
+    DataManifest.objects.filter(rule__isnull=True).exclude(
+        id__in=[group['last_id'] for group in latest]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nhanes', '0019_datageneration'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='datamanifest',
+            unique_together=set(),
+        ),
+        migrations.RunPython(
+            drop_duplicate_raw_manifests,
+            migrations.RunPython.noop
+            ),
+        migrations.AddConstraint(
+            model_name='datamanifest',
+            constraint=models.UniqueConstraint(condition=models.Q(('rule__isnull', True)), fields=('version', 'cycle', 'dataset'), name='unique_raw_manifest'),
+        ),
+        migrations.AddConstraint(
+            model_name='datamanifest',
+            constraint=models.UniqueConstraint(condition=models.Q(('rule__isnull', False)), fields=('version', 'cycle', 'dataset', 'rule'), name='unique_rule_manifest'),
+        ),
+    ]
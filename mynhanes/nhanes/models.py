@@ -153,6 +153,8 @@ class DatasetCycle(models.Model):
     has_special_year_code = models.BooleanField(default=False)
     special_year_code = models.CharField(max_length=10, blank=True, null=True)
     has_dataset = models.BooleanField(default=False)
+    # encoding of the XPT file, settled on the first ingestion
+    file_encoding = models.CharField(max_length=20, blank=True, null=True)
 
     class Meta:
         unique_together = ("dataset", "cycle")
@@ -278,6 +280,10 @@ class Data(models.Model):
         default=None
         )
     value = models.CharField(max_length=255)
+    # float of the numeric values, NULL for text and missing values
+    value_num = models.FloatField(null=True, blank=True, default=None)
+    # code of the value in VariableCode when stored encoded; value is empty
+    value_code = models.IntegerField(null=True, blank=True, default=None)
 
     class Meta:
         indexes = [
@@ -289,6 +295,94 @@ class Data(models.Model):
         return f"Sample {self.sample} | Variable {self.variable.variable} | Cycle {self.cycle.cycle} | Dataset {self.dataset.dataset} | Version {self.version}"  # noqa E501
 
 
+# dictionary of the values of a categorical variable, shared by all cycles;
+# Data rows stored encoded keep only the code
+class VariableCode(models.Model):
+    variable = models.ForeignKey(
+        Variable,
+        related_name="codes",
+        on_delete=models.CASCADE
+        )
+    code = models.IntegerField()
+    value = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = (("variable", "code"), ("variable", "value"))
+        verbose_name_plural = "Moviment: Variable Codes"
+
+    def __str__(self):
+        return f"{self.variable.variable}: {self.code} = {self.value}"
+
+
+# one row per (version, cycle, dataset, rule) loaded, so the loaded datasets,
+# their storage and their statistics are known without scanning the data
+class DataManifest(models.Model):
+    STORAGE_CHOICES = (
+        ("db", "Database"),
+        ("parquet", "Parquet"),
+    )
+    version = models.ForeignKey(Version, on_delete=models.CASCADE)
+    cycle = models.ForeignKey(Cycle, on_delete=models.CASCADE)
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE)
+    rule = models.ForeignKey(
+        Rule,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        default=None
+        )
+    rows = models.BigIntegerField(default=0)
+    n_samples = models.IntegerField(default=0)
+    n_variables = models.IntegerField(default=0)
+    source_hash = models.CharField(max_length=64, blank=True, default="")
+    load_time = models.FloatField(default=0)
+    # missing cells not stored by a sparse load and their estimated size
+    skipped_rows = models.BigIntegerField(default=0)
+    skipped_bytes = models.BigIntegerField(default=0)
+    storage = models.CharField(
+        max_length=10,
+        choices=STORAGE_CHOICES,
+        default="db"
+        )
+    loaded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # rule is NULL for the raw loads and NULLs are distinct in a unique
+        # index, so the raw and the rule partitions have their own constraint
+        constraints = [
+            models.UniqueConstraint(
+                fields=["version", "cycle", "dataset"],
+                condition=models.Q(rule__isnull=True),
+                name="unique_raw_manifest",
+            ),
+            models.UniqueConstraint(
+                fields=["version", "cycle", "dataset", "rule"],
+                condition=models.Q(rule__isnull=False),
+                name="unique_rule_manifest",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['cycle', 'dataset']),
+        ]
+        verbose_name_plural = "Moviment: Data Manifest"
+
+    def __str__(self):
+        return f"{self.dataset.dataset} - {self.cycle.cycle} ({self.version})"
+
+
+# single row counting the changes of the loaded data (ingestion, deletion and
+# rules); the cached query results of older generations are not reused
+class DataGeneration(models.Model):
+    generation = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Moviment: Data Generation"
+
+    def __str__(self):
+        return f"Generation {self.generation}"
+
+
 # ----------------------------------------------------------------------------
 # MODELS FOR MANAGING QUERY STRUCTURE
 # ----------------------------------------------------------------------------
@@ -352,6 +446,7 @@ class QueryFilter(models.Model):
         ("dataset__description", "Dataset Name"),
         ("version__version", "Version"),
         ("variable__tags__tag", "Tag"),
+        ("value", "Value"),
     )
     query_structure = models.ForeignKey(
         QueryStructure, related_name="filters", on_delete=models.CASCADE
@@ -382,6 +477,7 @@ class WorkProcessNhanes(models.Model):
         ("complete", "Complete"),
         ("error", "Error"),
         ("delete", "Delete"),
+        ("delta", "Delta"),
         ("standby", "Stand By"),
         ("no_file", "No File"),
     )
@@ -401,6 +497,13 @@ class WorkProcessNhanes(models.Model):
     records = models.IntegerField(default=0)
     n_samples = models.IntegerField(default=0)
     n_variables = models.IntegerField(default=0)
+    # rows changed by the last delta load
+    delta_inserted = models.IntegerField(default=0)
+    delta_updated = models.IntegerField(default=0)
+    delta_deleted = models.IntegerField(default=0)
+    # missing cells skipped by a sparse load and the estimated bytes saved
+    sparse_skipped_rows = models.BigIntegerField(default=0)
+    sparse_saved_bytes = models.BigIntegerField(default=0)
 
     class Meta:
         unique_together = ("dataset", "cycle")
@@ -1,10 +1,148 @@
 import os
+import zlib
 from django.db.models import Q, F
-from nhanes.models import Data, QueryColumns, VariableCycle, DatasetCycle
+from nhanes.models import (
+    Data,
+    DataManifest,
+    QueryColumns,
+    Variable,
+    VariableCycle,
+    DatasetCycle
+    )
+from nhanes.reports.query_duckdb import COLUMN_SEPARATOR, DuckDBQueryEngine
+from nhanes.reports.query_cache import get_query_cache, query_cache_key
+from nhanes.reports.query_sql import SQL_PIVOT_MAX_COLUMNS, sql_pivot_rows
+from nhanes.workprocess.data_storage import (
+    NUMERIC_OPERATORS,
+    get_data_generation,
+    read_data,
+    read_data_variables
+    )
+from core.parameters import get_parameter
+from nhanes.workprocess.ingestion_utils import DATA_INSERT_BATCH, MISSING_VALUE
+import numpy as np
 import pandas as pd
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 import dask.dataframe as dd
-from dask.distributed import Client
+from nhanes.utils.execution import get_dask_client, use_dask
+
+
+def _factorize_keys(df, columns, as_text=True):
+    """
+    Factorize the combinations of the values of columns into integer codes.
+
+    With as_text, the combinations are taken as text and ordered as their
+    values joined by '___', the string keys used by the pivot before; the
+    strings are only built for the distinct combinations. Otherwise the
+    codes follow the order of the values.
+
+    Returns
+    -------
+    tuple
+        The code of each row of df (numpy.ndarray) and a DataFrame with the
+        combination of each code.
+    """
+    codes = np.zeros(len(df), dtype=np.int64)
+    column_codes = []
+    labels = []
+    for column in columns:
+        col_codes, uniques = pd.factorize(
+            df[column],
+            sort=not as_text,
+            use_na_sentinel=not as_text
+            )
+        if as_text:
+            uniques = pd.Index(uniques).astype(str)
+        column_codes.append(col_codes)
+        labels.append(np.asarray(uniques, dtype=object))
+        # keep the codes dense, in the order of the combinations
+        codes, _ = pd.factorize(codes * len(uniques) + col_codes, sort=True)
+
+    # combination of each code, taken from its first row
+    first = np.empty(codes.max() + 1 if len(codes) else 0, dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    keys = pd.DataFrame({
+        column: labels[n][column_codes[n][first]]
+        for n, column in enumerate(columns)
+        })
+
+    if as_text and len(keys):
+        order = np.argsort(
+            keys[columns[0]].str.cat(
+                [keys[column] for column in columns[1:]],
+                sep='___'
+                ).to_numpy(dtype=str),
+            kind='stable'
+            )
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        codes = rank[codes]
+        keys = keys.iloc[order].reset_index(drop=True)
+    return codes, keys
+
+
+def _scatter_pivot_codes(row_codes, column_codes, values, shape):
+    """
+    Pivot the values into a matrix of shape (rows, columns), keeping the
+    first value that is not missing of each cell.
+    """
+    matrix = np.full(shape, np.nan, dtype=object)
+    keep = pd.notna(values)
+    cells = row_codes[keep] * shape[1] + column_codes[keep]
+    # numpy does not say which value is left in a cell assigned more than
+    # once, so only the first value of each cell is assigned
+    first = ~pd.Series(cells).duplicated(keep='first').to_numpy()
+    matrix.flat[cells[first]] = values[keep][first]
+    return matrix
+
+
+def _dask_pivot_codes(client, row_codes, column_codes, values, shape):
+    """
+    Pivot the values as _scatter_pivot_codes, on the Dask client.
+    """
+    df = pd.DataFrame({
+        'row': row_codes,
+        'column': pd.Categorical.from_codes(
+            column_codes,
+            categories=np.arange(shape[1])
+            ),
+        'value': values,
+        })
+
+    # desired_partition_size = 100e6  # 100 MB por partição
+    desired_partition_size = 20e6  # 50 MB per partitio
+    n_partitions = int(
+        df.memory_usage(deep=True).sum() / desired_partition_size
+        )
+    if n_partitions < 1:
+        n_partitions = 1
+
+    dask_df = dd.from_pandas(df, npartitions=n_partitions)
+    pivot_dd = dask_df.pivot_table(
+        index='row',
+        columns='column',
+        values='value',
+        aggfunc='first'
+    )
+    pivot_df = client.compute(pivot_dd).result()
+    pivot_df = pivot_df.reindex(
+        index=np.arange(shape[0]),
+        columns=np.arange(shape[1])
+        ).astype(object)
+    return pivot_df.where(pivot_df.notna(), np.nan).to_numpy()
+
+
+def _pivot_column_index(column_keys, pivot_columns):
+    """
+    Columns of the pivot table from the combinations of _factorize_keys.
+    """
+    if len(pivot_columns) > 1:
+        # multi-index columns, one level per pivot column
+        return pd.MultiIndex.from_arrays(
+            [column_keys[column] for column in pivot_columns],
+            names=[None] * len(pivot_columns)
+            )
+    return pd.Index(column_keys.iloc[:, 0], name='unique_column')
 
 
 def _create_pivot_table(
@@ -45,24 +183,15 @@ def _create_pivot_table(
     if missing_cols:
         raise ValueError(f"Missing columns in DataFrame: {missing_cols}")
 
-    # Create a unique index to avoid conflicts in the pivot table
-    df['unique_index'] = df['Cycle'].astype(str) + \
-        '___' + df['sample'].astype(str) + \
-        '___' + df['sequence'].astype(str)
-    df['unique_index'] = df['unique_index'].astype('category')
-
-    if len(pivot_columns) > 1:
-        # Create a unique column to avoid conflicts in the pivot table
-        df['unique_column'] = df[pivot_columns].apply(
-            lambda row: '___'.join(row.values.astype(str)),
-            axis=1
-            )
-        df['unique_column'] = df['unique_column'].astype('category')
-    else:
-        df['unique_column'] = df[pivot_columns].astype('category')
-
-    df.drop(columns=index_columns, inplace=True)
-    df.drop(columns=pivot_columns, inplace=True)
+    # Integer codes of the rows (index columns) and of the columns (pivot
+    # columns) of the pivot table
+    row_codes, row_keys = _factorize_keys(df, index_columns)
+    column_codes, column_keys = _factorize_keys(
+        df,
+        pivot_columns,
+        as_text=len(pivot_columns) > 1
+        )
+    values = df[value_column].to_numpy(dtype=object)
 
     if no_conflict:
         # TODO: Repensar sobre esse ponto
@@ -77,52 +206,47 @@ def _create_pivot_table(
         # )
         ...
     else:
-        # Configura um cliente Dask com um número específico de trabalhadores
-        # e memória limitada
-        client = Client(n_workers=6, threads_per_worker=1, memory_limit='5GB')
-        print(client.dashboard_link)
-        # Imprime o link do dashboard para monitoramento
-
-        partition_size = df.memory_usage(deep=True).sum() / len(df)
-        print(f"Partition size: {partition_size:.2f} bytes")
-
-        # desired_partition_size = 100e6  # 100 MB por partição
-        desired_partition_size = 20e6  # 50 MB per partitio
-        n_partitions = int(
-            df.memory_usage(deep=True).sum() / desired_partition_size
-            )
-        if n_partitions < 1:
-            n_partitions = 1
-
-        dask_df = dd.from_pandas(df, npartitions=n_partitions)
-        # dask_df = dd.from_pandas(df, npartitions=10)
-
-        pivot_dd = dask_df.pivot_table(
-            index='unique_index',
-            columns='unique_column',
-            values='value',
-            aggfunc='first'
-        )
-
-        pivot_df = pivot_dd.compute()
-
-        if len(pivot_columns) > 1:
-            # Transform single columns to multi-index columns
-            new_columns = [col.split('___') for col in pivot_df.columns]
-            multiindex_columns = pd.MultiIndex.from_tuples(new_columns)
-            pivot_df.columns = multiindex_columns
+        shape = (len(row_keys), len(column_keys))
+        if use_dask(len(df)):
+            # the Dask client is shared by the whole process (see
+            # nhanes.utils.execution) and started only once
+            client = get_dask_client()
+            matrix = _dask_pivot_codes(
+                client,
+                row_codes,
+                column_codes,
+                values,
+                shape
+                )
         else:
-            ...
+            matrix = _scatter_pivot_codes(
+                row_codes,
+                column_codes,
+                values,
+                shape
+                )
 
-        # Reset index and split unique_index to original columns
-        pivot_df[
-            ['Cycle', 'sample', 'sequence']
-            ] = pivot_df.index.to_series().str.split('___', expand=True)
+        pivot_df = pd.DataFrame(
+            matrix,
+            index=pd.MultiIndex.from_frame(row_keys),
+            columns=_pivot_column_index(column_keys, pivot_columns)
+            )
+
+    return pivot_df
 
-        pivot_df.reset_index(inplace=True)
-        pivot_df.drop(columns=['unique_index',], inplace=True)
-        pivot_df.set_index(['Cycle', 'sample', 'sequence'], inplace=True)
 
+def _pivot_batches_to_frame(reader, index_columns, n_pivot_columns):
+    """
+    Collect the Arrow record batches of a DuckDB pivot into the layout of
+    _create_pivot_table: the index columns as index and, with more than one
+    pivot column, MultiIndex columns split on COLUMN_SEPARATOR.
+    """
+    pivot_df = reader.read_pandas().set_index(index_columns)
+    pivot_df = pivot_df[sorted(pivot_df.columns)]
+    if n_pivot_columns > 1:
+        pivot_df.columns = pd.MultiIndex.from_tuples(
+            [tuple(col.split(COLUMN_SEPARATOR)) for col in pivot_df.columns]
+            )
     return pivot_df
 
 
@@ -163,6 +287,225 @@ def _download_query_results_as_csv(
     return response
 
 
+def _store_query_results(cache, cache_key, pivot_df, query_structure):
+    """
+    Keep the pivot table of an export in the result cache, when it is on. A
+    failed write only costs the next export its cache hit.
+    """
+    if cache is None:
+        return
+    try:
+        cache.store(cache_key, pivot_df, query_structure.structure_name)
+    except (OSError, ValueError):
+        cache.remove(cache_key)
+
+
+def _prepare_long_frame(df, column_names, rename_dict):
+    """
+    Add the columns of the partition and of the variable of each value of
+    read_data, keep column_names and rename them to the query columns.
+    """
+    # columns of the partition and of the variable of each value
+    for column in column_names:
+        if column in df.columns:
+            continue
+        if column.startswith('variable__'):
+            lookup = Variable.objects.filter(
+                id__in=df['variable'].unique().tolist()
+                ).values_list('id', column[len('variable__'):])
+            df[column] = df['variable'].map(dict(lookup))
+        else:
+            lookup = DataManifest.objects.filter(
+                id__in=df['manifest'].unique().tolist()
+                ).values_list('id', column)
+            df[column] = df['manifest'].map(dict(lookup))
+
+    # values stored as 'nan' are missing, the same as the cells without a row
+    # of the datasets loaded in sparse mode or in Parquet files
+    df['value'] = df['value'].replace(MISSING_VALUE, np.nan)
+
+    return df[column_names].rename(columns=rename_dict)
+
+
+def _query_columns(
+        manifests,
+        variables,
+        value_filters,
+        column_names,
+        rename_dict,
+        pivot_columns
+        ):
+    """
+    Find the columns of the pivot of a query without reading its values,
+    from the variables with values in each partition.
+
+    Returns
+    -------
+    tuple
+        The (manifest, variable) pairs with the code of their column in
+        'column', and the columns of the pivot table, in code order.
+    """
+    pairs = read_data_variables(manifests, variables, value_filters)
+    if pairs.empty:
+        raise ValueError("No data found in the query structure. ")
+    keys = _prepare_long_frame(
+        pairs.assign(sample=0, sequence=0, value=np.nan),
+        column_names,
+        rename_dict
+        )
+    codes, column_keys = _factorize_keys(
+        keys,
+        pivot_columns,
+        as_text=len(pivot_columns) > 1
+        )
+    return (
+        pairs.assign(column=codes),
+        _pivot_column_index(column_keys, pivot_columns)
+        )
+
+
+def _sql_pivot_table(
+        qs_manifest,
+        variables,
+        value_filters,
+        column_names,
+        rename_dict,
+        index_columns,
+        pivot_columns,
+        max_columns=SQL_PIVOT_MAX_COLUMNS,
+        ):
+    """
+    Pivot the query in the database with conditional aggregation (see
+    nhanes.reports.query_sql), in the layout of _create_pivot_table.
+
+    Returns
+    -------
+    pandas.DataFrame or None
+        The pivoted DataFrame, or None for the pandas pivot when the query
+        has Parquet partitions, more than max_columns columns or cells with
+        more than one value (e.g. several versions, or the output of a rule
+        next to the raw data), where MAX would not keep the first value.
+    """
+    manifests = list(
+        qs_manifest.select_related('version', 'cycle', 'dataset')
+        )
+    if any(m.storage != 'db' for m in manifests):
+        return None
+    pairs, columns = _query_columns(
+        manifests,
+        variables,
+        value_filters,
+        column_names,
+        rename_dict,
+        pivot_columns
+        )
+    if len(columns) > max_columns:
+        return None
+
+    rows = pd.DataFrame.from_records(
+        sql_pivot_rows(manifests, pairs, value_filters).iterator(
+            chunk_size=DATA_INSERT_BATCH
+            ),
+        columns=index_columns + list(range(len(columns))) + ['n_values']
+        )
+    values = rows.iloc[:, len(index_columns):-1].to_numpy(dtype=object)
+    missing = pd.isna(values)
+    if (rows['n_values'].to_numpy() > (~missing).sum(axis=1)).any():
+        return None
+    values[missing] = np.nan
+    # rows in the order of _create_pivot_table
+    row_codes, row_keys = _factorize_keys(rows, index_columns)
+    matrix = np.empty_like(values)
+    matrix[row_codes] = values
+    return pd.DataFrame(
+        matrix,
+        index=pd.MultiIndex.from_frame(row_keys),
+        columns=columns
+        )
+
+
+def _stream_query_results_as_csv(
+        qs_manifest,
+        variables,
+        value_filters,
+        column_names,
+        rename_dict,
+        index_columns,
+        pivot_columns,
+        query_structure,
+        gzip=False,
+        ):
+    """
+    Stream the results of a query as a CSV file, one cycle at a time.
+
+    The columns of the file are known before any value is read, from the
+    variables with values in each partition, so the header is written once
+    and the pivot of every cycle is written with the same columns. Only the
+    rows of one cycle are in memory at a time. The rows come in the same
+    order as in the buffered export, which sorts them by cycle first.
+
+    Returns
+    -------
+    django.http.StreamingHttpResponse
+        The CSV file, or the CSV file compressed with gzip (.csv.gz).
+    """
+    manifests = list(
+        qs_manifest.select_related('version', 'cycle', 'dataset')
+        )
+    _, columns = _query_columns(
+        manifests,
+        variables,
+        value_filters,
+        column_names,
+        rename_dict,
+        pivot_columns
+        )
+
+    cycles = {}
+    for m in manifests:
+        cycles.setdefault(m.cycle.cycle, []).append(m)
+
+    def rows():
+        yield pd.DataFrame(
+            columns=columns,
+            index=pd.MultiIndex.from_tuples([], names=index_columns)
+            ).to_csv()
+        for cycle in sorted(cycles):
+            df = read_data(cycles[cycle], variables, value_filters)
+            if df.empty:
+                continue
+            pivot_df = _create_pivot_table(
+                _prepare_long_frame(df, column_names, rename_dict),
+                index_columns=index_columns,
+                pivot_columns=pivot_columns,
+                no_conflict=query_structure.no_conflict,
+                no_multi_index=query_structure.no_multi_index
+                )
+            yield pivot_df.reindex(columns=columns).to_csv(header=False)
+
+    def encode(chunks):
+        if not gzip:
+            for chunk in chunks:
+                yield chunk.encode('utf-8')
+            return
+        compressor = zlib.compressobj(wbits=31)  # gzip container
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8'))
+            if data:
+                yield data
+        yield compressor.flush()
+
+    file_name = f"{query_structure.structure_name}.csv"
+    if gzip:
+        file_name += ".gz"
+    response = StreamingHttpResponse(
+        encode(rows()),
+        content_type='application/gzip' if gzip else 'text/csv'
+        )
+    response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return response
+
+
 def _parse_filter_value(operator, value):
     if operator == 'in':
         # Assume que os valores são separados por vírgula
@@ -203,6 +546,65 @@ def _parse_file_filter(file_path, filter_field):
     return {f'{filter_field}__in': values}
 
 
+def _parse_query_filters(qs_filters):
+    """
+    Split the filters of a query structure by what they select: the loaded
+    partitions (version, cycle and dataset), the variables read from them
+    and the values kept.
+
+    Returns:
+        tuple: (manifest_query, variables, value_filters). manifest_query is
+            a Q on DataManifest, variables the names of the selected
+            variables by id (None for every variable) and value_filters the
+            lookups on value or value_num.
+    """
+    manifest_query = Q()
+    variable_query = Q()
+    value_filters = []
+    for filter_obj in qs_filters:
+        # Parse the filter value based on the operator
+        value = _parse_filter_value(filter_obj.operator, filter_obj.value)
+        # if operator == '_eq' no use in the variable (default is eq)
+        if filter_obj.operator == 'file':
+            kwargs = _parse_file_filter(
+                filter_obj.value,
+                filter_obj.filter_name
+                )
+
+        elif filter_obj.filter_name == 'value' and \
+                filter_obj.operator in NUMERIC_OPERATORS:
+            # compare the typed value_num column, not the text of the value
+            if filter_obj.operator == 'range':
+                value = [float(v) for v in filter_obj.value.split('-')]
+            else:
+                value = float(value)
+            kwargs = {f'value_num__{filter_obj.operator}': value}
+
+        elif filter_obj.operator == 'eq':
+            kwargs = {f'{filter_obj.filter_name}': value}
+        else:
+            kwargs = {f'{filter_obj.filter_name}__{filter_obj.operator}': value}  # noqa: E501
+
+        if filter_obj.filter_name == 'value':
+            value_filters.append(kwargs)
+        elif filter_obj.filter_name.startswith('variable__'):
+            variable_query &= Q(**{
+                key[len('variable__'):]: v for key, v in kwargs.items()
+                })
+        else:
+            manifest_query &= Q(**kwargs)  # Using AND to combine filters
+
+    variables = None
+    if variable_query:
+        variables = dict(
+            Variable.objects.filter(variable_query).distinct().values_list(
+                'id',
+                'variable'
+                )
+            )
+    return manifest_query, variables, value_filters
+
+
 def download_data_report(modeladmin, request, queryset):
     """
     Download the results of a query from the admin interface.
@@ -243,28 +645,72 @@ def download_data_report(modeladmin, request, queryset):
             )
         return
 
-    # Get all data in lazy mode
-    data_query = Data.objects.all()
-
-    query = Q()
-    for filter_obj in qs_filters:
-        # Parse the filter value based on the operator
-        value = _parse_filter_value(filter_obj.operator, filter_obj.value)
-        # if operator == '_eq' no use in the variable (default is eq)
-        if filter_obj.operator == 'file':
-            kwargs = _parse_file_filter(
-                filter_obj.value,
-                filter_obj.filter_name
-                )
+    manifest_query, variables, value_filters = _parse_query_filters(
+        qs_filters
+        )
+    qs_manifest = DataManifest.objects.filter(manifest_query)
 
-        elif filter_obj.operator == 'eq':
-            kwargs = {f'{filter_obj.filter_name}': value}
-        else:
-            kwargs = {f'{filter_obj.filter_name}__{filter_obj.operator}': value}  # noqa: E501
+    # Define index and pivot columns
+    index_cols = ['Cycle', 'sample', 'sequence']  # [0.2.0]
+    pivot_cols = [col.column_name for col in qs_report_columns]
+    pivot_cols = [col for col in pivot_cols if col not in index_cols]
 
-        query &= Q(**kwargs)  # Using AND to combine filters
+    # the same query on the same data generation is read from the result
+    # cache; the streaming export keeps its bounded memory and skips it
+    engine = get_parameter('query', 'engine', 'pandas')
+    streaming = engine != 'duckdb' and str(
+        get_parameter('query', 'streaming', False)
+        ).lower() == 'true'
+    cache = None if streaming else get_query_cache()
+    cache_key = None
+    if cache is not None:
+        cache_key = query_cache_key(
+            query_structure,
+            get_data_generation(),
+            engine
+            )
+        pivot_df = cache.get(cache_key)
+        if pivot_df is not None:
+            return _download_query_results_as_csv(
+                request,
+                pivot_df,
+                query_structure.structure_name
+                )
 
-    data_query = data_query.filter(query)
+    if engine == 'duckdb':
+        # filters and pivot run in DuckDB, in a single SQL statement
+        pivot_keys = [
+            col.internal_data_key for col in qs_report_columns
+            if col.column_name not in index_cols
+            ]
+        try:
+            with DuckDBQueryEngine() as engine:
+                pivot_df = _pivot_batches_to_frame(
+                    engine.pivot(
+                        qs_manifest,
+                        variables,
+                        value_filters,
+                        pivot_keys
+                        ),
+                    index_cols,
+                    len(pivot_keys)
+                    )
+        except (ImportError, ValueError) as e:
+            modeladmin.message_user(request, str(e), level='error')
+            return
+        if pivot_df.empty:
+            modeladmin.message_user(
+                request,
+                "No data found in the query structure. ",
+                level='error'
+                )
+            return
+        _store_query_results(cache, cache_key, pivot_df, query_structure)
+        return _download_query_results_as_csv(
+            request,
+            pivot_df,
+            query_structure.structure_name
+            )
 
     # Standard columns
     column_names = ['cycle__cycle', 'sample', 'sequence', 'value']
@@ -274,18 +720,6 @@ def download_data_report(modeladmin, request, queryset):
     new_columns = [col for col in new_columns if col not in column_names]
     column_names.extend(new_columns)
 
-    data_query = data_query.values_list(*column_names)
-
-    if not data_query:
-        modeladmin.message_user(
-            request,
-            "No data found in the query structure. ",
-            level='error'
-            )
-        return
-
-    df = pd.DataFrame(list(data_query), columns=column_names)
-
     # SELECT internal_data_key, column_name
     column_mappings = QueryColumns.objects.filter(
         internal_data_key__in=column_names
@@ -295,21 +729,86 @@ def download_data_report(modeladmin, request, queryset):
     rename_dict = {
         mapping['internal_data_key']: mapping['column_name'] for mapping in column_mappings  # noqa: E501
         }
-    df.rename(columns=rename_dict, inplace=True)
 
-    # Define index and pivot columns
-    index_cols = ['Cycle', 'sample', 'sequence']  # [0.2.0]
-    pivot_cols = [col.column_name for col in qs_report_columns]
-    pivot_cols = [col for col in pivot_cols if col not in index_cols]
+    if streaming:
+        # one cycle at a time, written to the response as it is pivoted
+        try:
+            return _stream_query_results_as_csv(
+                qs_manifest,
+                variables,
+                value_filters,
+                column_names,
+                rename_dict,
+                index_cols,
+                pivot_cols,
+                query_structure,
+                gzip=str(
+                    get_parameter('query', 'streaming_gzip', False)
+                    ).lower() == 'true'
+                )
+        except (ValueError, OSError) as e:
+            modeladmin.message_user(request, str(e), level='error')
+            return
+
+    if engine == 'sql':
+        # pivot in the database, or in pandas above the column threshold
+        try:
+            pivot_df = _sql_pivot_table(
+                qs_manifest,
+                variables,
+                value_filters,
+                column_names,
+                rename_dict,
+                index_cols,
+                pivot_cols,
+                max_columns=int(get_parameter(
+                    'query',
+                    'sql_pivot_max_columns',
+                    SQL_PIVOT_MAX_COLUMNS
+                    ))
+                )
+        except ValueError as e:
+            modeladmin.message_user(request, str(e), level='error')
+            return
+        if pivot_df is not None:
+            _store_query_results(cache, cache_key, pivot_df, query_structure)
+            return _download_query_results_as_csv(
+                request,
+                pivot_df,
+                query_structure.structure_name
+                )
 
-    # Create the pivot table
-    pivot_df = _create_pivot_table(
-        df,
-        index_columns=index_cols,
-        pivot_columns=pivot_cols,
-        no_conflict=query_structure.no_conflict,
-        no_multi_index=query_structure.no_multi_index
-        )
+    # read the values from the storage of each partition, with only the
+    # selected variables and values
+    try:
+        df = read_data(qs_manifest, variables, value_filters)
+    except ValueError as e:
+        modeladmin.message_user(request, str(e), level='error')
+        return
+
+    if df.empty:
+        modeladmin.message_user(
+            request,
+            "No data found in the query structure. ",
+            level='error'
+            )
+        return
+
+    df = _prepare_long_frame(df, column_names, rename_dict)
+
+    # Create the pivot table on the execution backend
+    try:
+        pivot_df = _create_pivot_table(
+            df,
+            index_columns=index_cols,
+            pivot_columns=pivot_cols,
+            no_conflict=query_structure.no_conflict,
+            no_multi_index=query_structure.no_multi_index
+            )
+    except (ValueError, OSError) as e:
+        modeladmin.message_user(request, str(e), level='error')
+        return
+    _store_query_results(cache, cache_key, pivot_df, query_structure)
 
     # Download the results as a CSV file
     return _download_query_results_as_csv(
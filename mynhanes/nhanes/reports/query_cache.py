@@ -0,0 +1,182 @@
+"""
+Result cache of the QueryStructure exports.
+
+An export is identified by the SHA-256 of a canonical JSON of its query
+structure (filters, columns in the order of the export, the no_conflict and
+no_multi_index flags and the query engine) and of the data generation (see
+workprocess.data_storage.bump_data_generation). Every load, deletion or rule
+output bumps the generation, so a result is only reused while the data it
+was built from is unchanged. Saves and deletes of the metadata shown in the
+exports (versions, cycles, groups, datasets, tags, variables and their
+codes) bump it through nhanes.signals, once per transaction; bulk edits that skip the model
+signals (QuerySet.update, bulk_update) must call bump_data_generation.
+
+The pivot table of each result is stored as a zstd compressed Parquet file
+<key>.parquet under <download_path>/query_cache with a JSON sidecar holding
+the layout of its index and columns, its size and the last access time; the
+least recently used results are evicted above query.cache_size.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.conf import settings
+from nhanes.workprocess.ingestion_cache import SidecarCache, file_sha256
+from core.parameters import get_parameter
+
+# bumped when the layout of the cached files changes
+CACHE_FORMAT = 1
+CACHE_COMPRESSION = "zstd"
+
+
+def query_cache_key(query_structure, generation, engine='pandas'):
+    """
+    Return the cache key of an export of query_structure on the data of
+    generation.
+
+    The filters are sorted, so the same filters in any order give the same
+    key; the columns keep their order, which sets the levels of the columns
+    of the pivot table. The content of the files of the 'file' filters is
+    part of the key, not only their path.
+    """
+    filters = []
+    for qs_filter in query_structure.filters.all():
+        value = qs_filter.value
+        if qs_filter.operator == 'file' and os.path.isfile(value):
+            value = f"{value}:{file_sha256(value)}"
+        filters.append([qs_filter.filter_name, qs_filter.operator, value])
+    structure = {
+        'format': CACHE_FORMAT,
+        'generation': generation,
+        'engine': engine,
+        'filters': sorted(filters),
+        'columns': [
+            [col.column_name, col.internal_data_key]
+            for col in query_structure.columns.all()
+            ],
+        'no_conflict': query_structure.no_conflict,
+        'no_multi_index': query_structure.no_multi_index,
+    }
+    canonical = json.dumps(structure, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _to_table(pivot_df):
+    """
+    Flatten a pivot table to an Arrow table: the index columns first, then
+    the value columns as strings named by position.
+    """
+    arrays = []
+    names = []
+    for name in pivot_df.index.names:
+        arrays.append(pa.array(pivot_df.index.get_level_values(name)))
+        names.append(name)
+    for n in range(pivot_df.shape[1]):
+        values = pivot_df.iloc[:, n]
+        arrays.append(pa.array(
+            values.where(values.isna(), values.astype(str)),
+            type=pa.string(),
+            from_pandas=True
+            ))
+        names.append(str(n))
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def _from_table(table, layout):
+    # rebuild the index and the (multi-index) columns of the pivot table
+    df = table.to_pandas().set_index(layout['index'])
+    # missing cells as in the pivot, NaN instead of the None of Arrow
+    df = df.where(df.notna(), np.nan)
+    if layout['multi_index']:
+        columns = pd.MultiIndex.from_tuples(
+            [tuple(col) for col in layout['columns']],
+            names=layout['column_names']
+            )
+    else:
+        columns = pd.Index(layout['columns'], name=layout['column_names'][0])
+    df.columns = columns
+    return df
+
+
+class QueryResultCache(SidecarCache):
+    """
+    Pivot tables of the exports keyed by query_cache_key, with the sidecar
+    index and the LRU eviction of SidecarCache; store() evicts the least
+    recently used results above max_size.
+    """
+
+    def path(self, key):
+        return self.cache_dir / f"{key}.parquet"
+
+    def _file_path(self, key, entry):
+        return self.path(key)
+
+    def get(self, key):
+        """
+        Return the pivot table cached under key, or None on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        try:
+            table = pq.read_table(self.path(key))
+        except (OSError, pa.ArrowInvalid):
+            self.remove(key)
+            return None
+        self._touch(key)
+        return _from_table(table, entry['layout'])
+
+    def store(self, key, pivot_df, name=""):
+        """
+        Write the pivot table of an export under key, then evict the least
+        recently used results above max_size.
+        """
+        multi_index = isinstance(pivot_df.columns, pd.MultiIndex)
+        layout = {
+            'index': list(pivot_df.index.names),
+            'multi_index': multi_index,
+            'columns': [
+                list(col) if multi_index else col
+                for col in pivot_df.columns.tolist()
+                ],
+            'column_names': list(pivot_df.columns.names),
+        }
+        tmp_path = self.path(key).with_suffix('.parquet.tmp')
+        pq.write_table(
+            _to_table(pivot_df),
+            tmp_path,
+            compression=CACHE_COMPRESSION
+            )
+        os.replace(tmp_path, self.path(key))
+        entry = self._store_entry(key, {
+            'name': name,
+            'layout': layout,
+            'rows': len(pivot_df),
+            'size': os.path.getsize(self.path(key)),
+        })
+        self.evict(keep=(key,))
+        return entry
+
+    def remove(self, key):
+        self._remove(key)
+
+
+def get_query_cache():
+    """
+    Return the result cache of the exports, or None when query.cache is off.
+    """
+    if str(get_parameter('query', 'cache', False)).lower() != 'true':
+        return None
+    download_path = Path(
+        get_parameter('workprocess', 'download_path', settings.BASE_DIR)
+        )
+    cache_size = float(get_parameter('query', 'cache_size', 0))
+    return QueryResultCache(
+        download_path / "query_cache",
+        max_size=int(cache_size * 1024 ** 3) or None
+        )
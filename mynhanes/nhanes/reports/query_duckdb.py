@@ -0,0 +1,396 @@
+"""
+DuckDB engine of the QueryStructure export.
+
+The filters on the version, cycle, dataset and variable are resolved by the
+ORM into the partitions (DataManifest) and variables to read. Everything
+else runs in an embedded, in-process DuckDB as a single SQL statement: the
+rows of the Parquet partitions are read with read_parquet, the rows of the
+database partitions from the SQLite file attached read-only, by a query
+SQLite runs with the partitions and variables in its WHERE clause (or, when
+the SQLite extension of DuckDB is not available, from the rows of read_data
+handed over as Arrow), the value filters become a WHERE clause and the
+result is built by a PIVOT. The pivot is returned as Arrow record batches.
+
+A cell with more than one value keeps the first value that is not missing,
+in the order read_data returns them (the database rows by id, then the
+Parquet partitions one after the other), as the pandas engine does.
+
+duckdb is an optional dependency, imported only when this engine is used.
+"""
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.db import connection
+from nhanes.models import Data, DataManifest, Variable, VariableCode
+from nhanes.workprocess.data_storage import (
+    DatabaseStorage,
+    ParquetStorage,
+    READ_COLUMNS,
+    _split_lookup
+    )
+
+# rows per Arrow record batch of the result
+BATCH_SIZE = 100000
+# separator of the values of the pivot columns in a result column name, as
+# in _create_pivot_table
+COLUMN_SEPARATOR = '___'
+
+
+def _import_duckdb():
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError(
+            "The duckdb query engine needs the duckdb package: pip install duckdb"  # noqa E501
+            ) from e
+    return duckdb
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _literal(text):
+    return "'" + str(text).replace("'", "''") + "'"
+
+
+def _lookup_sql(kwargs):
+    """
+    Translate a lookup on value or value_num (as given to
+    Data.objects.filter) into a SQL condition and its parameters.
+    """
+    (key, value), = kwargs.items()
+    field, lookup = _split_lookup(key)
+    column = _quote(field)
+    compare = {'lt': '<', 'lte': '<=', 'gt': '>', 'gte': '>='}
+    if lookup == 'exact':
+        return f"{column} = ?", [value]
+    if lookup == 'iexact':
+        return f"lower({column}) = lower(?)", [value]
+    if lookup == 'in':
+        return f"{column} IN ({', '.join(['?'] * len(value))})", list(value)
+    if lookup in compare:
+        return f"{column} {compare[lookup]} ?", [value]
+    if lookup == 'range':
+        return f"{column} BETWEEN ? AND ?", list(value)
+    if lookup == 'isnull':
+        return f"{column} IS {'' if value else 'NOT '}NULL", []
+    functions = {
+        'contains': 'contains',
+        'startswith': 'starts_with',
+        'endswith': 'ends_with',
+        }
+    if lookup in functions:
+        return f"{functions[lookup]}({column}, ?)", [value]
+    if lookup[1:] in functions:
+        return f"{functions[lookup[1:]]}(lower({column}), lower(?))", [value]  # noqa E501
+    if lookup == 'regex':
+        return f"regexp_matches({column}, ?)", [value]
+    if lookup == 'iregex':
+        return f"regexp_matches({column}, ?, 'i')", [value]
+    raise ValueError(f"Lookup {key} is not supported by the duckdb engine.")
+
+
+def _sqlite_rows_sql(manifests, variables):
+    """
+    SQLite query of the Data rows of the partitions and variables, with the
+    value of the code of encoded rows. The partitions are grouped as in
+    _partition_query; all the ids are inlined as integers.
+    """
+    def column(model, field):
+        return _quote(model._meta.get_field(field).column)
+
+    def ids(values):
+        return ', '.join(str(int(v)) for v in sorted(values))
+
+    groups = {}
+    for m in manifests:
+        key = (m.version_id, m.dataset_id, m.rule_id)
+        groups.setdefault(key, set()).add(m.cycle_id)
+    partitions = []
+    for (version_id, dataset_id, rule_id), cycle_ids in groups.items():
+        rule = f"d.{column(Data, 'rule_id')} IS NULL" if rule_id is None \
+            else f"d.{column(Data, 'rule_id')} = {int(rule_id)}"
+        partitions.append(
+            f"(d.{column(Data, 'version')} = {int(version_id)}"
+            f" AND d.{column(Data, 'dataset')} = {int(dataset_id)}"
+            f" AND {rule}"
+            f" AND d.{column(Data, 'cycle')} IN ({ids(cycle_ids)}))"
+            )
+    where = ' OR '.join(partitions) or '0'
+    if variables is not None:
+        where = f"({where}) AND d.{column(Data, 'variable')} IN ({ids(variables) or 'NULL'})"  # noqa E501
+    # encoded values are replaced by the value of their code
+    return f"""
+        SELECT
+            d.{column(Data, 'id')} AS id,
+            d.{column(Data, 'version')} AS version,
+            d.{column(Data, 'cycle')} AS cycle,
+            d.{column(Data, 'dataset')} AS dataset,
+            COALESCE(d.{column(Data, 'rule_id')}, 0) AS rule,
+            d.{column(Data, 'variable')} AS variable,
+            d.{column(Data, 'sample')} AS sample,
+            d.{column(Data, 'sequence')} AS sequence,
+            COALESCE(c.{column(VariableCode, 'value')}, d.{column(Data, 'value')}) AS value,
+            d.{column(Data, 'value_num')} AS value_num
+        FROM {_quote(Data._meta.db_table)} d
+        LEFT JOIN {_quote(VariableCode._meta.db_table)} c
+            ON c.{column(VariableCode, 'variable')} = d.{column(Data, 'variable')}
+            AND c.{column(VariableCode, 'code')} = d.{column(Data, 'value_code')}
+        WHERE {where}
+        """  # noqa E501
+
+
+class DuckDBQueryEngine:
+    """
+    Build the pivot of a query in DuckDB.
+
+    Use as a context manager; the connection is closed on exit, so the
+    batches have to be read inside the with block.
+    """
+
+    def __init__(self):
+        self.duckdb = _import_duckdb()
+        self.con = self.duckdb.connect()
+        self.source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.con.close()
+
+    def _attach_database(self):
+        # the SQLite file of Django, read-only, through the sqlite extension
+        if connection.vendor != 'sqlite':
+            raise ValueError("Only SQLite databases can be attached.")
+        name = str(connection.settings_dict['NAME'])
+        if name.startswith('file:') or name == ':memory:':
+            raise ValueError("In-memory databases can not be attached.")
+        self.con.execute(
+            f"ATTACH {_literal(name)} AS nhanes_db (TYPE sqlite, READ_ONLY)"
+            )
+
+    def _database_rows(self, manifests, variables, value_filters):
+        """
+        SQL of the rows of the database partitions, in READ_COLUMNS and
+        the source_order and row_order of the rows.
+        """
+        keys = pa.table({
+            'manifest': [m.id for m in manifests],
+            'version': [m.version_id for m in manifests],
+            'cycle': [m.cycle_id for m in manifests],
+            'dataset': [m.dataset_id for m in manifests],
+            'rule': [m.rule_id or 0 for m in manifests],
+            })
+        self.con.register('manifest_keys', keys)
+        try:
+            self._attach_database()
+            self.source = 'sqlite'
+        except (ValueError, self.duckdb.Error):
+            # rows read by the ORM, handed over as Arrow
+            df = DatabaseStorage().read(manifests, variables, value_filters)
+            # the rows are ordered by id
+            df = df.assign(source_order=0, row_order=range(len(df)))
+            self.con.register(
+                'database_rows',
+                pa.Table.from_pandas(df, preserve_index=False)
+                )
+            self.source = 'arrow'
+            return "SELECT * FROM database_rows"
+
+        # the scan of an attached table pushes no filter down to SQLite, so
+        # the rows are selected by a query run by SQLite itself
+        sql = _sqlite_rows_sql(manifests, variables)
+        return f"""
+            SELECT
+                k.manifest,
+                d.variable,
+                d.sample,
+                d.sequence,
+                d.value,
+                d.value_num,
+                0 AS source_order,
+                d.id AS row_order
+            FROM sqlite_query('nhanes_db', {_literal(sql)}) d
+            JOIN manifest_keys k
+                ON d.version = k.version
+                AND d.cycle = k.cycle
+                AND d.dataset = k.dataset
+                AND d.rule = k.rule
+            """
+
+    def _parquet_rows(self, manifests, variable_ids):
+        """
+        SQL of the rows of the Parquet partitions, in READ_COLUMNS and
+        the source_order and row_order of the rows: one branch per variable
+        column of each file, so only the projected columns are read and the
+        filters reach the row group statistics.
+        """
+        storage = ParquetStorage()
+        branches = []
+        for position, m in enumerate(manifests, start=1):
+            path = storage.manifest_path(m)
+            schema = pq.read_schema(path)
+            for name in schema.names:
+                if name in ('SEQN', 'sequence') or name not in variable_ids:
+                    continue
+                col = _quote(name)
+                if pa.types.is_floating(schema.field(name).type):
+                    value_num = f"CAST({col} AS DOUBLE)"
+                else:
+                    value_num = "CAST(NULL AS DOUBLE)"
+                branches.append(f"""
+                    SELECT
+                        {m.id} AS manifest,
+                        {variable_ids[name]} AS variable,
+                        "SEQN" AS sample,
+                        "sequence" AS sequence,
+                        CAST({col} AS VARCHAR) AS value,
+                        {value_num} AS value_num,
+                        {position} AS source_order,
+                        file_row_number AS row_order
+                    FROM read_parquet({_literal(path)}, file_row_number=true)
+                    WHERE {col} IS NOT NULL
+                    """)
+        return branches
+
+    def pivot(self, manifests, variables, value_filters, pivot_keys, batch_size=BATCH_SIZE):  # noqa E501
+        """
+        Pivot the values of the query.
+
+        Args:
+            manifests (iterable): DataManifest of the partitions to read.
+            variables (dict): Names of the variables to read by id, or None
+                to read every variable.
+            value_filters (list): Lookups on value or value_num.
+            pivot_keys (list): internal_data_key of the pivot columns, such
+                as 'dataset__dataset' or 'variable__variable'.
+
+        Returns:
+            pyarrow.RecordBatchReader: Cycle, sample, sequence and a column
+                per combination of the pivot keys, named by their values
+                joined by COLUMN_SEPARATOR.
+        """
+        if not pivot_keys:
+            raise ValueError("The query structure needs a column to pivot on.")  # noqa E501
+        manifests = list(
+            DataManifest.objects.filter(
+                id__in=[m.id for m in manifests]
+                ).select_related('version', 'cycle', 'dataset')
+            )
+
+        # attributes of the partitions and variables used by the pivot
+        manifest_keys = ['cycle__cycle'] + [
+            key for key in pivot_keys
+            if not key.startswith('variable__') and key != 'cycle__cycle'
+            ]
+        variable_keys = ['variable'] + [
+            key[len('variable__'):] for key in pivot_keys
+            if key.startswith('variable__') and key != 'variable__variable'
+            ]
+        partitions = DataManifest.objects.filter(
+            id__in=[m.id for m in manifests]
+            ).values_list('id', *manifest_keys)
+        self.con.register('partitions', pd.DataFrame.from_records(
+            list(partitions),
+            columns=['id'] + manifest_keys
+            ).astype({key: str for key in manifest_keys}))
+        qs_variable = Variable.objects.all()
+        if variables is not None:
+            qs_variable = qs_variable.filter(id__in=list(variables))
+        rows = list(qs_variable.values_list('id', *variable_keys))
+        self.con.register('variables', pd.DataFrame.from_records(
+            rows,
+            columns=['id'] + variable_keys
+            ).astype({key: str for key in variable_keys}))
+        variable_ids = {row[1]: row[0] for row in rows}
+
+        sources = []
+        db_manifests = [m for m in manifests if m.storage == 'db']
+        if db_manifests:
+            sources.append(
+                self._database_rows(db_manifests, variables, value_filters)
+                )
+        sources.extend(
+            self._parquet_rows(
+                [m for m in manifests if m.storage == 'parquet'],
+                variable_ids
+                )
+            )
+        if not sources:
+            sources = [
+                "SELECT " + ", ".join(
+                    f"CAST(NULL AS {kind}) AS {column}"
+                    for column, kind in zip(
+                        READ_COLUMNS + ['source_order', 'row_order'],
+                        ['BIGINT', 'BIGINT', 'BIGINT', 'BIGINT', 'VARCHAR', 'DOUBLE', 'BIGINT', 'BIGINT']  # noqa E501
+                        )
+                    ) + " WHERE false"
+                ]
+
+        conditions = []
+        params = []
+        for kwargs in value_filters:
+            sql, values = _lookup_sql(kwargs)
+            conditions.append(sql)
+            params.extend(values)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        def key_column(key):
+            if key.startswith('variable__'):
+                return f"CAST(v.{_quote(key[len('variable__'):])} AS VARCHAR)"  # noqa E501
+            return f"CAST(p.{_quote(key)} AS VARCHAR)"
+
+        pivot_column = f"concat_ws('{COLUMN_SEPARATOR}', " + ", ".join(
+            key_column(key) for key in pivot_keys
+            ) + ")"
+
+        # the filtered rows are staged in a temporary table, as DuckDB does
+        # not take parameters in the source of a PIVOT on the values of the
+        # data; 'nan' is the missing value of the dense database loads
+        self.con.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE pivot_source AS
+            SELECT
+                p."cycle__cycle" AS "Cycle",
+                r.sample,
+                r.sequence,
+                {pivot_column} AS pivot_column,
+                NULLIF(r.value, 'nan') AS value,
+                r.source_order,
+                r.row_order
+            FROM (
+                SELECT * FROM ({' UNION ALL '.join(sources)}) rows
+                {where}
+            ) r
+            JOIN partitions p ON r.manifest = p.id
+            JOIN variables v ON r.variable = v.id
+            """,
+            params
+            )
+        if not self.con.execute("SELECT count(*) FROM pivot_source").fetchone()[0]:  # noqa E501
+            # a PIVOT needs at least one value to build its columns
+            return pa.RecordBatchReader.from_batches(
+                pa.schema([
+                    pa.field('Cycle', pa.string()),
+                    pa.field('sample', pa.int64()),
+                    pa.field('sequence', pa.int64()),
+                    ]),
+                []
+                )
+        # first value that is not missing of each cell, in the order of
+        # read_data; the nulls are ordered last, as a FILTER clause on the
+        # aggregate is lost in the filter the PIVOT adds on pivot_column
+        result = self.con.execute(
+            """
+            PIVOT pivot_source
+            ON pivot_column
+            USING first(value ORDER BY value IS NULL, source_order, row_order)
+            GROUP BY "Cycle", sample, sequence
+            ORDER BY "Cycle", sample, sequence
+            """
+            )
+        if hasattr(result, 'to_arrow_reader'):
+            return result.to_arrow_reader(batch_size)
+        return result.fetch_record_batch(batch_size)
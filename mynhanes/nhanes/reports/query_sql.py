@@ -0,0 +1,100 @@
+"""
+SQL pivot of the QueryStructure export.
+
+The wide table is built by the database with conditional aggregation, one
+column per output column of the query:
+
+    SELECT cycle, sample, sequence,
+           MAX(CASE WHEN <values of column 0> THEN value END),
+           MAX(CASE WHEN <values of column 1> THEN value END), ...
+    FROM Data WHERE <partitions and filters of the query>
+    GROUP BY cycle, sample, sequence
+
+so only one row per sample leaves the database instead of one row per
+value. The values of a column are those of its variables in the
+partitions that give it its name (e.g. dataset DEMO and variable RIDAGEYR).
+It only reads the Data table; the pivot of Parquet partitions stays in
+pandas.
+
+MAX is the value of a cell only when the cell has one value. The rows also
+count their values, and queries with a cell of several values (several
+versions, or the output of a rule next to the raw data) are pivoted with
+pandas, which keeps the first one (the lowest id).
+"""
+from django.db.models import Case, CharField, Count, F, Max, OuterRef, Q, Subquery, When  # noqa E501
+from nhanes.models import Data, VariableCode
+from nhanes.workprocess.data_storage import DatabaseStorage, _partition_query
+from nhanes.workprocess.ingestion_utils import MISSING_VALUE
+
+# output columns above which the export falls back to the pandas pivot
+SQL_PIVOT_MAX_COLUMNS = 300
+
+
+def _cell_value(variable_ids):
+    # encoded rows hold the code of their value, looked up in VariableCode
+    if not VariableCode.objects.filter(variable_id__in=variable_ids).exists():
+        return F('value')
+    return Case(
+        When(value_code__isnull=True, then=F('value')),
+        default=Subquery(
+            VariableCode.objects.filter(
+                variable=OuterRef('variable'),
+                code=OuterRef('value_code')
+                ).values('value')[:1]
+            ),
+        output_field=CharField()
+        )
+
+
+def sql_pivot_rows(manifests, pairs, value_filters):
+    """
+    Queryset of the rows of the pivot.
+
+    Args:
+        manifests (list): DataManifest of the partitions, all in the Data
+            table.
+        pairs (DataFrame): manifest, variable and the code of the output
+            column of the pair, from 0 to the number of columns - 1.
+        value_filters (list): Lookups on value or value_num.
+
+    Returns:
+        QuerySet: Tuples of cycle, sample, sequence, the value of each
+            output column (None where there is no value) and the number of
+            values of the row. More values than filled columns means a cell
+            with several values, where MAX is not the first one.
+    """
+    by_id = {m.id: m for m in manifests}
+    query = _partition_query(manifests)
+    for kwargs in value_filters:
+        query &= DatabaseStorage._value_query(kwargs)
+    variable_ids = sorted(pairs['variable'].unique().tolist())
+    query &= Q(variable_id__in=variable_ids)
+
+    cell = _cell_value(variable_ids)
+    columns = {}
+    for code, column_pairs in pairs.groupby('column', sort=True):
+        condition = Q(
+            variable_id__in=sorted(column_pairs['variable'].unique().tolist())
+            ) & _partition_query(
+                [by_id[m] for m in column_pairs['manifest'].unique()]
+                )
+        # values stored as 'nan' are missing
+        condition &= ~Q(value=MISSING_VALUE)
+        columns[f"column_{code}"] = Max(
+            Case(When(condition, then=cell), output_field=CharField())
+            )
+
+    columns['n_values'] = Count(
+        Case(When(~Q(value=MISSING_VALUE), then=cell), output_field=CharField())  # noqa E501
+        )
+
+    return Data.objects.filter(query).values(
+        'cycle__cycle',
+        'sample',
+        'sequence'
+        ).annotate(**columns).order_by().values_list(
+            'cycle__cycle',
+            'sample',
+            'sequence',
+            *columns
+            )
@@ -1,7 +1,24 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
-from nhanes.models import WorkProcessNhanes, Data, Dataset, Cycle, DatasetCycle
+from nhanes.models import (
+    WorkProcessNhanes,
+    Data,
+    DataManifest,
+    Dataset,
+    Cycle,
+    DatasetCycle,
+    Group,
+    Tag,
+    Variable,
+    VariableCode,
+    Version
+    )
 from nhanes.utils.logs import logger, start_logger
+from nhanes.workprocess.data_storage import (
+    bump_data_generation,
+    bump_data_generation_on_commit,
+    delete_data
+    )
 from core.parameters import config
 
 
@@ -15,11 +32,19 @@ def handle_deletion(sender, instance, **kwargs):
         logger(log, "s", "Deleting data due to status 'delete'.")
 
         try:
-            # Attempt to delete the Data
-            deleted_count, _ = Data.objects.filter(
+            # Attempt to delete the Data, from the storage of each load
+            deleted_count = delete_data(
+                DataManifest.objects.filter(
+                    dataset=instance.dataset,
+                    cycle=instance.cycle
+                ).select_related('version', 'cycle', 'dataset')
+            )
+            deleted_count += Data.objects.filter(
                 dataset=instance.dataset,
                 cycle=instance.cycle
-            ).delete()
+            ).delete()[0]
+            # the query results cached before this deletion are stale
+            bump_data_generation()
 
             # Log the successful deletion
             msm = f"Successfully deleted {deleted_count} records for {instance.dataset.dataset} in cycle {instance.cycle.cycle} due to status 'delete'."  # noqa E501
@@ -46,6 +71,28 @@ def handle_deletion(sender, instance, **kwargs):
         # TODO: Add NormalizationData
 
 
+# models whose fields can be filters or columns of a QueryStructure export
+# (codes, descriptions, groups, tags), or decode its values
+EXPORT_METADATA_MODELS = [Version, Cycle, Group, Dataset, Tag, Variable, VariableCode]  # noqa E501
+
+
+def handle_metadata_change(sender, **kwargs):
+    # the query results cached before the edit are stale; one bump for all
+    # the rows saved in the same transaction
+    bump_data_generation_on_commit()
+
+
+for model in EXPORT_METADATA_MODELS:
+    post_save.connect(handle_metadata_change, sender=model)
+    post_delete.connect(handle_metadata_change, sender=model)
+
+
+@receiver(m2m_changed, sender=Variable.tags.through)
+def handle_variable_tags_change(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_data_generation_on_commit()
+
+
 @receiver(post_save, sender=Dataset)
 def create_workprocess_by_dataset(sender, instance, created, **kwargs):
     if created:
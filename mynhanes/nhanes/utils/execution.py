@@ -0,0 +1,109 @@
+"""
+Execution backend of the pivots of the reports.
+
+The backend is set once for the whole process in the execution section of
+parameters.yml:
+
+    pandas     the pivot runs in-process with pandas.
+    local      a local Dask cluster, started on the first large pivot and
+               reused by every export of the process until it exits.
+    scheduler  a client of the Dask scheduler at scheduler_address, shared
+               by every export of the process.
+
+With the local and scheduler backends, inputs with fewer than dask_min_rows
+rows still run with pandas: for them the scheduling costs more than the
+pivot itself.
+"""
+import atexit
+import threading
+from core.parameters import get_parameter
+
+BACKENDS = ['pandas', 'local', 'scheduler']
+# rows of the input under which the Dask backends pivot with pandas
+DASK_MIN_ROWS = 5_000_000
+
+_client = None
+_cluster = None
+_lock = threading.Lock()
+
+
+def get_backend():
+    backend = str(get_parameter('execution', 'backend', 'pandas')).lower()
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Invalid execution backend: {backend}. Please choose one of {', '.join(BACKENDS)}."  # noqa E501
+            )
+    return backend
+
+
+def use_dask(n_rows):
+    """
+    Return True if an input of n_rows rows runs on the Dask backend.
+    """
+    if get_backend() == 'pandas':
+        return False
+    return n_rows >= int(
+        get_parameter('execution', 'dask_min_rows', DASK_MIN_ROWS)
+        )
+
+
+def _start_client(backend):
+    from dask.distributed import Client, LocalCluster
+    if backend == 'scheduler':
+        address = get_parameter('execution', 'scheduler_address')
+        if not address:
+            raise ValueError(
+                "execution.scheduler_address key not found on Parameters file."  # noqa E501
+                )
+        return Client(address), None
+    cluster = LocalCluster(
+        n_workers=int(get_parameter('execution', 'n_workers', 2)),
+        threads_per_worker=int(
+            get_parameter('execution', 'threads_per_worker', 1)
+            ),
+        memory_limit=get_parameter('execution', 'memory_limit', '2GB'),
+        dashboard_address=get_parameter(
+            'execution',
+            'dashboard_address',
+            ':8787'
+            ),
+        )
+    return Client(cluster), cluster
+
+
+def get_dask_client():
+    """
+    Return the Dask client of the process, starting it on the first call.
+    A client that lost its cluster or scheduler is started again.
+    """
+    global _client, _cluster
+    backend = get_backend()
+    if backend == 'pandas':
+        raise ValueError("The pandas execution backend has no Dask client.")
+    with _lock:
+        if _client is not None and _client.status != 'running':
+            _close()
+        if _client is None:
+            _client, _cluster = _start_client(backend)
+        return _client
+
+
+def _close():
+    global _client, _cluster
+    if _client is not None:
+        _client.close()
+    if _cluster is not None:
+        _cluster.close()
+    _client = None
+    _cluster = None
+
+
+def close_dask_client():
+    """
+    Close the Dask client of the process and its local cluster, if any.
+    """
+    with _lock:
+        _close()
+
+
+atexit.register(close_dask_client)
@@ -25,8 +25,29 @@ def start_logger(process=None):
     return logger
 
 
+class LogBuffer:
+    """
+    Collects log messages emitted outside the thread that owns the database
+    (download workers, parse processes) so they can be written to the Logs
+    table later with flush().
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.records = []
+
+    def flush(self, log):
+        for status, message in self.records:
+            logger(log, status, message)
+        self.records = []
+
+
 # Logs
 def logger(log, status="e", message=None, content_object=None):
+    if isinstance(log, LogBuffer):
+        log.records.append((status, message))
+        return True
+
     log.info(message)
     if not message:
         message = 'not inform'
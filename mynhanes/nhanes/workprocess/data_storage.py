@@ -0,0 +1,727 @@
+"""
+Storage backends of the NHANES data.
+
+The 'db' backend keeps one Data row per cell. The 'parquet' backend writes
+each loaded (version, cycle, dataset) as one Parquet file under
+<download_path>/parquet, with a column per variable and the min/max
+statistics Parquet keeps for each row group. The backend of new loads is set
+in workprocess.data_storage; the DataManifest records the backend of every
+load, so the readers pick the right one for each partition and loads of both
+backends are read together.
+
+Both backends return the same long layout as the Data table, with only the
+requested variables (projection) and, for the filters on the value, only
+the rows that can match (predicate pushdown to the row groups of the
+Parquet files, to the WHERE clause for the database).
+"""
+import operator
+import os
+import time
+from functools import reduce
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+from nhanes.models import (
+    Cycle,
+    Data,
+    DataGeneration,
+    DataManifest,
+    Dataset,
+    Variable,
+    VariableCode,
+    Version
+    )
+from nhanes.utils.logs import logger
+from nhanes.workprocess import ingestion_utils
+from nhanes.workprocess.ingestion_codes import decode_values
+from core.parameters import get_parameter
+
+# columns returned by read_data; manifest is the id of the DataManifest of
+# the partition and variable the id of the Variable
+READ_COLUMNS = ['manifest', 'variable', 'sample', 'sequence', 'value', 'value_num']  # noqa E501
+
+# lookups of a filter on the value that compare numbers, not strings
+NUMERIC_OPERATORS = ['lt', 'lte', 'gt', 'gte', 'range']
+
+# folder of the Parquet files under the download path
+PARQUET_FOLDER = "parquet"
+# rows per row group; the min/max statistics are kept per row group
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+PARQUET_COMPRESSION = "zstd"
+
+
+def _split_lookup(key):
+    # 'value_num__gt' -> ('value_num', 'gt'), 'value' -> ('value', 'exact')
+    field, _, lookup = key.partition('__')
+    return field, lookup or 'exact'
+
+
+def _partition_query(manifests):
+    """
+    Q of the Data rows of the partitions, grouped by version, dataset and
+    rule with the list of their cycles.
+    """
+    groups = {}
+    for m in manifests:
+        key = (m.version_id, m.dataset_id, m.rule_id)
+        groups.setdefault(key, set()).add(m.cycle_id)
+    query = Q()
+    for (version_id, dataset_id, rule_id), cycle_ids in groups.items():
+        partition = Q(
+            version_id=version_id,
+            dataset_id=dataset_id,
+            cycle_id__in=sorted(cycle_ids)
+            )
+        if rule_id is None:
+            partition &= Q(rule_id__isnull=True)
+        else:
+            partition &= Q(rule_id=rule_id)
+        query = partition if not query else query | partition
+    return query
+
+
+def _stored_elsewhere(log, name, cycle_id, dataset_id):
+    # a dataset is kept in a single storage; a load of another storage has
+    # to be deleted before the dataset is loaded again
+    storage = DataManifest.objects.filter(
+        cycle_id=cycle_id,
+        dataset_id=dataset_id,
+        rule__isnull=True
+        ).exclude(storage=name).values_list('storage', flat=True).first()
+    if storage is None:
+        return False
+    msm = f"Cycle {cycle_id} and dataset {dataset_id} are stored in the {storage} storage. Delete them to load them in the {name} storage."  # noqa E501
+    logger(log, "e", msm)
+    return True
+
+
+class DatabaseStorage:
+    """
+    Data rows in the Data table, one row per cell.
+    """
+    name = "db"
+
+    def save(self, log, df, cycle_id, dataset_id, **options):
+        return ingestion_utils.save_nhanes_data(
+            log,
+            df,
+            cycle_id,
+            dataset_id,
+            **options
+            )
+
+    def apply_delta(self, log, df, cycle_id, dataset_id, **options):
+        if _stored_elsewhere(log, self.name, cycle_id, dataset_id):
+            return None
+        return ingestion_utils.apply_nhanes_data_delta(
+            log,
+            df,
+            cycle_id,
+            dataset_id,
+            **options
+            )
+
+    @staticmethod
+    def _value_query(kwargs):
+        # encoded rows match on the value of their code; the lookup is the
+        # same on VariableCode.value
+        field, _ = _split_lookup(next(iter(kwargs)))
+        if field != 'value':
+            return Q(**kwargs)
+        return Q(**kwargs) | Q(Exists(
+            VariableCode.objects.filter(
+                variable=OuterRef('variable'),
+                code=OuterRef('value_code'),
+                **kwargs
+                )
+            ))
+
+    def _query(self, manifests, variables, value_filters):
+        manifests = list(manifests)
+        keys = pd.DataFrame.from_records(
+            [
+                (m.id, m.version_id, m.cycle_id, m.dataset_id, m.rule_id or 0)
+                for m in manifests
+            ],
+            columns=['manifest', 'version', 'cycle', 'dataset', 'rule']
+            )
+        # one query for all the partitions, so only their rows are read;
+        # the merge adds the manifest of each row
+        query = _partition_query(manifests) if manifests else Q(pk__in=[])
+        if variables is not None:
+            query &= Q(variable_id__in=list(variables))
+        for kwargs in value_filters:
+            query &= self._value_query(kwargs)
+        return keys, query
+
+    @staticmethod
+    def _merge_keys(df, keys):
+        df['rule'] = pd.to_numeric(df['rule']).fillna(0)
+        df = df.astype({
+            'version': np.int64,
+            'cycle': np.int64,
+            'dataset': np.int64,
+            'rule': np.int64
+            })
+        return df.merge(keys, on=['version', 'cycle', 'dataset', 'rule'])
+
+    def read(self, manifests, variables=None, value_filters=()):
+        keys, query = self._query(manifests, variables, value_filters)
+        # in id order, so the first value of a cell with several values
+        # (the one kept by the pivot) is the one loaded first
+        qs = Data.objects.filter(query).values_list(
+            'version_id',
+            'cycle_id',
+            'dataset_id',
+            'rule_id',
+            'variable_id',
+            'sample',
+            'sequence',
+            'value',
+            'value_num',
+            'value_code'
+            ).order_by('id')
+        df = pd.DataFrame.from_records(
+            qs.iterator(chunk_size=ingestion_utils.DATA_INSERT_BATCH),
+            columns=['version', 'cycle', 'dataset', 'rule'] + READ_COLUMNS[1:] + ['value_code']  # noqa E501
+            )
+        df = decode_values(df, 'variable')
+        df = self._merge_keys(df, keys)
+        df['value_num'] = df['value_num'].astype(float)
+        return df[READ_COLUMNS]
+
+    def read_variables(self, manifests, variables=None, value_filters=()):
+        keys, query = self._query(manifests, variables, value_filters)
+        # the distinct pairs are computed by the database
+        qs = Data.objects.filter(query).values_list(
+            'version_id',
+            'cycle_id',
+            'dataset_id',
+            'rule_id',
+            'variable_id'
+            ).order_by().distinct()
+        df = pd.DataFrame.from_records(
+            list(qs),
+            columns=['version', 'cycle', 'dataset', 'rule', 'variable']
+            )
+        return self._merge_keys(df, keys)[['manifest', 'variable']]
+
+    def delete(self, manifests):
+        deleted = 0
+        for m in manifests:
+            count, _ = Data.objects.filter(
+                version_id=m.version_id,
+                cycle_id=m.cycle_id,
+                dataset_id=m.dataset_id,
+                rule_id=m.rule_id
+                ).delete()
+            deleted += count
+        return deleted
+
+
+class ParquetStorage:
+    """
+    One Parquet file per loaded (version, cycle, dataset), with SEQN,
+    sequence and a column per variable, in
+    <root>/version=<version>/cycle=<cycle>/dataset=<dataset>/data.parquet.
+    Numeric variables are stored as doubles and character variables as
+    strings; missing values are nulls, not rows.
+    """
+    name = "parquet"
+
+    def __init__(self, root=None):
+        if root is None:
+            root = Path(
+                get_parameter('workprocess', 'download_path', settings.BASE_DIR)  # noqa E501
+                ) / PARQUET_FOLDER
+        self.root = Path(root)
+
+    def path(self, version, cycle, dataset):
+        return self.root / f"version={version}" / f"cycle={cycle}" / \
+            f"dataset={dataset}" / "data.parquet"
+
+    def manifest_path(self, manifest):
+        return self.path(
+            manifest.version.version,
+            manifest.cycle.cycle,
+            manifest.dataset.dataset
+            )
+
+    @staticmethod
+    def _schema(chunk, columns):
+        import pyarrow as pa
+        fields = [
+            pa.field('SEQN', pa.int64()),
+            pa.field('sequence', pa.int64())
+            ]
+        for col in columns:
+            if pd.api.types.is_numeric_dtype(chunk[col]):
+                fields.append(pa.field(col, pa.float64()))
+            else:
+                fields.append(pa.field(col, pa.string()))
+        return pa.schema(fields)
+
+    def _write(self, df, path):
+        """
+        Write the chunks of df to a temporary file next to path.
+
+        Returns:
+            tuple: (temporary path, variables by name, number of cells,
+                samples, number of missing cells).
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        chunks = [df] if isinstance(df, pd.DataFrame) else df
+        os.makedirs(path.parent, exist_ok=True)
+        tmp_path = path.with_suffix('.parquet.tmp')
+        writer = None
+        variable = None
+        n_cells = 0
+        n_missing = 0
+        samples = set()
+        try:
+            for chunk in chunks:
+                if variable is None:
+                    variable = ingestion_utils._get_data_variables(chunk.columns)  # noqa E501
+                    columns = ingestion_utils._data_columns(
+                        chunk.columns,
+                        variable
+                        )
+                    schema = self._schema(chunk, columns)
+                    writer = pq.ParquetWriter(
+                        tmp_path,
+                        schema,
+                        compression=PARQUET_COMPRESSION,
+                        write_statistics=True
+                        )
+                frame = chunk[['SEQN', 'sequence'] + columns].astype(
+                    {'SEQN': np.int64, 'sequence': np.int64}
+                    )
+                writer.write_table(
+                    pa.Table.from_pandas(
+                        frame,
+                        schema=schema,
+                        preserve_index=False
+                        ),
+                    row_group_size=PARQUET_ROW_GROUP_SIZE
+                    )
+                n_cells += len(chunk) * len(columns)
+                n_missing += int(chunk[columns].isna().to_numpy().sum())
+                samples.update(chunk['SEQN'].unique().tolist())
+        except Exception:
+            if writer is not None:
+                writer.close()
+            ingestion_utils._remove_files(tmp_path)
+            raise
+        if writer is not None:
+            writer.close()
+        return tmp_path, variable or {}, n_cells, samples, n_missing
+
+    def _load(self, log, df, cycle_id, dataset_id, source_hash, delta):
+        try:
+            cycle = Cycle.objects.get(id=cycle_id)
+            dataset = Dataset.objects.get(id=dataset_id)
+            version = Version.objects.get(version='nhanes')
+        except (Cycle.DoesNotExist, Dataset.DoesNotExist):
+            msm = "Dataset or Cycle not found on ParquetStorage."
+            logger(log, "e", msm)
+            return None
+
+        manifest = DataManifest.objects.filter(
+            cycle=cycle,
+            dataset=dataset,
+            rule__isnull=True
+            ).first()
+        if manifest is not None and not delta:
+            msm = "Data already exists for this cycle and dataset. No updates will be performed."  # noqa E501
+            logger(log, "w", msm)
+            return None
+        if _stored_elsewhere(log, self.name, cycle_id, dataset_id):
+            return None
+
+        changes = {'inserted': 0, 'updated': 0, 'deleted': 0}
+        if manifest is not None and source_hash and \
+                manifest.source_hash == source_hash:
+            msm = f"Source file of cycle {cycle_id} and dataset {dataset_id} is unchanged. No delta to apply."  # noqa E501
+            logger(log, "i", msm)
+            return changes
+
+        path = self.path(version.version, cycle.cycle, dataset.dataset)
+        v_time_start = time.time()
+        tmp_path = None
+        try:
+            tmp_path, variable, n_cells, samples, n_missing = self._write(
+                df,
+                path
+                )
+            n_rows = n_cells - n_missing
+            if manifest is not None:
+                # the file is the unit of storage: the delta is counted on
+                # the rows of both files and the file is replaced
+                key = ingestion_utils.DELTA_KEY
+                df_old = self._read_file(path, manifest.id)
+                df_new = self._read_file(tmp_path, manifest.id)
+                df_insert, df_update, delete_ids = \
+                    ingestion_utils._compare_data_rows(
+                        df_old[key + ['value']].assign(id=np.arange(len(df_old))),  # noqa E501
+                        df_new[key + ['value', 'value_num']].assign(value_code=None)  # noqa E501
+                        )
+                changes = {
+                    'inserted': len(df_insert),
+                    'updated': len(df_update),
+                    'deleted': len(delete_ids)
+                    }
+            else:
+                manifest = DataManifest(
+                    version=version,
+                    cycle=cycle,
+                    dataset=dataset,
+                    storage=self.name
+                    )
+                changes['inserted'] = n_rows
+
+            with transaction.atomic():
+                manifest.rows = n_rows
+                manifest.n_samples = len(samples)
+                manifest.n_variables = len(set(variable) - {'SEQN'})
+                manifest.source_hash = source_hash or ""
+                manifest.load_time = time.time() - v_time_start
+                manifest.save()
+                os.replace(tmp_path, path)
+        except Exception as e:
+            if tmp_path is not None:
+                ingestion_utils._remove_files(tmp_path)
+            msm = f"Error saving the Parquet file of cycle {cycle_id} and dataset {dataset_id}: {e}"  # noqa E501
+            logger(log, "e", msm)
+            return None
+
+        msm = f"Data of cycle {cycle_id} and dataset {dataset_id} saved in {path} ({n_rows} values, {path.stat().st_size / 1024 ** 2:.1f} MB)."  # noqa E501
+        logger(log, "i", msm)
+        return changes
+
+    def save(self, log, df, cycle_id, dataset_id, save_data=True, source_hash="", **options):  # noqa E501
+        # sparse and encoded do not apply: missing values are nulls and the
+        # strings are dictionary encoded by Parquet itself
+        if not save_data:
+            return True
+        return self._load(
+            log,
+            df,
+            cycle_id,
+            dataset_id,
+            source_hash,
+            delta=False
+            ) is not None
+
+    def apply_delta(self, log, df, cycle_id, dataset_id, source_hash="", **options):  # noqa E501
+        return self._load(
+            log,
+            df,
+            cycle_id,
+            dataset_id,
+            source_hash,
+            delta=True
+            )
+
+    @staticmethod
+    def _pushdown(value_filters, schema, columns):
+        """
+        Arrow expression selecting the rows where at least one column can
+        match every value filter, or None. It only has to keep every row
+        that matches: the cells are filtered exactly after the melt.
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        numeric = [c for c in columns if pa.types.is_floating(schema.field(c).type)]  # noqa E501
+        text = [c for c in columns if c not in numeric]
+        compare = {
+            'lt': operator.lt,
+            'lte': operator.le,
+            'gt': operator.gt,
+            'gte': operator.ge
+            }
+        expressions = []
+        for kwargs in value_filters:
+            (key, value), = kwargs.items()
+            field, lookup = _split_lookup(key)
+            if field == 'value_num' and lookup in compare:
+                matches = [
+                    compare[lookup](pc.field(c), float(value))
+                    for c in numeric
+                    ]
+            elif field == 'value_num' and lookup == 'range':
+                matches = [
+                    (pc.field(c) >= float(value[0])) &
+                    (pc.field(c) <= float(value[1]))
+                    for c in numeric
+                    ]
+            elif field == 'value' and lookup in ['exact', 'in']:
+                values = value if lookup == 'in' else [value]
+                matches = [pc.field(c).isin(values) for c in text]
+                # the text of a number matches the column of its double
+                numbers = pd.to_numeric(
+                    pd.Series(values, dtype=object),
+                    errors='coerce'
+                    ).dropna().tolist()
+                matches += [pc.field(c).isin(numbers) for c in numeric]
+            else:
+                continue
+            if not matches:
+                return pc.scalar(False)
+            expressions.append(reduce(operator.or_, matches))
+        if not expressions:
+            return None
+        return reduce(operator.and_, expressions)
+
+    @staticmethod
+    def _match_values(df, kwargs):
+        # exact filter of the melted cells, with the meaning of the Django
+        # lookups on the Data table
+        (key, value), = kwargs.items()
+        field, lookup = _split_lookup(key)
+        series = df[field]
+        text = series.astype(str)
+        if lookup == 'exact':
+            return series == value
+        if lookup == 'iexact':
+            return text.str.lower() == str(value).lower()
+        if lookup == 'in':
+            return series.isin(value)
+        if lookup in ['lt', 'lte', 'gt', 'gte']:
+            return getattr(operator, lookup.replace('te', 'e'))(series, value)
+        if lookup == 'range':
+            return series.between(*value)
+        if lookup == 'isnull':
+            return series.isna() == value
+        if lookup in ['contains', 'icontains']:
+            return text.str.contains(
+                value,
+                case=lookup == 'contains',
+                regex=False
+                )
+        if lookup in ['startswith', 'istartswith', 'endswith', 'iendswith']:
+            method = lookup.lstrip('i')
+            if lookup.startswith('i'):
+                return getattr(text.str.lower().str, method)(str(value).lower())  # noqa E501
+            return getattr(text.str, method)(value)
+        if lookup in ['regex', 'iregex']:
+            return text.str.contains(
+                value,
+                case=lookup == 'regex',
+                regex=True
+                )
+        raise ValueError(f"Lookup {key} is not supported by the Parquet storage.")  # noqa E501
+
+    def _read_file(self, path, manifest_id, variables=None, value_filters=()):
+        import pyarrow.parquet as pq
+
+        schema = pq.read_schema(path)
+        names = [n for n in schema.names if n not in ('SEQN', 'sequence')]
+        if variables is not None:
+            wanted = set(variables.values())
+            names = [n for n in names if n in wanted]
+        variable = {
+            var.variable: var for var in Variable.objects.filter(
+                variable__in=names
+                ).only('id', 'variable')
+            }
+        names = [n for n in names if n in variable]
+        table = pq.read_table(
+            path,
+            columns=['SEQN', 'sequence'] + names,
+            filters=self._pushdown(value_filters, schema, names)
+            )
+        arrays = ingestion_utils._melt_data_arrays(
+            table.to_pandas(),
+            variable,
+            sparse=True
+            )
+        if arrays is None:
+            df = pd.DataFrame(
+                {column: pd.Series(dtype=np.int64) for column in READ_COLUMNS[1:4]}  # noqa E501
+                ).assign(
+                    value=pd.Series(dtype=object),
+                    value_num=pd.Series(dtype=float)
+                    )
+        else:
+            df = pd.DataFrame(dict(zip(READ_COLUMNS[1:], arrays)))
+            df['value_num'] = df['value_num'].astype(float)
+        for kwargs in value_filters:
+            df = df[self._match_values(df, kwargs)]
+        return df.assign(manifest=manifest_id)[READ_COLUMNS]
+
+    def read(self, manifests, variables=None, value_filters=()):
+        frames = [
+            self._read_file(
+                self.manifest_path(m),
+                m.id,
+                variables,
+                value_filters
+                )
+            for m in manifests
+        ]
+        if not frames:
+            return pd.DataFrame(columns=READ_COLUMNS)
+        return pd.concat(frames, ignore_index=True)
+
+    def read_variables(self, manifests, variables=None, value_filters=()):
+        # one file in memory at a time
+        frames = [
+            self._read_file(
+                self.manifest_path(m),
+                m.id,
+                variables,
+                value_filters
+                )[['manifest', 'variable']].drop_duplicates()
+            for m in manifests
+        ]
+        if not frames:
+            return pd.DataFrame(columns=['manifest', 'variable'])
+        return pd.concat(frames, ignore_index=True)
+
+    def delete(self, manifests):
+        deleted = 0
+        for m in manifests:
+            path = self.manifest_path(m)
+            if path.exists():
+                ingestion_utils._remove_files(path)
+                deleted += m.rows
+        return deleted
+
+
+STORAGES = {
+    DatabaseStorage.name: DatabaseStorage,
+    ParquetStorage.name: ParquetStorage,
+}
+
+
+def get_data_storage(name=None):
+    """
+    Return the storage backend called name, by default the one set in
+    workprocess.data_storage ('db' or 'parquet').
+    """
+    name = name or get_parameter('workprocess', 'data_storage', 'db')
+    if name not in STORAGES:
+        raise ValueError(f"Invalid data storage {name}. Please choose {', '.join(STORAGES)}.")  # noqa E501
+    return STORAGES[name]()
+
+
+def read_data(manifests, variables=None, value_filters=()):
+    """
+    Read the values of the loaded partitions from their storages.
+
+    Args:
+        manifests (iterable): DataManifest of the partitions to read.
+        variables (dict): Names of the variables to read by id, or None to
+            read every variable.
+        value_filters (list): Lookups on value or value_num, as given to
+            Data.objects.filter (e.g. {'value_num__gt': 10.0}); a cell is
+            kept when it matches all of them.
+
+    Returns:
+        DataFrame: READ_COLUMNS. The missing values of dense database loads
+            are kept as stored ('nan').
+    """
+    manifests = list(manifests.select_related('version', 'cycle', 'dataset')) \
+        if hasattr(manifests, 'select_related') else list(manifests)
+    frames = []
+    for name, storage in STORAGES.items():
+        selected = [m for m in manifests if m.storage == name]
+        if selected:
+            frames.append(storage().read(selected, variables, value_filters))
+    if not frames:
+        return pd.DataFrame(columns=READ_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_data_variables(manifests, variables=None, value_filters=()):
+    """
+    Return the variables with values in each partition, with the arguments
+    of read_data, without reading the values.
+
+    Returns:
+        DataFrame: manifest and variable, one row per pair.
+    """
+    manifests = list(manifests.select_related('version', 'cycle', 'dataset')) \
+        if hasattr(manifests, 'select_related') else list(manifests)
+    frames = []
+    for name, storage in STORAGES.items():
+        selected = [m for m in manifests if m.storage == name]
+        if selected:
+            frames.append(
+                storage().read_variables(selected, variables, value_filters)
+                )
+    if not frames:
+        return pd.DataFrame(columns=['manifest', 'variable'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def delete_data(manifests):
+    """
+    Delete the data of the partitions from their storages, and their
+    DataManifest rows.
+
+    Returns:
+        int: Number of values deleted.
+    """
+    manifests = list(manifests)
+    deleted = 0
+    for name, storage in STORAGES.items():
+        selected = [m for m in manifests if m.storage == name]
+        if selected:
+            deleted += storage().delete(selected)
+    DataManifest.objects.filter(id__in=[m.id for m in manifests]).delete()
+    return deleted
+
+
+def get_data_generation():
+    """
+    Return the generation of the loaded data, 0 before the first change.
+    """
+    generation = DataGeneration.objects.values_list(
+        'generation',
+        flat=True
+        ).first()
+    return generation or 0
+
+
+def bump_data_generation():
+    """
+    Count a change of the loaded data (a load, a deletion, the output of a
+    rule or an edit of the metadata shown in the exports), so the query
+    results cached before it are not reused.
+
+    Returns:
+        int: The new generation.
+    """
+    # F() so concurrent processes never lose an increment; a single UPDATE
+    # once the row exists, as it also runs on every metadata save
+    for _ in range(2):
+        updated = DataGeneration.objects.filter(pk=1).update(
+            generation=F('generation') + 1,
+            updated_at=timezone.now()
+            )
+        if updated:
+            break
+        DataGeneration.objects.get_or_create(pk=1)
+    return get_data_generation()
+
+
+def bump_data_generation_on_commit():
+    """
+    Bump the data generation once when the current transaction commits,
+    however many times it is called in the transaction (e.g. for each
+    metadata row saved); at once in autocommit mode.
+    """
+    # the callbacks of a rolled back transaction or savepoint are dropped
+    # by Django, so a bump is pending only while it is in the queue
+    for _, func, *_ in connection.run_on_commit:
+        if func is bump_data_generation:
+            return
+    transaction.on_commit(bump_data_generation)
@@ -0,0 +1,130 @@
+import json
+import os
+from contextlib import contextmanager
+from django.db import connection
+from nhanes.models import Data
+from nhanes.utils.logs import logger
+
+# name of the file that keeps the dropped indexes until they are rebuilt
+BULK_STATE_FILE = "bulk_indexes.json"
+
+# indexes kept during the bulk load: handle_deletion removes the rows of a
+# dataset, and without this index every delete scans the table
+KEEP_INDEX_COLUMNS = [['dataset_id']]
+
+
+def _get_data_indexes():
+    """
+    Return the secondary indexes of the Data table as a list of dicts with
+    the keys name, columns and sql (the statement that created the index).
+    Primary key and unique indexes are never included.
+    """
+    table = Data._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+        cursor.execute(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL",
+            [table]
+            )
+        statements = dict(cursor.fetchall())
+    return [
+        {'name': name, 'columns': info['columns'], 'sql': statements[name]}
+        for name, info in constraints.items()
+        if info['index'] and not info['primary_key'] and not info['unique']
+        and name in statements
+    ]
+
+
+def _write_state(state_file, indexes):
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump({'table': Data._meta.db_table, 'indexes': indexes}, f)
+    os.replace(tmp_file, state_file)
+
+
+def drop_data_indexes(log, state_file):
+    """
+    Drop the secondary indexes of the Data table.
+
+    The CREATE statements are written to state_file before anything is
+    dropped, so the indexes can be rebuilt by restore_data_indexes() even
+    if the process dies in the middle of the load.
+
+    Returns:
+        list: The indexes dropped.
+    """
+    indexes = [
+        index for index in _get_data_indexes()
+        if index['columns'] not in KEEP_INDEX_COLUMNS
+    ]
+    _write_state(state_file, indexes)
+    with connection.cursor() as cursor:
+        for index in indexes:
+            cursor.execute(
+                f"DROP INDEX IF EXISTS {connection.ops.quote_name(index['name'])}"  # noqa E501
+                )
+    msm = f"Bulk mode: dropped {len(indexes)} indexes of the Data table."
+    logger(log, "i", msm)
+    return indexes
+
+
+def restore_data_indexes(log, state_file):
+    """
+    Rebuild the indexes recorded in state_file, run ANALYZE and remove the
+    state file. Indexes that already exist are skipped, so it is safe to run
+    it again after a failure.
+
+    Returns:
+        int: Number of indexes rebuilt.
+    """
+    try:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return 0
+
+    existing = {index['name'] for index in _get_data_indexes()}
+    rebuilt = 0
+    with connection.cursor() as cursor:
+        for index in state['indexes']:
+            if index['name'] in existing:
+                continue
+            cursor.execute(index['sql'])
+            rebuilt += 1
+        cursor.execute(f"ANALYZE {connection.ops.quote_name(state['table'])}")
+    os.remove(state_file)
+    msm = f"Bulk mode: rebuilt {rebuilt} indexes of the Data table and updated its statistics."  # noqa E501
+    logger(log, "i", msm)
+    return rebuilt
+
+
+def recover_data_indexes(log, state_file):
+    """
+    Rebuild the indexes left dropped by an interrupted bulk load.
+    """
+    if not os.path.exists(state_file):
+        return 0
+    msm = "Bulk mode: found indexes dropped by an interrupted run. Rebuilding them."  # noqa E501
+    logger(log, "w", msm)
+    return restore_data_indexes(log, state_file)
+
+
+@contextmanager
+def bulk_load(log, state_file):
+    """
+    Drop the Data indexes for the duration of the block and rebuild them
+    once at the end, whether the block succeeds or fails.
+    """
+    if connection.vendor != 'sqlite':
+        msm = f"Bulk mode is not supported on {connection.vendor}. Loading with the indexes in place."  # noqa E501
+        logger(log, "w", msm)
+        yield False
+        return
+
+    recover_data_indexes(log, state_file)
+    drop_data_indexes(log, state_file)
+    try:
+        yield True
+    finally:
+        restore_data_indexes(log, state_file)
@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+import pandas as pd
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    Return the SHA-256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SidecarCache:
+    """
+    Files of a cache folder indexed by JSON sidecars <key>.json, each with
+    at least the size of the file and its last access time. The sidecars
+    are the index: they are read once when the cache is opened and kept in
+    memory afterwards.
+
+    When max_size (bytes) is set, evict() removes the least recently used
+    files until the cache fits. Subclasses give the path of the file of a
+    key in _file_path.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.entries = {}
+        for meta_file in self.cache_dir.glob('*.json'):
+            # skip the state files of partial downloads (<key>.XPT.part.json)
+            if '.' in meta_file.stem:
+                continue
+            try:
+                with open(meta_file, 'r') as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self.entries[meta_file.stem] = entry
+
+    def _file_path(self, key, entry):
+        raise NotImplementedError
+
+    def _meta_path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def _write_meta(self, key, entry):
+        tmp_path = self._meta_path(key).with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._meta_path(key))
+
+    def _store_entry(self, key, entry):
+        entry['last_access'] = time.time()
+        with self.lock:
+            self.entries[key] = entry
+            self._write_meta(key, entry)
+        return entry
+
+    def _touch(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry['last_access'] = time.time()
+            self._write_meta(key, entry)
+        return entry
+
+    def _remove(self, key, path=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if path is None and entry is not None:
+                path = self._file_path(key, entry)
+            for path in [path, self._meta_path(key)]:
+                if path is None:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def total_size(self):
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def evict(self, keep=()):
+        """
+        Remove least recently used files until the cache fits max_size.
+        Keys in keep are never removed.
+
+        Returns:
+            int: Number of files removed.
+        """
+        if not self.max_size:
+            return 0
+        with self.lock:
+            entries = sorted(
+                self.entries.items(),
+                key=lambda item: item[1]['last_access']
+                )
+            total = sum(entry['size'] for _, entry in entries)
+        removed = 0
+        for key, entry in entries:
+            if total <= self.max_size:
+                break
+            if key in keep:
+                continue
+            self._remove(key)
+            total -= entry['size']
+            removed += 1
+        return removed
+
+
+class DownloadCache(SidecarCache):
+    """
+    Persistent cache of the files downloaded from the NHANES site.
+
+    Each URL is stored as <sha256 of the URL><extension> in cache_dir with a
+    sidecar holding the URL, ETag, Last-Modified, size, SHA-256 of the
+    content and the last access time.
+    """
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def path(self, url):
+        """
+        Path of the cached copy of url. The URL extension is kept so the
+        parsers can still tell XPT and HTM files apart.
+        """
+        suffix = Path(urlparse(url).path).suffix
+        return self.cache_dir / f"{self.key(url)}{suffix}"
+
+    def _file_path(self, key, entry):
+        return self.path(entry['url'])
+
+    def get(self, url):
+        """
+        Return the cache entry of url, or None when there is no valid copy.
+        """
+        key = self.key(url)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        path = self.path(url)
+        if not path.exists() or path.stat().st_size != entry['size']:
+            self.remove(url)
+            return None
+        return entry
+
+    def verify(self, url):
+        """
+        Check the cached copy of url against the size and SHA-256 recorded
+        when it was downloaded.
+        """
+        entry = self.get(url)
+        if entry is None:
+            return False
+        return file_sha256(self.path(url)) == entry['sha256']
+
+    def conditional_headers(self, url):
+        """
+        Headers to revalidate the cached copy of url with the server.
+        """
+        entry = self.get(url)
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, headers, size, sha256):
+        """
+        Register the file just written to path(url).
+        """
+        return self._store_entry(self.key(url), {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'size': size,
+            'sha256': sha256,
+        })
+
+    def touch(self, url):
+        """
+        Mark url as recently used.
+        """
+        return self._touch(self.key(url))
+
+    def remove(self, url):
+        self._remove(self.key(url), self.path(url))
+
+    def evict(self, keep=()):
+        """
+        Remove least recently used files until the cache fits max_size.
+        URLs in keep are never removed.
+
+        Returns:
+            int: Number of files removed.
+        """
+        return super().evict(keep={self.key(url) for url in keep})
+
+
+class CodebookCache:
+    """
+    Parsed NHANES codebooks keyed by the SHA-256 of their HTM file.
+
+    Each entry is a JSON file <sha256>.json with the variables DataFrame (in
+    the pandas 'split' layout) and the code tables already serialized as
+    JSON records, so an unchanged codebook is never parsed again.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, sha256):
+        return self.cache_dir / f"{sha256}.json"
+
+    def get(self, sha256, source_code):
+        """
+        Return the (variable_df, json_tables) parsed for this HTM content and
+        dataset, or None when it was not parsed yet.
+        """
+        try:
+            with open(self.path(sha256), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('source') != source_code:
+            return None
+        variables = entry['variables']
+        variable_df = pd.DataFrame(
+            variables['data'],
+            index=variables['index'],
+            columns=variables['columns'],
+            )
+        return variable_df, entry['code_tables']
+
+    def store(self, sha256, source_code, variable_df, json_tables):
+        entry = {
+            'source': source_code,
+            'variables': variable_df.to_dict(orient='split'),
+            'code_tables': json_tables,
+        }
+        tmp_path = self.path(sha256).with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self.path(sha256))
@@ -0,0 +1,156 @@
+"""
+Dictionary encoding of the values of categorical variables.
+
+In encoded mode the Data rows of a categorical variable keep an integer code
+of the VariableCode table in value_code and an empty value. A variable is
+categorical in a cycle when its code table lists the values one by one,
+without a 'Range of Values' row. Encoding and decoding work on whole arrays,
+one merge per chunk, never value by value.
+"""
+import json
+import numpy as np
+import pandas as pd
+from nhanes.models import VariableCode, VariableCycle
+
+# description of the code table rows of the continuous variables
+RANGE_OF_VALUES = "Range of Values"
+
+
+def _is_categorical_table(value_table):
+    # value_table holds the code table as a JSON string (or its list)
+    if isinstance(value_table, str):
+        try:
+            value_table = json.loads(value_table)
+        except ValueError:
+            return False
+    if not isinstance(value_table, list) or not value_table:
+        return False
+    codes = [str(row.get('Code or Value', '')).lower() for row in value_table]
+    descriptions = [row.get('Value Description') for row in value_table]
+    if codes == ['no data'] or RANGE_OF_VALUES in descriptions:
+        return False
+    return True
+
+
+def categorical_variables(cycle_id, dataset_id, variable_ids):
+    """
+    Return the ids of the variables, among variable_ids, whose code table in
+    the cycle and dataset describes a categorical variable.
+    """
+    qs = VariableCycle.objects.filter(
+        cycle_id=cycle_id,
+        dataset_id=dataset_id,
+        variable_id__in=list(variable_ids)
+        ).values_list('variable_id', 'value_table')
+    return {
+        variable_id for variable_id, value_table in qs
+        if _is_categorical_table(value_table)
+    }
+
+
+class ValueEncoder:
+    """
+    Encode the values of the categorical variables into VariableCode codes.
+
+    The codes of the variables are loaded once; values not seen before get
+    the next codes of their variable and are saved in a single bulk insert
+    per chunk.
+    """
+
+    def __init__(self, categorical):
+        self.categorical = np.array(sorted(categorical), dtype=np.int64)
+        self.codes = pd.DataFrame.from_records(
+            VariableCode.objects.filter(
+                variable_id__in=self.categorical.tolist()
+                ).values_list('variable_id', 'value', 'code'),
+            columns=['variable', 'value', 'code']
+            ).astype({'variable': np.int64, 'code': np.int64})
+        self.created = 0
+
+    def _add_codes(self, new):
+        # next codes of each variable, after the ones already assigned
+        start = new['variable'].map(
+            self.codes.groupby('variable')['code'].max() + 1
+            ).fillna(0).astype(np.int64)
+        new = new.assign(
+            code=start + new.groupby('variable').cumcount().astype(np.int64)
+            )
+        VariableCode.objects.bulk_create(
+            [
+                VariableCode(variable_id=variable, code=code, value=value)
+                for variable, value, code in new.itertuples(index=False)
+            ],
+            batch_size=500
+            )
+        self.codes = pd.concat([self.codes, new], ignore_index=True)
+        self.created += len(new)
+
+    def encode(self, variable_ids, values):
+        """
+        Encode the values of the categorical variables.
+
+        Args:
+            variable_ids (ndarray): Variable id of each value.
+            values (ndarray): Values as stored in Data.value.
+
+        Returns:
+            tuple: (values, value_codes). Encoded values are replaced by ''
+                and their codes are set in value_codes, None elsewhere.
+        """
+        value_codes = np.full(len(values), None, dtype=object)
+        mask = np.isin(variable_ids, self.categorical)
+        if not mask.any():
+            return values, value_codes
+
+        df = pd.DataFrame({
+            'variable': np.asarray(variable_ids)[mask].astype(np.int64),
+            'value': np.asarray(values)[mask],
+            })
+        merged = df.merge(self.codes, on=['variable', 'value'], how='left')
+        if merged['code'].isna().any():
+            self._add_codes(
+                merged.loc[
+                    merged['code'].isna(),
+                    ['variable', 'value']
+                    ].drop_duplicates()
+                )
+            merged = df.merge(self.codes, on=['variable', 'value'], how='left')
+
+        value_codes[mask] = merged['code'].astype(np.int64).to_numpy()
+        values = np.array(values, dtype=object)
+        values[mask] = ''
+        return values, value_codes
+
+
+def decode_values(df, variable_column, code_column='value_code', value_column='value'):  # noqa E501
+    """
+    Replace, in place, the value of the encoded rows of df by the value of
+    their code. variable_column holds the variable ids.
+
+    Returns:
+        DataFrame: df without the code column.
+    """
+    codes = df[code_column]
+    mask = codes.notna().to_numpy()
+    if mask.any():
+        variable_ids = df.loc[mask, variable_column].astype(np.int64)
+        table = pd.DataFrame.from_records(
+            VariableCode.objects.filter(
+                variable_id__in=variable_ids.unique().tolist()
+                ).values_list('variable_id', 'code', 'value'),
+            columns=['variable', 'code', 'value']
+            )
+        lookup = pd.Series(
+            table['value'].to_numpy(),
+            index=pd.MultiIndex.from_arrays([
+                table['variable'].astype(np.int64),
+                table['code'].astype(np.int64)
+                ])
+            )
+        keys = pd.MultiIndex.from_arrays([
+            variable_ids.to_numpy(),
+            codes[mask].astype(np.int64).to_numpy()
+            ])
+        df[value_column] = df[value_column].astype(object)
+        df.loc[mask, value_column] = lookup.reindex(keys).to_numpy()
+    return df.drop(columns=[code_column])
@@ -0,0 +1,250 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from nhanes.workprocess import ingestion_utils
+from nhanes.utils.logs import logger, LogBuffer
+
+# status codes that are worth another attempt
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket used to cap the request rate against one host.
+
+    Tokens are refilled continuously at `rate` per second up to `capacity`.
+    acquire() blocks the calling thread until a token is available.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be greater than zero")
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.rate
+            )
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    """
+    Keeps one TokenBucket per host so every worker shares the same budget
+    when talking to wwwn.cdc.gov (or any other host).
+    """
+
+    def __init__(self, requests_per_second):
+        self.requests_per_second = requests_per_second
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.requests_per_second)
+                self.buckets[host] = bucket
+        bucket.acquire()
+
+
+def _retry_after_seconds(value):
+    """
+    Parse a Retry-After header, given either in seconds or as an HTTP date.
+    Returns None when the header is missing or invalid.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class DownloadSession:
+    """
+    HTTP session shared by all download workers of one ingestion run.
+
+    Keeps a pool of keep-alive connections per host, applies a timeout to
+    every request and retries 429/5xx answers and connection errors. The
+    wait between attempts honors Retry-After and otherwise uses exponential
+    backoff with full jitter. Counters for requests, retries, bytes and
+    connection reuse are kept for the whole run.
+    """
+
+    def __init__(
+            self,
+            pool_size=4,
+            timeout=60,
+            max_retries=5,
+            backoff_factor=1.0,
+            backoff_max=60.0,
+            ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=0,
+            )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.bytes = 0
+
+    def _backoff(self, attempt, response=None):
+        retry_after = None
+        if response is not None:
+            retry_after = _retry_after_seconds(response.headers.get('Retry-After'))
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(
+            0,
+            min(self.backoff_max, self.backoff_factor * 2 ** attempt)
+            )
+
+    def get(self, url, limiter=None, **kwargs):
+        """
+        Send a streaming GET request, retrying transient failures.
+        The last response is returned even if its status is still an error.
+        When a HostRateLimiter is given, every attempt waits for its turn.
+        """
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.wait(url)
+            try:
+                response = self.session.get(
+                    url,
+                    stream=True,
+                    allow_redirects=True,
+                    timeout=self.timeout,
+                    **kwargs
+                    )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                if response.status_code not in RETRY_STATUS or \
+                        attempt >= self.max_retries:
+                    return response
+                delay = self._backoff(attempt, response)
+                response.close()
+            with self.lock:
+                self.retries += 1
+            attempt += 1
+            time.sleep(delay)
+
+    def add_bytes(self, n_bytes):
+        with self.lock:
+            self.bytes += n_bytes
+
+    def stats(self):
+        """
+        Return the run counters. Connection figures come from the urllib3
+        pools: every request that did not open a new connection reused one.
+        """
+        n_requests = 0
+        n_connections = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                n_requests += pool.num_requests
+                n_connections += pool.num_connections
+        return {
+            'requests': n_requests,
+            'connections': n_connections,
+            'reused': max(0, n_requests - n_connections),
+            'retries': self.retries,
+            'bytes': self.bytes,
+        }
+
+    def log_stats(self, log):
+        stats = self.stats()
+        msm = (
+            f"Download session: {stats['requests']} requests, "
+            f"{stats['connections']} new connections, "
+            f"{stats['reused']} reused connections, "
+            f"{stats['retries']} retries, "
+            f"{stats['bytes'] / 1024 ** 2:.1f} MB downloaded."
+            )
+        logger(log, "i", msm)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+def _download_job(job, limiter, session, cache=None):
+    """
+    Download the XPT and HTM files of one WorkProcess job.
+
+    Runs in a worker thread, so all messages are collected in a LogBuffer and
+    written to the database later by the caller.
+    """
+    buffer = LogBuffer()
+    job['status'] = True
+    job['error'] = ''
+    v_time_start = time.time()
+
+    for extension, url, file_name in [
+        ('XPT', job['data_url'], job['data_file']),
+        ('htm', job['doc_url'], job['doc_file']),
+    ]:
+        job['extension'] = extension
+        if cache is None and os.path.exists(file_name):
+            msm = f"File {file_name} already exists. Skipping download."
+            logger(buffer, "i", msm)
+            continue
+
+        status, error = ingestion_utils.download_nhanes_file(
+            buffer,
+            url,
+            file_name,
+            session=session,
+            cache=cache,
+            limiter=limiter
+            )
+        if not status:
+            job['status'] = False
+            job['error'] = error
+            break
+
+    job['time_download'] = int(time.time() - v_time_start)
+    job['log'] = buffer
+    return job
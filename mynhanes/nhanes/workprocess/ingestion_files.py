@@ -0,0 +1,203 @@
+"""
+File outputs of the ingestion (the csv, parquet and feather load types).
+
+Each dataset is written as <name_file>_data.<format> with the rows of the XPT
+file and <name_file>_meta.<format> with its variables and code tables. Parquet
+and Feather files are zstd-compressed and keep the types of the columns:
+SEQN and sequence as int64, numeric variables as float64 and character
+variables as string. Every file written is listed in OUTPUT_MANIFEST, in the
+same folder, so the outputs of a run can be found without listing the folder.
+"""
+import json
+import os
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+FILE_FORMATS = ['csv', 'parquet', 'feather']
+FILE_COMPRESSION = "zstd"
+# rows per row group of the Parquet files
+FILE_ROW_GROUP_SIZE = 64 * 1024
+OUTPUT_MANIFEST = "manifest.json"
+
+
+def _arrow_schema(df):
+    """
+    Arrow schema of a data or metadata chunk: SEQN and sequence as int64,
+    numeric columns as float64 and the others as string.
+    """
+    import pyarrow as pa
+    fields = []
+    for col in df.columns:
+        if col in ('SEQN', 'sequence'):
+            fields.append(pa.field(col, pa.int64()))
+        elif pd.api.types.is_numeric_dtype(df[col]) \
+                and not pd.api.types.is_bool_dtype(df[col]):
+            fields.append(pa.field(col, pa.float64()))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+
+def _arrow_table(df, schema):
+    import pyarrow as pa
+    df = df.astype({
+        col: np.int64 for col in ('SEQN', 'sequence') if col in df.columns
+        })
+    # text columns keep their missing values as nulls
+    for field in schema:
+        if pa.types.is_string(field.type):
+            df[field.name] = df[field.name].astype('string')
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+class _ParquetWriter:
+    def __init__(self, path, schema):
+        import pyarrow.parquet as pq
+        self.writer = pq.ParquetWriter(
+            path,
+            schema,
+            compression=FILE_COMPRESSION,
+            write_statistics=True
+            )
+
+    def write(self, table):
+        self.writer.write_table(table, row_group_size=FILE_ROW_GROUP_SIZE)
+
+    def close(self):
+        self.writer.close()
+
+
+class _FeatherWriter:
+    # Feather v2 is the Arrow IPC file format, written batch by batch
+    def __init__(self, path, schema):
+        import pyarrow as pa
+        self.sink = pa.OSFile(str(path), 'wb')
+        self.writer = pa.ipc.new_file(
+            self.sink,
+            schema,
+            options=pa.ipc.IpcWriteOptions(compression=FILE_COMPRESSION)
+            )
+
+    def write(self, table):
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+        self.sink.close()
+
+
+def _write_arrow(chunks, path, file_format):
+    """
+    Write the chunks to path in one file. The schema is taken from the
+    first chunk.
+
+    Returns:
+        tuple: (number of rows, number of columns).
+    """
+    writer_class = _ParquetWriter if file_format == 'parquet' else _FeatherWriter  # noqa E501
+    tmp_path = path.with_name(path.name + '.tmp')
+    writer = None
+    n_rows = 0
+    n_columns = 0
+    try:
+        for chunk in chunks:
+            if writer is None:
+                schema = _arrow_schema(chunk)
+                writer = writer_class(tmp_path, schema)
+                n_columns = len(schema)
+            writer.write(_arrow_table(chunk, schema))
+            n_rows += len(chunk)
+    except Exception:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if writer is None:
+        return 0, 0
+    writer.close()
+    os.replace(tmp_path, path)
+    return n_rows, n_columns
+
+
+def _write_csv(chunks, path):
+    n_rows = 0
+    n_columns = 0
+    for n, chunk in enumerate(chunks):
+        chunk.to_csv(path, mode='a' if n else 'w', header=not n)
+        n_rows += len(chunk)
+        n_columns = len(chunk.columns)
+    return n_rows, n_columns
+
+
+def write_output_file(df, path, file_format):
+    """
+    Write a DataFrame, or an iterable of DataFrame chunks, to path.
+
+    Returns:
+        dict: The entry of the file in the output manifest.
+    """
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"Invalid file format: {file_format}.")
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+    if file_format == 'csv':
+        n_rows, n_columns = _write_csv(chunks, path)
+    else:
+        n_rows, n_columns = _write_arrow(chunks, path, file_format)
+    return {
+        'file': path.name,
+        'format': file_format,
+        'compression': None if file_format == 'csv' else FILE_COMPRESSION,
+        'rows': n_rows,
+        'columns': n_columns,
+        'bytes': os.path.getsize(path) if os.path.exists(path) else 0,
+        }
+
+
+def write_dataset_files(df, df_metadata, base_dir, name_file, file_format, cycle=None, dataset=None):  # noqa E501
+    """
+    Write the data and metadata files of a dataset and list them in the
+    output manifest of base_dir.
+
+    Returns:
+        dict: The entry of the dataset in the output manifest.
+    """
+    entry = {
+        'cycle': cycle,
+        'dataset': dataset,
+        'data': write_output_file(
+            df,
+            base_dir / f"{name_file}_data.{file_format}",
+            file_format
+            ),
+        'meta': write_output_file(
+            df_metadata,
+            base_dir / f"{name_file}_meta.{file_format}",
+            file_format
+            ),
+        'written_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),  # noqa E501
+        }
+    update_output_manifest(base_dir, name_file, entry)
+    return entry
+
+
+def read_output_manifest(base_dir):
+    """
+    Return the output manifest of base_dir: the files written by name_file.
+    """
+    path = base_dir / OUTPUT_MANIFEST
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f).get('outputs', {})
+
+
+def update_output_manifest(base_dir, name_file, entry):
+    outputs = read_output_manifest(base_dir)
+    outputs[name_file] = entry
+    path = base_dir / OUTPUT_MANIFEST
+    tmp_path = path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'outputs': dict(sorted(outputs.items()))}, f, indent=2)
+    os.replace(tmp_path, path)
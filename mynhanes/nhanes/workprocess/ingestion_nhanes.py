@@ -1,17 +1,64 @@
 import os
 import time
-from time import sleep
-import numpy as np
+from contextlib import nullcontext
 import pandas as pd
 from pathlib import Path
 from django.conf import settings
-from nhanes.models import WorkProcessNhanes # noqa E501
-from nhanes.workprocess import ingestion_utils
+from nhanes.models import WorkProcessNhanes, DataManifest # noqa E501
+from nhanes.workprocess import (
+    ingestion_utils,
+    ingestion_download,
+    ingestion_bulk,
+    ingestion_pipeline
+    )
+from nhanes.workprocess.ingestion_files import FILE_FORMATS, write_dataset_files
+from nhanes.workprocess.data_storage import (
+    bump_data_generation,
+    get_data_storage
+    )
+from nhanes.workprocess.ingestion_cache import CodebookCache, DownloadCache
 from nhanes.utils.logs import logger, start_logger
-from core.parameters import config
+from core.parameters import config, get_parameter
+
+# jobs waiting between two stages of the pipeline, per download worker
+PIPELINE_QUEUE_FACTOR = 2
 
 
-def ingestion_nhanes(load_type=str('db')):
+def _get_workprocess_files(qry_workprocess, cache):
+    """
+    Build the file names and URLs of the XPT and HTM files of a WorkProcess.
+    The files live in the download cache, keyed by their URLs.
+    """
+    # set file names
+    dataset = qry_workprocess.dataset.dataset
+    if qry_workprocess.cycle.year_code == '':
+        name_file = f"{dataset}"
+    elif qry_workprocess.cycle.year_code is not None:
+        name_file = f"{dataset}_{qry_workprocess.cycle.year_code}"
+    else:
+        name_file = f"{dataset}"
+
+    if qry_workprocess.datasetcycle.has_special_year_code:
+        if qry_workprocess.datasetcycle.special_year_code is not None:
+            name_file = f"{dataset}_{qry_workprocess.datasetcycle.special_year_code}"  # noqa E501
+        else:
+            name_file = f"{dataset}"
+
+    # set URLs
+    data_url = qry_workprocess.cycle.get_dataset_url(f"{name_file}.XPT")
+    doc_url = data_url.replace('XPT', 'htm')
+
+    return {
+        'workprocess': qry_workprocess,
+        'name_file': name_file,
+        'data_file': cache.path(data_url),
+        'doc_file': cache.path(doc_url),
+        'data_url': data_url,
+        'doc_url': doc_url,
+    }
+
+
+def ingestion_nhanes(load_type=str('db'), bulk=False):
 
     # start Log monitor
     log_file = __name__
@@ -20,8 +67,8 @@ def ingestion_nhanes(load_type=str('db')):
     logger(log, "s", "Started WorkProcess to Ingestion NHANES Data")
 
     # check if load_type is valid
-    if load_type not in ['db', 'csv', 'both']:
-        msm = "Invalid load type. Please choose 'db', 'csv', or 'both'."
+    if load_type not in ['db', 'both'] + FILE_FORMATS:
+        msm = "Invalid load type. Please choose 'db', 'csv', 'parquet', 'feather' or 'both'."  # noqa E501
         logger(log, "e", msm)
         return False
 
@@ -48,9 +95,25 @@ def ingestion_nhanes(load_type=str('db')):
         logger(log, "e", msm)
         return False    # Can be changed to return False
 
-    # filter workprocess in queue to ingestion
+    # storage of the data: Data table or Parquet files
+    try:
+        storage = get_data_storage()
+    except ValueError as e:
+        logger(log, "e", str(e))
+        return False
+
+    # rebuild the Data indexes left dropped by an interrupted bulk load
+    bulk_state_file = download_path / ingestion_bulk.BULK_STATE_FILE
+    ingestion_bulk.recover_data_indexes(log, bulk_state_file)
+    if bulk and load_type != 'db':
+        msm = "Bulk mode only applies to the db load type. Ignoring it."
+        logger(log, "w", msm)
+        bulk = False
+
+    # filter workprocess in queue to ingestion; 'delta' re-ingests a loaded
+    # dataset writing only the rows that changed
     qs_workprocess = WorkProcessNhanes.objects.filter(
-        status='pending',
+        status__in=['pending', 'delta'],
         is_download=True
     )
     if not qs_workprocess.exists():
@@ -58,190 +121,345 @@ def ingestion_nhanes(load_type=str('db')):
         logger(log, "i", msm)
         return False
 
-    # Process NHANES ingestion by Cycle and Dataset
-    for qry_workprocess in qs_workprocess:
+    # download settings
+    download_workers = int(get_parameter('workprocess', 'download_workers', 4))
+    download_rate = float(get_parameter('workprocess', 'download_rate', 2))
+    session = ingestion_download.DownloadSession(
+        pool_size=download_workers,
+        timeout=float(get_parameter('workprocess', 'download_timeout', 60)),
+        max_retries=int(get_parameter('workprocess', 'download_retries', 5)),
+        backoff_factor=float(get_parameter('workprocess', 'download_backoff', 1)),
+        )
+
+    # setting folder to hosting output files
+    base_dir = download_path / "downloads"
+    os.makedirs(base_dir, exist_ok=True)
+
+    # rows per chunk when reading XPT files, 0 to read the whole file at once
+    chunk_size = int(get_parameter('workprocess', 'xpt_chunk_size', 0))
+
+    # downloaded files are kept in a persistent cache and revalidated with
+    # the server instead of being downloaded again on every ingestion
+    cache_size = float(get_parameter('workprocess', 'download_cache_size', 0))
+    cache = DownloadCache(
+        download_path / "cache",
+        max_size=int(cache_size * 1024 ** 3) or None
+        )
+    codebook_cache = CodebookCache(download_path / "codebooks")
+
+    # files are downloaded, parsed and loaded in a pipeline: the next
+    # datasets are downloaded and parsed while the current one is loaded
+    parse_workers = int(get_parameter('workprocess', 'parse_workers', 2))
+    jobs = [
+        _get_workprocess_files(qry_workprocess, cache)
+        for qry_workprocess in qs_workprocess.select_related(
+            'cycle',
+            'dataset',
+            'datasetcycle'
+            )
+    ]
+
+    def make_task(job):
+        return _get_parse_task(job, cache, codebook_cache, chunk_size)
+
+    def write(job, parsed):
+        _ingest_workprocess(
+            log,
+            job,
+            parsed,
+            load_type,
+            load_metadata,
+            cache,
+            base_dir,
+            chunk_size=chunk_size,
+            codebook_cache=codebook_cache,
+            storage=storage,
+            )
 
-        v_time_start_dataset = time.time()
+    # in bulk mode the Data indexes are dropped during the whole load and
+    # rebuilt once at the end
+    bulk_context = ingestion_bulk.bulk_load(log, bulk_state_file) \
+        if bulk else nullcontext()
+    try:
+        with bulk_context:
+            ingestion_pipeline.run_ingestion_pipeline(
+                log,
+                jobs,
+                make_task,
+                write,
+                download_workers=download_workers,
+                requests_per_second=download_rate,
+                session=session,
+                cache=cache,
+                parse_workers=parse_workers,
+                queue_size=download_workers * PIPELINE_QUEUE_FACTOR,
+                )
+    finally:
+        session.log_stats(log)
+        session.close()
+
+    total_time = int(time.time() - v_time_start_process)
+    logger(
+        log,
+        "s",
+        f"The Master Data was imported in {total_time} seconds."
+    )
+    return True
 
-        msm = f"Starting ingestion for {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset}." # noqa E501
+
+def _get_parse_task(job, cache, codebook_cache, chunk_size):
+    """
+    Build the task sent to the parse stage for a downloaded job. The
+    codebook is looked up in the codebook cache here, so unchanged HTM files
+    are not sent to be parsed.
+    """
+    qry_workprocess = job['workprocess']
+    dataset = qry_workprocess.dataset.dataset
+    data_entry = cache.get(job['data_url'])
+    doc_entry = cache.get(job['doc_url'])
+
+    job['codebook'] = None
+    if codebook_cache is not None and doc_entry is not None:
+        job['codebook'] = codebook_cache.get(doc_entry['sha256'], dataset)
+
+    return {
+        'name_file': job['name_file'],
+        'dataset': dataset,
+        'data_file': str(job['data_file']),
+        'doc_file': str(job['doc_file']),
+        'data_url': job['data_url'],
+        'doc_url': job['doc_url'],
+        'data_sha256': data_entry['sha256'] if data_entry else None,
+        'doc_sha256': doc_entry['sha256'] if doc_entry else None,
+        # the encoding is detected once per dataset cycle and kept
+        'encoding': qry_workprocess.datasetcycle.file_encoding,
+        'chunk_size': chunk_size,
+        'parse_codebook': job['codebook'] is None,
+    }
+
+
+def _ingest_workprocess(
+        log,
+        job,
+        parsed,
+        load_type,
+        load_metadata,
+        cache,
+        base_dir,
+        chunk_size=0,
+        codebook_cache=None,
+        storage=None,
+        ):
+    """
+    Load one WorkProcess from the output of its parse stage. This is the
+    writer of the pipeline: the only step that touches the database.
+    """
+    qry_workprocess = job['workprocess']
+    dataset = qry_workprocess.dataset.dataset
+    name_file = job['name_file']
+    if storage is None:
+        storage = get_data_storage()
+    data_file = job['data_file']
+    doc_file = job['doc_file']
+    url = job['doc_url']
+
+    v_time_start_dataset = time.time()
+    time_dataset = 0
+
+    msm = f"Starting ingestion for {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset}." # noqa E501
+    logger(log, "i", msm)
+
+    if not job['status']:
+        qry_workprocess.status = job['error']
+        qry_workprocess.save()
+        msm = f"No file to {name_file}.{job['extension']}"
         logger(log, "i", msm)
+        return False
 
-        # set file names
-        dataset = qry_workprocess.dataset.dataset
-        if qry_workprocess.cycle.year_code == '':
-            name_file = f"{dataset}"
-        elif qry_workprocess.cycle.year_code is not None:
-            name_file = f"{dataset}_{qry_workprocess.cycle.year_code}"
-        else:
-            name_file = f"{dataset}"
+    qry_workprocess.time_download = job['time_download']
 
-        if qry_workprocess.datasetcycle.has_special_year_code:
-            if qry_workprocess.datasetcycle.special_year_code is not None:
-                name_file = f"{dataset}_{qry_workprocess.datasetcycle.special_year_code}"  # noqa E501
-            else:
-                name_file = f"{dataset}"
-
-        # setting folder to hosting download files
-        base_dir = download_path / "downloads"  # str(qry_workprocess.cycle.base_dir)
-        os.makedirs(base_dir, exist_ok=True)
-
-        data_file = base_dir / f"{name_file}.XPT"
-        doc_file = base_dir / f"{name_file}.htm"
-
-        # set URLs
-        data_url = qry_workprocess.cycle.get_dataset_url(f"{name_file}.XPT")
-        doc_url = data_url.replace('XPT', 'htm')
-
-        # start download files
-        file_types = {
-            'XPT': 'XPT',
-            'htm': 'htm'
-        }
-        for file_type, extension in file_types.items():
-            # set file type and url
-            if file_type == 'XPT':
-                file_name = data_file
-                url = data_url
-            else:
-                file_name = doc_file
-                url = doc_url
-            sleep(np.random.rand())  # avoit 429 error / too many requests
-            if not os.path.exists(file_name):
-                status, error = ingestion_utils.download_nhanes_file(
-                    log,
-                    url,
-                    file_name
-                    )
-                if status:
-                    msm = f"The {name_file}.{extension} file was downloaded."
-                    logger(log, "s", msm)
-                else:
-                    break
-            else:
-                status = True
-                msm = f"File {file_name}.{extension} already exists. Skipping download."
-                logger(log, "i", msm)
+    if not parsed['status']:
+        # drop the cached copy so the next run downloads it again
+        if parsed['error_url']:
+            cache.remove(parsed['error_url'])
+        qry_workprocess.status = 'error'
+        qry_workprocess.save()
+        return False
 
-        if not status:
-            qry_workprocess.status = error
-            qry_workprocess.save()
-            msm = f"No file to {name_file}.{extension}"
-            logger(log, "i", msm)
-            continue
-
-        # get data from XPT file
-        try:
-            df, meta_df = ingestion_utils.get_data_from_xpt(log, data_file)
-        except Exception as e:
-            try:
-                os.remove(data_file)
-                os.remove(doc_file)
-            except OSError as f:
-                msm = f"Error deleting file: {f}"
-                logger(log, "e", msm)
-            msm = f"Error reading XPT file: {e}"
-            logger(log, "e", msm)
-            qry_workprocess.status = 'error'
-            qry_workprocess.save()
-            continue
+    encoding = parsed['encoding']
+    datasetcycle = qry_workprocess.datasetcycle
+    if parsed['detected']:
+        datasetcycle.file_encoding = encoding
+        datasetcycle.save(update_fields=['file_encoding'])
+    else:
+        msm = f"Using the known encoding {encoding} for {name_file}. Encoding detection skipped." # noqa E501
+        logger(log, "i", msm)
+
+    # in streaming mode the rows are read chunk by chunk while they are saved
+    ingestion_utils.reset_peak_rss()
+    meta_df = parsed['meta_df']
+    if chunk_size:
+        df = ingestion_utils.XptChunkReader(
+            log,
+            data_file,
+            chunk_size,
+            encoding
+            )
+    else:
+        df = parsed['df']
+
+    # get data from HTM file; codebooks already parsed are taken from the
+    # codebook cache by the content hash of the HTM file
+    codebook = job['codebook']
+    if codebook is None:
+        codebook = parsed['codebook']
+        doc_entry = cache.get(job['doc_url'])
+        if codebook_cache is not None and doc_entry is not None \
+                and not codebook[0].empty:
+            codebook_cache.store(doc_entry['sha256'], dataset, *codebook)
+    else:
+        msm = f"Codebook of {name_file} unchanged. HTML parsing skipped."
+        logger(log, "i", msm)
+    variable_df, json_tables = ingestion_utils.get_data_from_htm(
+        log,
+        dataset,
+        doc_file,
+        meta_df,
+        codebook=codebook
+        )
+    if variable_df is None or json_tables is None:
+        msm = f"Error reading htm file: {doc_file}"
+        logger(log, "e", msm)
+        qry_workprocess.status = 'error'
+        qry_workprocess.save()
+        return False
+
+    # Normalization of the variable names
+    df_metadata = pd.merge(
+        variable_df,
+        meta_df[['Variable', 'Type']],
+        left_on='VariableName',
+        right_on='Variable',
+        how='left'
+    )
+
+    # Create a column in 'combined_df' for the code table
+    df_metadata['CodeTables'] = df_metadata['VariableName'].map(json_tables)
+
+    if load_type in ['both'] + FILE_FORMATS:
+        # Save the data and metadata in files (csv, parquet or feather)
+        file_format = 'csv' if load_type == 'both' else load_type
+        entry = write_dataset_files(
+            df,
+            df_metadata,
+            base_dir,
+            name_file,
+            file_format,
+            cycle=qry_workprocess.cycle.cycle,
+            dataset=dataset
+            )
+        msm = f"Saved files: {base_dir / entry['data']['file']} and {base_dir / entry['meta']['file']}"  # noqa E501
+        logger(log, "s", msm)
 
-        # get data from HTM file
-        variable_df, code_table = ingestion_utils.get_data_from_htm(dataset, doc_file, meta_df)
-        if variable_df is None or code_table is None:
-            msm = f"Error reading htm file: {doc_file}"
+    elif load_type in ['db', 'both']:
+        # Salve the NHANES metadata in the database
+        check_return = ingestion_utils.process_and_save_metadata(
+            log,
+            df_metadata,
+            dataset_id=qry_workprocess.dataset.id,
+            cycle_id=qry_workprocess.cycle.id,
+            load_metadata=load_metadata,
+            dataset_cycle_url=url,
+            dataset_cycle_description=""  # TODO: Extract JSON from HTML (_parse_nhanes_html_docfile) # noqa E501
+            )
+        if not check_return:
+            msm = f"Error on save metadata in database to {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset}." # noqa E501
             logger(log, "e", msm)
             qry_workprocess.status = 'error'
             qry_workprocess.save()
-            continue
-
-        # Normalization of the variable names
-        df_metadata = pd.merge(
-            variable_df,
-            meta_df[['Variable', 'Type']],
-            left_on='VariableName',
-            right_on='Variable',
-            how='left'
-        )
+            return False
+
+        save_data = config['workprocess']['save_data']
+        if save_data is None:
+            save_data = True
+
+        # the content hash of the XPT file identifies the source version
+        entry = cache.get(job['data_url'])
+        source_hash = entry['sha256'] if entry is not None else ""
 
-        # Converter code_table to JSON
-        json_tables = {
-            key: value.to_json(orient='records') for key, value in code_table.items()
-        }
-
-        # Create a column in 'combined_df' for the code table
-        df_metadata['CodeTables'] = df_metadata['VariableName'].map(json_tables)
-
-        if load_type in ['csv', 'both']:
-            # Save the metadata in CSV or DB
-            csv_file_path = str(data_file).replace('.XPT', '_data.csv')
-            df.to_csv(csv_file_path)
-            doc_file_path = str(doc_file).replace('.htm', '_meta.csv')
-            df_metadata.to_csv(doc_file_path)
-            msm = f"Saved files: {csv_file_path} and {doc_file_path}"
-            logger(log, "s", msm)
-
-        elif load_type in ['db', 'both']:
-            # Salve the NHANES metadata in the database
-            check_return = ingestion_utils.process_and_save_metadata(
+        # sparse mode does not store the missing values and encoded mode
+        # stores the values of categorical variables as codes
+        sparse = str(
+            get_parameter('workprocess', 'sparse_data', False)
+            ).lower() == 'true'
+        encoded = str(
+            get_parameter('workprocess', 'encoded_data', False)
+            ).lower() == 'true'
+
+        # Salve the NHANES data in the storage set in the parameters
+        if qry_workprocess.status == 'delta' and save_data:
+            changes = storage.apply_delta(
                 log,
-                df_metadata,
-                dataset_id=qry_workprocess.dataset.id,
+                df,
                 cycle_id=qry_workprocess.cycle.id,
-                load_metadata=load_metadata,
-                dataset_cycle_url=url,
-                dataset_cycle_description=""  # TODO: Extract JSON from HTML (_parse_nhanes_html_docfile) # noqa E501
+                dataset_id=qry_workprocess.dataset.id,
+                source_hash=source_hash,
+                sparse=sparse,
+                encoded=encoded
                 )
-            if not check_return:
-                msm = f"Error on save metadata in database to {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset}." # noqa E501
-                logger(log, "e", msm)
-                qry_workprocess.status = 'error'
-                qry_workprocess.save()
-                continue
-
-            save_data = config['workprocess']['save_data']
-            if save_data is None:
-                save_data = True
-
-            # Salve the NHANES data in the database
-            check_return = ingestion_utils.save_nhanes_data(
+            check_return = changes is not None
+            if check_return:
+                qry_workprocess.delta_inserted = changes['inserted']
+                qry_workprocess.delta_updated = changes['updated']
+                qry_workprocess.delta_deleted = changes['deleted']
+        else:
+            check_return = storage.save(
                 log,
                 df,
                 cycle_id=qry_workprocess.cycle.id,
                 dataset_id=qry_workprocess.dataset.id,
-                save_data=save_data
+                save_data=save_data,
+                source_hash=source_hash,
+                sparse=sparse,
+                encoded=encoded
                 )
-            if not check_return:
-                msm = f"Error on save data in database to {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset}." # noqa E501
-                logger(log, "e", msm)
-                qry_workprocess.status = 'error'
-                qry_workprocess.save()
-                continue
-
-            # Update the WorkProcess table
-            time_dataset = int(time.time() - v_time_start_dataset)
-            qry_workprocess.source_file_version = "v.0"  # FIX: version
-            qry_workprocess.source_file_size = os.path.getsize(data_file)
-            qry_workprocess.time = time_dataset
-            qry_workprocess.status = 'complete'
-            qry_workprocess.records = df.shape[0]
-            qry_workprocess.n_samples = df.shape[0]
-            qry_workprocess.save()
-
-        # Clean up downloaded files
-        try:
-            os.remove(data_file)
-            os.remove(doc_file)
-        except OSError as e:
-            msm = f"Error deleting file: {e}"
+        if not check_return:
+            msm = f"Error on save data in database to {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset}." # noqa E501
             logger(log, "e", msm)
+            qry_workprocess.status = 'error'
+            qry_workprocess.save()
+            return False
+        # the query results cached before this load (data or metadata) are
+        # stale
+        bump_data_generation()
 
-        msm = f"Finished ingestion for {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset} in {time_dataset} seconds." # noqa E501
-        logger(log, "s", msm)
+        # Update the WorkProcess table
+        time_dataset = int(time.time() - v_time_start_dataset)
+        if source_hash:
+            qry_workprocess.source_file_version = source_hash
+        qry_workprocess.source_file_size = os.path.getsize(data_file)
+        qry_workprocess.time = time_dataset
+        qry_workprocess.status = 'complete'
+        n_rows = df.shape[0] if isinstance(df, pd.DataFrame) else df.rows
+        qry_workprocess.records = n_rows
+        qry_workprocess.n_samples = n_rows
+        manifest = DataManifest.objects.filter(
+            cycle=qry_workprocess.cycle,
+            dataset=qry_workprocess.dataset,
+            rule__isnull=True
+            ).first()
+        if manifest is not None:
+            qry_workprocess.sparse_skipped_rows = manifest.skipped_rows
+            qry_workprocess.sparse_saved_bytes = manifest.skipped_bytes
+            if manifest.skipped_rows:
+                msm = f"Sparse mode for {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset}: {manifest.skipped_rows} missing values not stored ({manifest.skipped_rows / (manifest.rows + manifest.skipped_rows):.0%} of the rows, about {manifest.skipped_bytes / 1024 ** 2:.1f} MB)."  # noqa E501
+                logger(log, "i", msm)
+        qry_workprocess.save()
 
-    total_time = int(time.time() - v_time_start_process)
-    logger(
-        log,
-        "s",
-        f"The Master Data was imported in {total_time} seconds."
-    )
+    msm = f"Finished ingestion for {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset} in {time_dataset} seconds." # noqa E501
+    logger(log, "s", msm)
+    peak_rss = ingestion_utils.peak_rss_mb()
+    if peak_rss is not None and parsed['peak_rss'] is not None:
+        msm = f"Peak memory (RSS) for {qry_workprocess.cycle.cycle} - {qry_workprocess.dataset.dataset}: parse {parsed['peak_rss']:.0f} MB, load {peak_rss:.0f} MB." # noqa E501
+        logger(log, "i", msm)
     return True
@@ -0,0 +1,346 @@
+"""
+Staged ingestion pipeline: download -> parse -> write.
+
+Downloads run in a pool of threads, the XPT and HTM files are parsed in a
+pool of processes and one writer, the calling thread, owns the database
+connection. The stages are connected by bounded queues, so the next files
+are downloaded and parsed while the current dataset is being loaded, and
+each stage reports how busy it was at the end of the run.
+
+The parse pool uses the 'spawn' start method; the worker processes import
+this module before Django is configured, hence the setup below.
+"""
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor  # noqa E501
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    django.setup()
+
+from nhanes.utils.logs import logger, LogBuffer  # noqa: E402
+from nhanes.workprocess import ingestion_download, ingestion_utils  # noqa: E402,E501
+from nhanes.workprocess.ingestion_cache import file_sha256  # noqa: E402
+
+# marks the end of the jobs in a queue
+_END = object()
+
+
+class StageStats:
+    """
+    Busy time of one pipeline stage, shared by its workers.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.items += 1
+            self.busy += seconds
+
+    def utilization(self, elapsed):
+        if not elapsed:
+            return 0.0
+        return min(1.0, self.busy / (elapsed * self.workers))
+
+    def log(self, log, elapsed):
+        msm = f"Pipeline stage {self.name}: {self.items} jobs, busy {self.utilization(elapsed):.0%} of {elapsed:.0f}s with {self.workers} worker(s)."  # noqa E501
+        logger(log, "i", msm)
+
+
+def parse_workprocess_files(task):
+    """
+    Parse stage of one WorkProcess. Runs in a worker process, so it must not
+    touch the database: messages are returned in a LogBuffer.
+
+    Args:
+        task (dict): name_file, dataset, data_file, doc_file, data_sha256,
+            doc_sha256, encoding, chunk_size and parse_codebook.
+
+    Returns:
+        dict: status, error_url (the cached file to drop on failure),
+            encoding, detected, df, meta_df, codebook, peak_rss, busy and
+            log.
+    """
+    v_time_start = time.perf_counter()
+    buffer = LogBuffer()
+    ingestion_utils.reset_peak_rss()
+    result = {
+        'status': True,
+        'error_url': None,
+        'encoding': task['encoding'],
+        'detected': False,
+        'df': None,
+        'meta_df': None,
+        'codebook': None,
+        'log': buffer,
+    }
+
+    try:
+        # check the cached files before they are handed to the parser
+        for file_key, url_key, hash_key in [
+            ('data_file', 'data_url', 'data_sha256'),
+            ('doc_file', 'doc_url', 'doc_sha256'),
+        ]:
+            if file_sha256(task[file_key]) != task[hash_key]:
+                result['status'] = False
+                result['error_url'] = task[url_key]
+                msm = f"Checksum verification failed for {task[url_key]}. The file will be downloaded again."  # noqa E501
+                logger(buffer, "e", msm)
+                return result
+
+        # get data from XPT file; in streaming mode only the metadata is
+        # read here and the rows are read by the writer while they are saved
+        try:
+            if not result['encoding']:
+                result['encoding'], _ = ingestion_utils.detect_xpt_encoding(
+                    buffer,
+                    task['data_file']
+                    )
+                result['detected'] = True
+            if task['chunk_size']:
+                result['meta_df'] = ingestion_utils.get_metadata_from_xpt(
+                    buffer,
+                    task['data_file'],
+                    result['encoding']
+                    )
+            else:
+                result['df'], result['meta_df'] = \
+                    ingestion_utils.get_data_from_xpt(
+                        buffer,
+                        task['data_file'],
+                        result['encoding']
+                        )
+        except Exception as e:
+            result['status'] = False
+            result['error_url'] = task['data_url']
+            msm = f"Error reading XPT file: {e}"
+            logger(buffer, "e", msm)
+            return result
+
+        try:
+            if task['parse_codebook']:
+                result['codebook'] = ingestion_utils.parse_htm_codebook(
+                    buffer,
+                    task['dataset'],
+                    task['doc_file']
+                    )
+        except Exception as e:
+            result['status'] = False
+            result['error_url'] = task['doc_url']
+            msm = f"Error reading htm file: {e}"
+            logger(buffer, "e", msm)
+        return result
+    finally:
+        result['peak_rss'] = ingestion_utils.peak_rss_mb()
+        result['busy'] = time.perf_counter() - v_time_start
+
+
+def _failed_result(job, error):
+    """
+    Parse result of a job whose parse task could not be built or run (e.g. a
+    broken process pool), so only its WorkProcess is marked as error.
+    """
+    buffer = LogBuffer()
+    msm = f"Error parsing the files of {job['name_file']}: {error!r}"
+    logger(buffer, "e", msm)
+    return {
+        'status': False,
+        'error_url': None,
+        'busy': 0.0,
+        'log': buffer,
+    }
+
+
+def _put(target, item, stop):
+    # bounded put that gives up when the pipeline is stopped
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(source, stop):
+    while not stop.is_set():
+        try:
+            return source.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def run_ingestion_pipeline(
+        log,
+        jobs,
+        make_task,
+        write,
+        download_workers=4,
+        requests_per_second=2.0,
+        session=None,
+        cache=None,
+        parse_workers=2,
+        queue_size=4,
+        ):
+    """
+    Download, parse and write the jobs through the pipeline.
+
+    Args:
+        log (logger): Logger object to log messages.
+        jobs (list): Dicts with the keys name_file, data_url, data_file,
+            doc_url and doc_file.
+        make_task (callable): make_task(job) returns the parse task of a
+            downloaded job, or None when there is nothing to parse.
+        write (callable): write(job, parsed) loads one job. Called in the
+            calling thread only, with parsed None for failed downloads.
+        download_workers (int): Number of download threads.
+        requests_per_second (float): Request budget per host shared by all
+            download threads; 0 or less downloads without a rate limit.
+        session (DownloadSession): Session shared by the download threads.
+        cache (DownloadCache): Download cache. Files of jobs still in the
+            pipeline are never evicted.
+        parse_workers (int): Number of parse processes; 0 parses in a thread
+            of this process.
+        queue_size (int): Bound of the queues between the stages.
+
+    Returns:
+        dict: StageStats of each stage and the elapsed time.
+    """
+    limiter = ingestion_download.HostRateLimiter(requests_per_second) \
+        if requests_per_second > 0 else None
+    stop = threading.Event()
+    downloaded = queue.Queue(maxsize=queue_size)
+    parsed = queue.Queue(maxsize=queue_size)
+    pending = queue.Queue()
+    for job in jobs:
+        pending.put(job)
+
+    n_download = max(1, int(download_workers))
+    stats = {
+        'download': StageStats('download', n_download),
+        'parse': StageStats('parse', max(1, int(parse_workers))),
+        'write': StageStats('write', 1),
+    }
+    in_flight = set()
+    in_flight_lock = threading.Lock()
+    n_running = [n_download]
+    n_running_lock = threading.Lock()
+
+    def download_worker():
+        try:
+            while not stop.is_set():
+                try:
+                    job = pending.get_nowait()
+                except queue.Empty:
+                    break
+                with in_flight_lock:
+                    in_flight.update((job['data_url'], job['doc_url']))
+                v_time_start = time.perf_counter()
+                job = ingestion_download._download_job(
+                    job,
+                    limiter,
+                    session,
+                    cache
+                    )
+                stats['download'].add(time.perf_counter() - v_time_start)
+                if not _put(downloaded, job, stop):
+                    break
+        finally:
+            with n_running_lock:
+                n_running[0] -= 1
+                last = n_running[0] == 0
+            if last:
+                _put(downloaded, _END, stop)
+
+    if parse_workers:
+        executor = ProcessPoolExecutor(
+            max_workers=int(parse_workers),
+            mp_context=multiprocessing.get_context('spawn')
+            )
+    else:
+        executor = ThreadPoolExecutor(max_workers=1)
+
+    def parse_dispatcher():
+        # parse results are consumed in the order the jobs are dispatched,
+        # so the bound of the parsed queue also caps the work in progress
+        try:
+            while True:
+                job = _get(downloaded, stop)
+                if job is _END:
+                    return
+                try:
+                    task = make_task(job) if job['status'] else None
+                    future = executor.submit(parse_workprocess_files, task) \
+                        if task is not None else None
+                except Exception as e:
+                    # the writer marks this job as failed
+                    future = Future()
+                    future.set_exception(e)
+                if not _put(parsed, (job, future), stop):
+                    return
+        except BaseException as e:
+            # handed to the writer, which raises it in the calling thread
+            _put(parsed, e, stop)
+        finally:
+            _put(parsed, _END, stop)
+
+    threads = [
+        threading.Thread(target=download_worker, daemon=True)
+        for _ in range(n_download)
+    ] + [threading.Thread(target=parse_dispatcher, daemon=True)]
+
+    v_time_start = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        while True:
+            item = _get(parsed, stop)
+            if item is _END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            job, future = item
+            try:
+                result = future.result() if future is not None else None
+            except Exception as e:
+                result = _failed_result(job, e)
+            if result is not None:
+                stats['parse'].add(result['busy'])
+
+            v_time_write = time.perf_counter()
+            job.pop('log').flush(log)
+            if result is not None:
+                result.pop('log').flush(log)
+            write(job, result)
+            stats['write'].add(time.perf_counter() - v_time_write)
+
+            with in_flight_lock:
+                in_flight.difference_update((job['data_url'], job['doc_url']))
+                keep = list(in_flight)
+            if cache is not None:
+                removed = cache.evict(keep=keep)
+                if removed:
+                    msm = f"Removed {removed} files from the download cache."  # noqa E501
+                    logger(log, "i", msm)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    elapsed = time.perf_counter() - v_time_start
+    for stage in stats.values():
+        stage.log(log, elapsed)
+    stats['elapsed'] = elapsed
+    return stats
@@ -1,11 +1,21 @@
-import requests
+import hashlib
+import json
+import os
+import re
+import sys
+import time
 from io import StringIO
 import string
+from itertools import islice, repeat
+import requests
+import numpy as np
 import pandas as pd
 import pyreadstat
+import lxml.html
+from pandas.io.parsers import TextParser
 from bs4 import BeautifulSoup
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import transaction, IntegrityError
+from django.db import connection, transaction, IntegrityError
 from nhanes.models import (
     Version,
     Variable,
@@ -13,20 +23,84 @@ from nhanes.models import (
     Dataset,
     Cycle,
     DatasetCycle,
-    Data
+    Data,
+    DataManifest
     )
 from nhanes.utils.logs import logger
+from nhanes.workprocess.ingestion_codes import (
+    ValueEncoder,
+    categorical_variables,
+    decode_values
+    )
 
 
 class EmptySectionError(Exception):
     pass
 
 
-def _read_xpt_with_multiple_encodings(log, file_path):
-    encodings = ['utf-8', 'latin1', 'ISO-8859-1', 'utf-16']
+# encodings tried, in order, when reading XPT files
+XPT_ENCODINGS = ['utf-8', 'latin1', 'ISO-8859-1', 'utf-16']
+
+
+def _pyreadstat_encoding(encoding):
+    # pyreadstat only decodes UTF-8 strictly when no encoding is given; via
+    # iconv ('utf-8') invalid bytes are dropped silently instead of raising
+    if encoding and encoding.lower().replace('-', '') == 'utf8':
+        return None
+    return encoding
+
+
+def detect_xpt_encoding(log, file_path):
+    """
+    Settle the encoding of an XPT file without parsing it completely.
+
+    The metadata is read first (no rows). If the file has no character
+    columns any encoding that decodes the labels will do. Otherwise only the
+    character columns are scanned with each candidate encoding, which is far
+    cheaper than a full parse of the file.
+
+    Returns:
+        tuple: The encoding and the number of full parses avoided compared
+            with trying each encoding on the whole file.
+    """
+    for n, encoding in enumerate(XPT_ENCODINGS):
+        try:
+            _, meta = pyreadstat.read_xport(
+                file_path,
+                metadataonly=True,
+                encoding=_pyreadstat_encoding(encoding)
+                )
+            char_columns = [
+                name for name, var_type in meta.readstat_variable_types.items()
+                if var_type == 'string'
+            ]
+            if char_columns:
+                pyreadstat.read_xport(
+                    file_path,
+                    usecols=char_columns,
+                    encoding=_pyreadstat_encoding(encoding)
+                    )
+        except UnicodeDecodeError as e:
+            msm = f"UnicodeDecodeError with encoding {encoding}: {e}"
+            logger(log, "w", msm)
+            continue
+        msm = f"Encoding {encoding} settled from {'character columns' if char_columns else 'metadata'}; {n} full parses avoided."  # noqa E501
+        logger(log, "i", msm)
+        return encoding, n
+    raise ValueError("Failed to read XPT file with all attempted encodings")
+
+
+def _read_xpt_with_multiple_encodings(log, file_path, encoding=None):
+    encodings = XPT_ENCODINGS
+    if encoding:
+        # try the known encoding first and keep the others as fallback
+        encodings = [encoding] + [e for e in XPT_ENCODINGS if e != encoding]
     for encoding in encodings:
         try:
-            df, meta = pyreadstat.read_xport(file_path, encoding=encoding)
+            df, meta = pyreadstat.read_xport(
+                file_path,
+                encoding=_pyreadstat_encoding(encoding)
+                )
             msm = f"File read successfully with encoding: {encoding}"
             logger(log, "i", msm)
             return df, meta
@@ -43,13 +117,43 @@ def _read_xpt_with_multiple_encodings(log, file_path):
     raise ValueError("Failed to read XPT file with all attempted encodings")
 
 
-def get_data_from_xpt(log, datafile):
+def _get_metadata_frame(meta):
+    """
+    Convert the pyreadstat metadata container into a DataFrame with the
+    columns Variable, Type and Labels.
+    """
+    # list to store metadata of all variables
+    all_metadata = []
+
+    # iterate over all variables
+    for var_name in meta.column_names:
+        # get specific metadata for each variable
+        variable_labels = meta.column_names_to_labels.get(var_name, "")
+        variable_measurements = meta.readstat_variable_types.get(
+            var_name,
+            None
+            )
+        # create a dictionary with relevant metadata
+        metadata_dict = {
+            'Variable': var_name,
+            'Type': variable_measurements,
+            'Labels': variable_labels,
+        }
+        all_metadata.append(metadata_dict)
+
+    # convert the list of dictionaries into a DataFrame
+    return pd.DataFrame(all_metadata)
+
+
+def get_data_from_xpt(log, datafile, encoding=None):
     """
     Attempts to read the XPT file and extract the data and metadata.
     If the reading fails, logs the error and returns None.
     Args:
         log (logger): Logger object to log messages.
         datafile (str): Path to the XPT data file.
+        encoding (str): Encoding of the file, if already known. The other
+            encodings are still tried if it fails.
 
     Returns:
         tuple: A tuple containing the DataFrame of the data and a
@@ -57,7 +161,7 @@ def get_data_from_xpt(log, datafile):
     """
     try:
         # df, meta = pyreadstat.read_xport(datafile)
-        df, meta = _read_xpt_with_multiple_encodings(log, datafile)
+        df, meta = _read_xpt_with_multiple_encodings(log, datafile, encoding)
     except Exception as e:
         msm = f"Error reading XPT file: {e}"
         logger(log, "e", msm)
@@ -75,29 +179,131 @@ def get_data_from_xpt(log, datafile):
 
     # add a sequence number for each SEQN
     df['sequence'] = df.groupby('SEQN').cumcount()
-    # list to store metadata of all variables
-    all_metadata = []
 
-    # iterate over all variables
-    for var_name in meta.column_names:
-        # get specific metadata for each variable
-        variable_labels = meta.column_names_to_labels.get(var_name, "")
-        variable_measurements = meta.readstat_variable_types.get(
-            var_name,
-            None
+    return df, _get_metadata_frame(meta)
+
+
+def get_metadata_from_xpt(log, datafile, encoding=None):
+    """
+    Read only the variable metadata of an XPT file, without its rows.
+
+    Returns:
+        DataFrame: The columns Variable, Type and Labels.
+    """
+    try:
+        _, meta = pyreadstat.read_xport(
+            datafile,
+            metadataonly=True,
+            encoding=_pyreadstat_encoding(encoding)
             )
-        # create a dictionary with relevant metadata
-        metadata_dict = {
-            'Variable': var_name,
-            'Type': variable_measurements,
-            'Labels': variable_labels,
-        }
-        all_metadata.append(metadata_dict)
+    except Exception as e:
+        msm = f"Error reading XPT metadata: {e}"
+        logger(log, "e", msm)
+        raise ValueError(f"Error reading XPT metadata: {e}")
+    return _get_metadata_frame(meta)
 
-    # convert the list of dictionaries into a DataFrame
-    df_metadata = pd.DataFrame(all_metadata)
 
-    return df, df_metadata
+class XptChunkReader:
+    """
+    Iterates over an XPT file in chunks of chunk_size rows, so the memory
+    used by the ingestion is bounded by the chunk and not by the file.
+
+    Each chunk gets the same SEQN and sequence columns as get_data_from_xpt;
+    the sequence of a SEQN continues across chunk boundaries. After the
+    iteration, rows and samples hold the totals of the file.
+    """
+
+    def __init__(self, log, datafile, chunk_size, encoding=None):
+        self.log = log
+        self.datafile = datafile
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.rows = 0
+        self.samples = 0
+        self.columns = None
+
+    def _chunks(self):
+        encodings = XPT_ENCODINGS
+        if self.encoding:
+            encodings = [self.encoding] + \
+                [e for e in XPT_ENCODINGS if e != self.encoding]
+        for n, encoding in enumerate(encodings):
+            reader = pyreadstat.read_file_in_chunks(
+                pyreadstat.read_xport,
+                self.datafile,
+                chunksize=self.chunk_size,
+                encoding=_pyreadstat_encoding(encoding)
+                )
+            try:
+                first, _ = next(reader)
+            except StopIteration:
+                return
+            except UnicodeDecodeError as e:
+                if n == len(encodings) - 1:
+                    raise
+                msm = f"UnicodeDecodeError with encoding {encoding}: {e}"
+                logger(self.log, "w", msm)
+                continue
+            yield first
+            for chunk, _ in reader:
+                yield chunk
+            return
+
+    def __iter__(self):
+        self.rows = 0
+        seen = pd.Series(dtype='int64')
+        for df in self._chunks():
+            # ensure SEQN is treated as an integer
+            df['SEQN'] = df['SEQN'].astype(int)
+            if 'SEQN' in df.index.names:
+                df = df.reset_index()
+
+            # continue the sequence of the SEQN already seen in other chunks
+            offset = df['SEQN'].map(seen).fillna(0).astype(int)
+            df['sequence'] = df.groupby('SEQN').cumcount() + offset
+            seen = seen.add(df['SEQN'].value_counts(), fill_value=0)
+
+            df.index = pd.RangeIndex(self.rows, self.rows + df.shape[0])
+            self.rows += df.shape[0]
+            self.columns = df.columns.tolist()
+            yield df
+        self.samples = len(seen)
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory of the process (Linux only), so
+    peak_rss_mb() reports the peak of the next dataset only.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident memory of the process in MB, or None when the
+    platform does not report it.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    if sys.platform == 'darwin':
+        return peak / 1024 ** 2
+    return peak / 1024
 
 
 def _parse_html_variable_info_section(info):
@@ -149,8 +355,10 @@ def _parse_html_variable_section(
     return variable_df, code_table
 
 
-def _parse_nhanes_html_docfile(source_code, docfile):
+def _parse_nhanes_html_docfile_bs4(log, source_code, docfile):
     """
+    BeautifulSoup version of the codebook parser. Used as fallback when the
+    lxml parser cannot handle a file.
     """
     variable_df = pd.DataFrame()
     code_table = {}
@@ -173,38 +381,173 @@ def _parse_nhanes_html_docfile(source_code, docfile):
         return variable_df, code_table
     except Exception as e:
         msm = f"Error parsing HTML documentation file: {e}"
-        print(msm)  # replace to logger
+        logger(log, "e", msm)
         return variable_df, code_table
 
 
-def get_data_from_htm(doc_code, docfile, meta_df):
+# h3 titles of the variable sections, matched like the class of bs4 find()
+VARTITLE_XPATH = ".//h3[contains(concat(' ', normalize-space(@class), ' '), ' vartitle ')]"  # noqa E501
+
+
+def _html_text(element):
+    return ''.join(element.itertext())
+
+
+def _parse_html_code_table(table):
+    """
+    Build the code table of a variable straight from its lxml element.
+
+    Rows and header are taken the same way pd.read_html does (thead rows or
+    leading rows with only th cells, whitespace collapsed) and the values go
+    through the same TextParser, so the types match read_html. Tables with
+    spanning cells are left to read_html.
     """
+    if table.xpath('.//*[@colspan or @rowspan]'):
+        return pd.read_html(StringIO(lxml.html.tostring(table, encoding='unicode')))[0]  # noqa E501
+
+    def cells(row):
+        return [
+            re.sub(r'\s+', ' ', _html_text(cell).strip())
+            for cell in row.xpath('./td|./th')
+        ]
+
+    head = table.xpath('.//thead//tr')
+    body = table.xpath('.//tbody//tr') + table.xpath('./tr')
+    foot = table.xpath('.//tfoot//tr')
+    if not head:
+        while body and all(cell.tag == 'th' for cell in body[0].xpath('./td|./th')):  # noqa E501
+            head.append(body.pop(0))
+
+    head = [cells(row) for row in head]
+    rows = head + [cells(row) for row in body] + [cells(row) for row in foot]
+
+    header = None
+    if head:
+        if len(head) == 1:
+            header = 0
+        else:
+            header = [i for i, row in enumerate(head) if any(row)]
+
+    # pad ragged rows like read_html
+    width = max((len(row) for row in rows), default=0)
+    rows = [row + [''] * (width - len(row)) for row in rows]
+    with TextParser(rows, header=header, thousands=',', decimal='.') as parser:
+        return parser.read()
+
+
+def _parse_nhanes_html_docfile(log, source_code, docfile):
     """
-    variable_dfs = {}
-    code_table = {}
-    variable_df = None
+    Parse an NHANES codebook (HTM) with lxml.
 
-    variable_dfs[doc_code], code_tables = _parse_nhanes_html_docfile(
+    Every div with a vartitle h3 is a variable section, as in the bs4
+    parser. The variables are collected in a dict of records and the
+    DataFrame is created once at the end; the code tables are parsed from
+    the DOM without serializing them back to HTML.
+
+    Returns:
+        tuple: The variables DataFrame, indexed by <VariableName>_<source>,
+            and a dict of code tables by variable name.
+    """
+    try:
+        with open(docfile, 'r') as f:
+            root = lxml.html.document_fromstring(f.read())
+
+        records = {}
+        code_table = {}
+        # each variable is described in a separate div
+        for section in root.iter('div'):
+            titles = section.xpath(VARTITLE_XPATH)
+            if not titles or _html_text(titles[0]).find('CHECK ITEM') > -1:
+                continue
+            title = titles[0]
+
+            info = section.xpath('.//dl')[0]
+            infodict = {
+                dt.text_content().strip(': ').replace(' ', ''): dd.text_content().strip()  # noqa E501
+                for dt, dd in zip(info.xpath('.//dt'), info.xpath('.//dd'))
+            }
+            infodict['VariableNameLong'] = ''.join([i.title() for i in infodict['SASLabel'].translate(str.maketrans('', '', string.punctuation)).split(' ')]) if 'SASLabel' in infodict else infodict['VariableName'] # noqa E501
+            assert title.get('id') == infodict['VariableName']
+            infodict['VariableName'] = infodict['VariableName'].upper()
+            records.setdefault(infodict['VariableName'], {}).update(infodict)
+
+            tables = section.xpath('.//table')
+            if tables:
+                code_table[infodict['VariableName']] = _parse_html_code_table(
+                    tables[0]
+                    )
+    except Exception as e:
+        msm = f"Error parsing HTML documentation file with lxml: {e}. Trying the bs4 parser."  # noqa E501
+        logger(log, "w", msm)
+        return _parse_nhanes_html_docfile_bs4(log, source_code, docfile)
+
+    if not records:
+        return pd.DataFrame(), code_table
+
+    variable_df = pd.DataFrame.from_dict(records, orient='index')
+    variable_df['Source'] = source_code
+    variable_df = variable_df.loc[
+        variable_df.index != 'SEQN_%s' % source_code, :
+        ]
+    variable_df.index = variable_df.VariableName + '_' + variable_df.Source
+    return variable_df, code_table
+
+
+# code table of the variables without one in the codebook
+NO_DATA_CODE_TABLE = pd.DataFrame({
+    'Code or Value': ['no data'],
+    'Value Description': ['no data'],
+    'Count': [0],
+    'Cumulative': [0],
+    'Skip to Item': [None]
+}).to_json(orient='records')
+
+
+def parse_htm_codebook(log, doc_code, docfile):
+    """
+    Parse an NHANES codebook and serialize its code tables.
+
+    Returns:
+        tuple: The variables DataFrame and a dict with the code table of
+            each variable as JSON records.
+    """
+    variable_df, code_tables = _parse_nhanes_html_docfile(
+        log,
         doc_code,
         docfile
-    )
+        )
+    json_tables = {
+        key: value.to_json(orient='records') for key, value in code_tables.items()  # noqa E501
+    }
+    return variable_df, json_tables
 
-    if not code_tables:
-        # return variable_dfs[doc_code], code_table
-        code_tables = {}
 
-    # code_table.update(code_tables)
-    # for code in variable_dfs:
-    #     if variable_df is None:
-    #         variable_df = variable_dfs[code]
-    #     else:
-    #         variable_df = pd.concat((variable_df, variable_dfs[code]))
-    # return variable_df, code_table
+def get_data_from_htm(log, doc_code, docfile, meta_df, codebook=None):
+    """
+    Get the variables and code tables of a dataset from its codebook.
+
+    Args:
+        log (logger): Logger object to log messages.
+        doc_code (str): Dataset name, used as source of the variables.
+        docfile (str): Path to the HTM file.
+        meta_df (DataFrame): XPT metadata, used when the codebook has no
+            variables.
+        codebook (tuple): The output of parse_htm_codebook() for docfile,
+            e.g. from the CodebookCache. docfile is not parsed when given.
 
-    # Se o variable_dfs[doc_code] estiver vazio, usar meta_df para preencher os dados
-    if variable_dfs[doc_code].empty:
+    Returns:
+        tuple: The variables DataFrame and a dict with the code table of
+            each variable as JSON records.
+    """
+    if codebook is None:
+        codebook = parse_htm_codebook(log, doc_code, docfile)
+    variable_df, json_tables = codebook
+    json_tables = dict(json_tables)
+
+    # Se o variable_df estiver vazio, usar meta_df para preencher os dados
+    if variable_df.empty:
         # Construir um dataframe manualmente com base no meta_df
-        variable_dfs[doc_code] = pd.DataFrame({
+        variable_df = pd.DataFrame({
             'VariableName': meta_df['Variable'],         # Nome da variável
             'SASLabel': meta_df['Labels'],               # Rótulo da variável
             'EnglishText': meta_df['Labels'],            # Reutilizando Labels como EnglishText
@@ -214,29 +557,44 @@ def get_data_from_htm(doc_code, docfile, meta_df):
         })
 
     # Garantir que todas as variáveis em variable_df tenham correspondentes no code_table
-    variable_names = variable_dfs[doc_code]['VariableName'].unique()
-    for var_name in variable_names:
-        if var_name not in code_tables:
+    for var_name in variable_df['VariableName'].unique():
+        if var_name not in json_tables:
             # Adicionar uma entrada vazia ao code_table se a variável não estiver presente
-            code_tables[var_name] = pd.DataFrame({
-                'Code or Value': ['no data'],
-                'Value Description': ['no data'],
-                'Count': [0],
-                'Cumulative': [0],
-                'Skip to Item': [None]
-            })
-
-    # Atualiza o code_table com o resultado
-    code_table.update(code_tables)
-
-    # Concatena os dataframes das variáveis
-    for code in variable_dfs:
-        if variable_df is None:
-            variable_df = variable_dfs[code]
-        else:
-            variable_df = pd.concat((variable_df, variable_dfs[code]))
+            json_tables[var_name] = NO_DATA_CODE_TABLE
 
-    return variable_df, code_table
+    return variable_df, json_tables
+
+
+# VariableCycle fields written by the ingestion
+VARIABLE_CYCLE_FIELDS = [
+    'version',
+    'variable_name',
+    'sas_label',
+    'english_text',
+    'target',
+    'type',
+    'value_table',
+    ]
+
+
+def _variable_cycle_values(row, version, load_metadata):
+    """
+    Values of the VariableCycle fields for one metadata row, converted the
+    way the fields would store them, so they can be compared with the rows
+    already in the database.
+    """
+    values = {
+        'version': version,
+        'variable_name': row['VariableName'],
+        'sas_label': row['SASLabel'],
+        'english_text': row['EnglishText'] if load_metadata else '',
+        'target': row['Target'] if load_metadata else '',
+        'type': row['Type'],
+        'value_table': row['CodeTables'] if load_metadata else '',
+    }
+    for name in ['variable_name', 'sas_label', 'english_text', 'target', 'type']:  # noqa E501
+        values[name] = VariableCycle._meta.get_field(name).to_python(values[name])  # noqa E501
+    return values
 
 
 def process_and_save_metadata(
@@ -249,6 +607,12 @@ def process_and_save_metadata(
         dataset_cycle_description="",
         ):
     """
+    Save the variables of a dataset cycle and their VariableCycle metadata.
+
+    Existing Variables and VariableCycles are read in one query each; new
+    ones are created with bulk_create and only the VariableCycles whose
+    values changed are written with bulk_update. The DatasetCycle is
+    updated once. Everything runs in one transaction.
     """
 
     try:
@@ -263,79 +627,292 @@ def process_and_save_metadata(
     # drop columns that are not present in the database
     df['CodeTables'] = df['CodeTables'].apply(lambda x: None if pd.isna(x) else x)
 
+    # one row per variable; the last one wins as in a sequence of updates
+    df = df.drop_duplicates(subset='VariableName', keep='last')
+    names = list(df['VariableName'])
+
     # Uptade all or nothing and return False if any error occurs
-    with transaction.atomic():
-        for idx, row in df.iterrows():
-            try:
-                variable, created = Variable.objects.get_or_create(
+    try:
+        with transaction.atomic():
+            variables = {
+                v.variable: v for v in Variable.objects.filter(variable__in=names)  # noqa E501
+            }
+            new_variables = [
+                Variable(
                     variable=row['VariableName'],
-                    defaults={
-                        'description': row['SASLabel'],
-                        'type': 'oth',
-                    }
+                    description=row['SASLabel'],
+                    type='oth',
+                    )
+                for _, row in df.iterrows()
+                if row['VariableName'] not in variables
+            ]
+            if new_variables:
+                Variable.objects.bulk_create(new_variables)
+                # backends that can't return the ids of a bulk insert
+                if not all(v.pk for v in new_variables):
+                    new_variables = list(Variable.objects.filter(
+                        variable__in=[v.variable for v in new_variables]
+                        ))
+                variables.update({v.variable: v for v in new_variables})
+
+            if load_metadata:
+                DatasetCycle.objects.filter(
+                    dataset=qry_dataset,
+                    cycle=qry_cycle
+                ).update(
+                        metadata_url=dataset_cycle_url,
+                        description=dataset_cycle_description
                 )
 
-                if load_metadata:
-                    DatasetCycle.objects.filter(
-                        dataset=qry_dataset,
-                        cycle=qry_cycle
-                    ).update(
-                            metadata_url=dataset_cycle_url,
-                            description=dataset_cycle_description
+            existing = {
+                vc.variable_id: vc for vc in VariableCycle.objects.filter(
+                    dataset=qry_dataset,
+                    cycle=qry_cycle,
+                    variable__in=[variables[name] for name in names],
                     )
-                    variable_m, create_m = VariableCycle.objects.update_or_create(
+            }
+            to_create = []
+            to_update = []
+            for _, row in df.iterrows():
+                variable = variables[row['VariableName']]
+                values = _variable_cycle_values(row, qry_version, load_metadata)  # noqa E501
+                variable_cycle = existing.get(variable.id)
+                if variable_cycle is None:
+                    to_create.append(VariableCycle(
                         variable=variable,
                         dataset=qry_dataset,
                         cycle=qry_cycle,
-                        defaults={
-                            'version': qry_version,
-                            'variable_name': row['VariableName'],
-                            'sas_label': row['SASLabel'],
-                            'english_text': row['EnglishText'],
-                            'target': row['Target'],
-                            'type': row['Type'],
-                            'value_table': row['CodeTables']
-                            # 'value_table': row['CodeTables'] if row['CodeTables'] is not None else "{}",  # avoid NaN
-                        }
+                        **values
+                        ))
+                    continue
+                # compare the FK by id to avoid a query per row
+                current = {
+                    name: variable_cycle.version_id if name == 'version'
+                    else getattr(variable_cycle, name)
+                    for name in VARIABLE_CYCLE_FIELDS
+                }
+                values_id = dict(values, version=qry_version.id)
+                if current != values_id:
+                    for name, value in values.items():
+                        setattr(variable_cycle, name, value)
+                    to_update.append(variable_cycle)
+
+            if to_create:
+                VariableCycle.objects.bulk_create(to_create)
+            if to_update:
+                VariableCycle.objects.bulk_update(
+                    to_update,
+                    VARIABLE_CYCLE_FIELDS,
+                    batch_size=500
                     )
-                else:
-                    variable_m, create_m = VariableCycle.objects.update_or_create(
-                        variable=variable,
-                        dataset=qry_dataset,
-                        cycle=qry_cycle,
-                        defaults={
-                            'version': qry_version,
-                            'variable_name': row['VariableName'],
-                            'sas_label': row['SASLabel'],
-                            'english_text': '',
-                            'target': '',
-                            'type': row['Type'],
-                            'value_table': ''
-                        }
-                    )
-                # NOTE: Uncomment the following line to log the processed variables
-                # msm = f"Processed {variable.variable} with status {'created' if created else 'updated'}." # noqa E501
-                # logger(log, "i", msm)
-            except IntegrityError as e:
-                msm = f"Database error while processing {row['VariableName']}: {e}"
-                logger(log, "e", msm)
-                return False
-            except Exception as e:
-                msm = f"An unexpected error occurred: {e}"
-                logger(log, "e", msm)
-                return False
+    except IntegrityError as e:
+        msm = f"Database error while processing the metadata: {e}"
+        logger(log, "e", msm)
+        return False
+    except Exception as e:
+        msm = f"An unexpected error occurred: {e}"
+        logger(log, "e", msm)
+        return False
+
+    msm = f"Metadata saved: {len(new_variables)} new variables, {len(to_create)} new and {len(to_update)} updated variables by cycle."  # noqa E501
+    logger(log, "i", msm)
     return True
 
 
-def _chunked_bulk_create(objects, chunk_size=1000):
+# rows sent to the database in each executemany call
+DATA_INSERT_BATCH = 50000
+
+# columns that identify a Data row of a dataset cycle in a delta load
+DELTA_KEY = ['variable', 'sample', 'sequence']
+
+# columns written for each Data row of a delta load
+DELTA_VALUES = ['value', 'value_num', 'value_code']
+
+# value stored for the missing cells of a dense load; readers treat it as
+# missing, the same as a cell without a row in sparse mode
+MISSING_VALUE = str(np.nan)
+
+# bytes of the key columns of a Data row (version, cycle, dataset, variable,
+# sample and sequence), used to estimate the size saved in sparse mode
+DATA_ROW_KEY_BYTES = 6 * 8
+
+
+def _data_insert_sql():
     """
+    INSERT statement of the Data table for the columns filled by the
+    ingestion. rule_id is left to its NULL default.
     """
-    for i in range(0, len(objects), chunk_size):
-        Data.objects.bulk_create(objects[i:i + chunk_size])
+    fields = ['version', 'cycle', 'dataset', 'variable', 'sample', 'sequence', 'value', 'value_num', 'value_code']  # noqa E501
+    columns = [Data._meta.get_field(field).column for field in fields]
+    return "INSERT INTO {} ({}) VALUES ({})".format(
+        connection.ops.quote_name(Data._meta.db_table),
+        ", ".join(connection.ops.quote_name(column) for column in columns),
+        ", ".join(["%s"] * len(columns)),
+        )
+
+
+def _data_columns(columns, variable):
+    # columns of an XPT file stored as Data rows
+    return [
+        col for col in columns
+        if col not in ('SEQN', 'sequence') and col in variable
+    ]
+
+
+def _melt_data_arrays(chunk, variable, sparse=False):
+    """
+    Melt one chunk of an XPT file into the variable, sample, sequence,
+    value and value_num arrays of its Data rows, or None if the chunk has no
+    rows.
+
+    The value columns are converted to str once per column and flattened
+    column by column; SEQN and sequence are tiled and the variable ids are
+    repeated from an array, so no per cell Python work is done. value_num
+    holds the float of the numeric columns and None for the character
+    columns and the missing cells. In sparse mode the missing cells are
+    dropped with a mask over the same layout.
+    """
+    columns = _data_columns(chunk.columns, variable)
+    n_rows = len(chunk)
+    if not columns or not n_rows:
+        return None
+
+    variable_ids = np.array([variable[col].id for col in columns])
+    values = chunk[columns].astype(str).to_numpy().ravel(order='F')
+    samples = np.tile(chunk['SEQN'].to_numpy(dtype=np.int64), len(columns))
+    sequences = np.tile(
+        chunk['sequence'].to_numpy(dtype=np.int64),
+        len(columns)
+        )
+    variable_ids = np.repeat(variable_ids, n_rows)
+
+    # numeric columns as read by pyreadstat (double); NaN is stored as NULL
+    numbers = np.full((n_rows, len(columns)), np.nan)
+    numeric = [
+        n for n, col in enumerate(columns)
+        if pd.api.types.is_numeric_dtype(chunk[col])
+    ]
+    if numeric:
+        numbers[:, numeric] = chunk.iloc[
+            :,
+            [chunk.columns.get_loc(columns[n]) for n in numeric]
+            ].to_numpy(dtype=float)
+    numbers = numbers.ravel(order='F')
+    value_nums = numbers.astype(object)
+    value_nums[np.isnan(numbers)] = None
+
+    if sparse:
+        keep = ~chunk[columns].isna().to_numpy().ravel(order='F')
+        return (
+            variable_ids[keep],
+            samples[keep],
+            sequences[keep],
+            values[keep],
+            value_nums[keep],
+            )
+    return variable_ids, samples, sequences, values, value_nums
 
 
-def save_nhanes_data(log, df, cycle_id, dataset_id, save_data=True):
+def _melt_data_chunk(
+        chunk,
+        variable,
+        version_id,
+        cycle_id,
+        dataset_id,
+        sparse=False,
+        encoder=None,
+        ):
     """
+    Melt one chunk of an XPT file into Data rows. With an encoder, the
+    values of the categorical variables are stored as codes.
+
+    Returns:
+        iterator: Tuples in the column order of _data_insert_sql().
+    """
+    arrays = _melt_data_arrays(chunk, variable, sparse)
+    if arrays is None:
+        return iter(())
+
+    variable_ids, samples, sequences, values, value_nums = arrays
+    value_codes = repeat(None)
+    if encoder is not None:
+        values, value_codes = encoder.encode(variable_ids, values)
+        value_codes = value_codes.tolist()
+    return zip(
+        repeat(version_id),
+        repeat(cycle_id),
+        repeat(dataset_id),
+        variable_ids.tolist(),
+        samples.tolist(),
+        sequences.tolist(),
+        values.tolist(),
+        value_nums.tolist(),
+        value_codes,
+        )
+
+
+def _insert_data_rows(cursor, sql, rows, batch_size=DATA_INSERT_BATCH):
+    """
+    Send the rows to the database with executemany, batch_size at a time.
+    Also used for the UPDATE and DELETE statements of the delta load.
+
+    Returns:
+        int: Number of rows sent.
+    """
+    total = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return total
+        cursor.executemany(sql, batch)
+        total += len(batch)
+
+
+def _get_data_variables(columns):
+    """
+    Map the columns of an XPT file to their Variable instances. Raises
+    ValueError if a column has no Variable in the database.
+    """
+    # load only the fields that are present in the database
+    Variable_names = list(columns)
+
+    variable = {
+        variable.variable: variable for variable in Variable.objects.filter(
+            variable__in=Variable_names
+            ).only(
+                'id', 'variable'
+                )
+        }
+
+    # check if all fields are present in the database
+    missing_fields = [name for name in Variable_names if name not in variable and name != 'sequence']  # noqa E501
+    if missing_fields:
+        raise ValueError(f"Missing fields: {missing_fields}")
+    return variable
+
+
+def save_nhanes_data(
+        log,
+        df,
+        cycle_id,
+        dataset_id,
+        save_data=True,
+        source_hash="",
+        sparse=False,
+        encoded=False,
+        ):
+    """
+    Save the rows of an NHANES dataset in the Data table.
+
+    df is either a DataFrame or an iterable of DataFrame chunks, such as an
+    XptChunkReader. Chunks are converted and inserted one at a time, inside a
+    single transaction, so the whole dataset is loaded or nothing is. The
+    load is recorded in the DataManifest in the same transaction.
+
+    In sparse mode the missing cells are not stored; the rows skipped and an
+    estimate of the bytes saved are recorded in the DataManifest. In encoded
+    mode the values of the categorical variables are stored as codes of the
+    VariableCode table.
     """
     if not save_data:
         # Use only for testing purposes and to avoid data insertion
@@ -352,66 +929,402 @@ def save_nhanes_data(log, df, cycle_id, dataset_id, save_data=True):
         return False
 
     # check if data already exists for this cycle and dataset for any version
-    if Data.objects.filter(cycle=cycle, dataset=dataset).exists():
+    if DataManifest.objects.filter(
+        cycle=cycle,
+        dataset=dataset,
+        rule__isnull=True
+    ).exists():
         msm = "Data already exists for this cycle and dataset. No updates will \
             be performed."
         logger(log, "w", msm)
         return False
 
-    # load only the fields that are present in the database
-    Variable_names = df.columns.tolist()
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+    variable = None
+    sql = _data_insert_sql()
+    n_rows = 0
+    n_cells = 0
+    samples = set()
+    encoder = None
+    v_time_start = time.time()
 
-    variable = {
-        variable.variable: variable for variable in Variable.objects.filter(
-            variable__in=Variable_names
-            ).only(
-                'id', 'variable'
+    # using a transaction to avoid partial inserts
+    # rows are melted with pandas/numpy and inserted with executemany over
+    # the raw cursor, without creating a Data instance per value
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            for chunk in chunks:
+                if variable is None:
+                    variable = _get_data_variables(chunk.columns)
+                    if encoded:
+                        encoder = ValueEncoder(
+                            categorical_variables(
+                                cycle.id,
+                                dataset.id,
+                                [var.id for var in variable.values()]
+                                )
+                            )
+
+                rows = _melt_data_chunk(
+                    chunk,
+                    variable,
+                    version.id,
+                    cycle.id,
+                    dataset.id,
+                    sparse,
+                    encoder
+                    )
+                n_rows += _insert_data_rows(cursor, sql, rows)
+                n_cells += len(chunk) * len(
+                    _data_columns(chunk.columns, variable)
+                    )
+                samples.update(chunk['SEQN'].unique().tolist())
+
+            skipped_rows = n_cells - n_rows
+            DataManifest.objects.create(
+                version=version,
+                cycle=cycle,
+                dataset=dataset,
+                rows=n_rows,
+                n_samples=len(samples),
+                n_variables=len(set(variable or ()) - {'SEQN'}),
+                source_hash=source_hash or "",
+                load_time=time.time() - v_time_start,
+                skipped_rows=skipped_rows,
+                skipped_bytes=skipped_rows * (
+                    DATA_ROW_KEY_BYTES + len(MISSING_VALUE)
+                    ),
                 )
-        }
-
-    # check if all fields are present in the database
-    # missing_fields = [name for name in Variable_names if name not in fields]
-    missing_fields = [name for name in Variable_names if name not in variable and name != 'sequence']  # noqa E501
-    if missing_fields:
-        msm = f"Missing fields: {missing_fields}"
+    except Exception as e:
+        msm = f"Error saving data for cycle {cycle_id} and dataset {dataset_id}: {e}"  # noqa E501
         logger(log, "e", msm)
         return False
 
-    # pre-processing the data to extract SEQN and sequence for faster access
-    seqn_values = df['SEQN']
-    sequence_values = df['sequence']
-
-    # list comprehension
-    to_create = [
-        Data(
-            version=version,
-            cycle=cycle,
-            dataset=dataset,
-            variable=variable[col_name],
-            sample=seqn_values[index],
-            sequence=sequence_values[index],
-            value=str(value)
+    msm = f"All data for cycle {cycle_id} and dataset {dataset_id} \
+        has been inserted ({n_rows} rows)."
+    logger(log, "i", msm)
+    if encoder is not None:
+        msm = f"Encoded {len(encoder.categorical)} categorical variables; {encoder.created} new codes."  # noqa E501
+        logger(log, "i", msm)
+    return True
+
+
+def _column_values(series):
+    # list of a column with None for the missing values, sent as NULL
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def _compare_data_rows(df_old, df_new):
+    """
+    Compare the stored rows of a dataset with the rows of its new file.
+
+    Both frames are joined on DELTA_KEY with a hash join: rows only in
+    df_new are inserts, rows only in df_old are deletes and rows in both
+    with a different value are updates.
+
+    Args:
+        df_old (DataFrame): id, DELTA_KEY and value of the stored rows, with
+            the encoded values decoded.
+        df_new (DataFrame): DELTA_KEY and DELTA_VALUES of the rows of the
+            new file.
+
+    Returns:
+        tuple: (df_insert, df_update, delete_ids). df_insert has DELTA_KEY
+            and DELTA_VALUES, df_update the id and variable of the stored row
+            and its new DELTA_VALUES.
+    """
+    merged = df_old.merge(
+        df_new,
+        on=DELTA_KEY,
+        how='outer',
+        suffixes=('_old', '_new'),
+        indicator=True
         )
-        for col_name in (set(df.columns) - {'SEQN', 'sequence'})
-        if col_name in variable
-        for index, value in df[col_name].items()
-    ]
+    new_values = ['value_new'] + DELTA_VALUES[1:]
+    df_insert = merged.loc[
+        merged['_merge'] == 'right_only',
+        DELTA_KEY + new_values
+        ].rename(columns={'value_new': 'value'})
+    both = merged[merged['_merge'] == 'both']
+    df_update = both.loc[
+        both['value_old'] != both['value_new'],
+        ['id', 'variable'] + new_values
+        ].rename(columns={'value_new': 'value'})
+    delete_ids = merged.loc[merged['_merge'] == 'left_only', 'id']
+    return df_insert, df_update, delete_ids.astype(np.int64).tolist()
+
+
+def _get_stored_data(version, cycle, dataset):
+    # rows loaded from the NHANES files, without the ones created by rules
+    qs = Data.objects.filter(
+        version=version,
+        cycle=cycle,
+        dataset=dataset,
+        rule_id__isnull=True
+        ).values_list(
+            'id',
+            'variable_id',
+            'sample',
+            'sequence',
+            'value',
+            'value_code'
+            )
+    df_old = pd.DataFrame.from_records(
+        qs.iterator(chunk_size=DATA_INSERT_BATCH),
+        columns=['id'] + DELTA_KEY + ['value', 'value_code']
+        )
+    df_old = df_old.astype({column: np.int64 for column in ['id'] + DELTA_KEY})
+    return decode_values(df_old, 'variable')
 
-    # using a transaction to avoid partial inserts
-    # using bulk_create to speed up the process
-    with transaction.atomic():
-        _chunked_bulk_create(to_create)
 
-    msm = f"All data for cycle {cycle_id} and dataset {dataset_id} \
-        has been inserted."
+def _encode_rows(encoder, df):
+    # encode the values of the rows of a delta before they are written
+    if encoder is None or df.empty:
+        return df
+    values, value_codes = encoder.encode(
+        df['variable'].to_numpy(),
+        df['value'].to_numpy()
+        )
+    return df.assign(value=values, value_code=value_codes)
+
+
+def apply_nhanes_data_delta(
+        log,
+        df,
+        cycle_id,
+        dataset_id,
+        source_hash="",
+        sparse=False,
+        encoded=False,
+        ):
+    """
+    Re-ingest a republished NHANES dataset by writing only the rows that
+    changed since the last load.
+
+    The new file is compared with the stored rows by _compare_data_rows and
+    the inserts, updates and deletes are written in a single transaction,
+    together with the DataManifest. A dataset that was never loaded is
+    loaded in full by save_nhanes_data.
+
+    Returns:
+        dict: Number of rows inserted, updated and deleted, or None if the
+            delta could not be applied.
+    """
+    try:
+        cycle = Cycle.objects.get(id=cycle_id)
+        dataset = Dataset.objects.get(id=dataset_id)
+        version = Version.objects.get(version='nhanes')
+    except (Cycle.DoesNotExist, Dataset.DoesNotExist):
+        msm = "Dataset or Cycle not found on apply_nhanes_data_delta function."
+        logger(log, "e", msm)
+        return None
+
+    qs_manifest = DataManifest.objects.filter(
+        version=version,
+        cycle=cycle,
+        dataset=dataset,
+        rule__isnull=True
+        )
+    manifest = qs_manifest.first()
+    if manifest is None:
+        msm = f"No data loaded for cycle {cycle_id} and dataset {dataset_id}. Loading the full dataset."  # noqa E501
+        logger(log, "i", msm)
+        if not save_nhanes_data(
+            log,
+            df,
+            cycle_id,
+            dataset_id,
+            source_hash=source_hash,
+            sparse=sparse,
+            encoded=encoded
+        ):
+            return None
+        rows = qs_manifest.values_list('rows', flat=True).first()
+        return {'inserted': rows or 0, 'updated': 0, 'deleted': 0}
+
+    changes = {'inserted': 0, 'updated': 0, 'deleted': 0}
+    if source_hash and manifest.source_hash == source_hash:
+        msm = f"Source file of cycle {cycle_id} and dataset {dataset_id} is unchanged. No delta to apply."  # noqa E501
+        logger(log, "i", msm)
+        return changes
+
+    v_time_start = time.time()
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+    variable = None
+    frames = []
+    n_cells = 0
+    encoder = None
+    table = connection.ops.quote_name(Data._meta.db_table)
+    id_column = connection.ops.quote_name(Data._meta.pk.column)
+    set_values = ", ".join(
+        f"{connection.ops.quote_name(Data._meta.get_field(field).column)} = %s"
+        for field in DELTA_VALUES
+        )
+
+    try:
+        for chunk in chunks:
+            if variable is None:
+                variable = _get_data_variables(chunk.columns)
+            arrays = _melt_data_arrays(chunk, variable, sparse)
+            n_cells += len(chunk) * len(_data_columns(chunk.columns, variable))
+            if arrays is not None:
+                frames.append(
+                    pd.DataFrame(
+                        dict(zip(DELTA_KEY + ['value', 'value_num'], arrays))
+                        ).assign(value_code=None)
+                    )
+        if frames:
+            df_new = pd.concat(frames, ignore_index=True)
+        else:
+            df_new = pd.DataFrame(
+                {column: pd.Series(dtype=np.int64) for column in DELTA_KEY}
+                ).assign(
+                    value=pd.Series(dtype=object),
+                    value_num=pd.Series(dtype=object),
+                    value_code=pd.Series(dtype=object)
+                    )
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            df_old = _get_stored_data(version, cycle, dataset)
+            df_insert, df_update, delete_ids = _compare_data_rows(
+                df_old,
+                df_new
+                )
+            if encoded and variable is not None:
+                encoder = ValueEncoder(
+                    categorical_variables(
+                        cycle.id,
+                        dataset.id,
+                        [var.id for var in variable.values()]
+                        )
+                    )
+            df_insert = _encode_rows(encoder, df_insert)
+            df_update = _encode_rows(encoder, df_update)
+
+            changes['deleted'] = _insert_data_rows(
+                cursor,
+                f"DELETE FROM {table} WHERE {id_column} = %s",
+                ((row_id,) for row_id in delete_ids),
+                )
+            changes['updated'] = _insert_data_rows(
+                cursor,
+                f"UPDATE {table} SET {set_values} WHERE {id_column} = %s",
+                zip(
+                    *(_column_values(df_update[col]) for col in DELTA_VALUES),
+                    df_update['id'].astype(np.int64).tolist()
+                    ),
+                )
+            changes['inserted'] = _insert_data_rows(
+                cursor,
+                _data_insert_sql(),
+                zip(
+                    repeat(version.id),
+                    repeat(cycle.id),
+                    repeat(dataset.id),
+                    *(df_insert[col].tolist() for col in DELTA_KEY),
+                    *(_column_values(df_insert[col]) for col in DELTA_VALUES),
+                    ),
+                )
+
+            manifest.rows = len(df_new)
+            manifest.n_samples = df_new['sample'].nunique()
+            manifest.n_variables = len(set(variable or ()) - {'SEQN'})
+            manifest.source_hash = source_hash or ""
+            manifest.load_time = time.time() - v_time_start
+            manifest.skipped_rows = n_cells - len(df_new)
+            manifest.skipped_bytes = manifest.skipped_rows * (
+                DATA_ROW_KEY_BYTES + len(MISSING_VALUE)
+                )
+            manifest.save()
+    except Exception as e:
+        msm = f"Error applying the delta for cycle {cycle_id} and dataset {dataset_id}: {e}"  # noqa E501
+        logger(log, "e", msm)
+        return None
+
+    msm = f"Delta applied for cycle {cycle_id} and dataset {dataset_id}: {changes['inserted']} rows inserted, {changes['updated']} updated and {changes['deleted']} deleted out of {len(df_old)} stored rows."  # noqa E501
     logger(log, "i", msm)
-    return True
+    return changes
 
 
-def download_nhanes_file(log, url, path):
+def _adaptive_chunk_size(total_size):
     """
+    Pick the streaming chunk size from the expected file size: 64 KB for
+    small files, growing with the file up to 4 MB for the multi-GB ones.
+    """
+    min_chunk = 64 * 1024
+    max_chunk = 4 * 1024 * 1024
+    if not total_size:
+        return min_chunk
+    chunk = min_chunk
+    while chunk < max_chunk and chunk * 256 < total_size:
+        chunk *= 2
+    return chunk
+
+
+def _read_part_state(state_path):
+    try:
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove_files(*paths):
+    for file_path in paths:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def _content_range(value):
+    """
+    Parse 'bytes start-end/total' into (start, total). total is None when
+    the server sends '*'.
+    """
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', value or '')
+    if not match:
+        return None, None
+    total = None if match.group(2) == '*' else int(match.group(2))
+    return int(match.group(1)), total
+
+
+def download_nhanes_file(log, url, path, session=None, cache=None, limiter=None):  # noqa E501
+    """
+    Download one NHANES file to path.
+
+    The file is written to <path>.part and renamed to path only after its
+    length was checked, so path never holds a partial file. If a download
+    drops or ends short, the .part file is kept and resumed with an HTTP
+    Range request, up to the max_retries of the session in this call and
+    again on the next run. A cached copy revalidated by the server is
+    checked against its SHA-256 and downloaded again if it changed on disk.
+
+    Args:
+        log (logger): Logger object to log messages.
+        url (str): URL of the XPT or HTM file.
+        path (str): Destination of the downloaded file.
+        session (DownloadSession): Shared session of the ingestion run. When
+            not given a session is opened only for this file.
+        cache (DownloadCache): Download cache. When given, path must be
+            cache.path(url); a cached copy is revalidated with a conditional
+            GET and only downloaded again if the server has a new version.
+        limiter (HostRateLimiter): Rate limiter of the ingestion run, waited
+            on before every request, retries and resumes included.
+
+    Returns:
+        tuple: (True, '') on success or (False, status) where status is the
+            WorkProcess status to set ('no_file' or 'error').
     """
+    # imported here to avoid a circular import with ingestion_download
+    from nhanes.workprocess.ingestion_download import DownloadSession
+
     error = ''
+    part_path = f"{path}.part"
+    state_path = f"{path}.part.json"
+    own_session = session is None
+    if own_session:
+        session = DownloadSession(pool_size=1)
     try:
         # check if the URL is a HTML page
         if url.endswith('.htm') or url.endswith('.html'):
@@ -419,43 +1332,157 @@ def download_nhanes_file(log, url, path):
         else:
             is_html_page = False
 
-        response = requests.get(url, stream=True, allow_redirects=True)
-
-        # when file does not exist it redirects to a page that returns 200
-        # as a solution to this, we check if the content-type is html
-        content_type = response.headers.get('Content-Type')
+        attempt = 0
+        while True:
+            # resume a partial download when the server can validate it
+            offset = 0
+            state = None
+            if os.path.exists(part_path):
+                state = _read_part_state(state_path)
+            if state and state.get('url') == url and \
+                    (state.get('etag') or state.get('last_modified')):
+                offset = os.path.getsize(part_path)
+                headers = {
+                    'Range': f"bytes={offset}-",
+                    'If-Range': state.get('etag') or state.get('last_modified'),
+                }
+            elif cache is not None:
+                headers = cache.conditional_headers(url)
+            else:
+                headers = {}
+
+            response = session.get(url, limiter=limiter, headers=headers)
+
+            if response.status_code == 304 and cache is not None:
+                response.close()
+                if not cache.verify(url):
+                    # the cached copy changed on disk, download it again
+                    cache.remove(url)
+                    msm = f"Cached copy of {url} does not match its checksum. Downloading again."  # noqa E501
+                    logger(log, "w", msm)
+                    attempt += 1
+                    if attempt > session.max_retries:
+                        return False, 'error'
+                    continue
+                cache.touch(url)
+                msm = f"{url} not modified. Revalidated the cached copy, nothing downloaded."  # noqa E501
+                logger(log, "s", msm)
+                return True, error
+
+            # when file does not exist it redirects to a page that returns 200
+            # as a solution to this, we check if the content-type is html
+            content_type = response.headers.get('Content-Type', '')
+
+            # apply the 'text/html' check only if it's not a known .htm/.html URL
+            if not is_html_page and 'text' in content_type and 'html' in content_type:  # noqa E501
+                response.close()
+                msm = f"Failed to download {url}. The URL returned a HTML page, likely an error page."  # noqa E501
+                logger(log, "e", msm)
+                error = 'no_file'
+                return False, error
+
+            encoded = response.headers.get('Content-Encoding', 'identity') != 'identity'  # noqa E501
+            digest = hashlib.sha256()
+            if response.status_code == 206 and offset:
+                start, expected_size = _content_range(
+                    response.headers.get('Content-Range')
+                    )
+                if start != offset:
+                    # unexpected range, restart from scratch on the next try
+                    response.close()
+                    _remove_files(part_path, state_path)
+                    msm = f"Invalid range received from {url}. Restarting download."  # noqa E501
+                    logger(log, "w", msm)
+                    attempt += 1
+                    if attempt > session.max_retries:
+                        return False, 'error'
+                    continue
+                with open(part_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                mode = 'ab'
+                msm = f"Resuming download of {url} at byte {offset}."
+                logger(log, "i", msm)
+            elif response.status_code == 200:
+                offset = 0
+                mode = 'wb'
+                content_length = response.headers.get('Content-Length')
+                if content_length and not encoded:
+                    expected_size = int(content_length)
+                else:
+                    expected_size = None
+                with open(state_path, 'w') as f:
+                    json.dump({
+                        'url': url,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'size': expected_size,
+                    }, f)
+            else:
+                response.close()
+                if response.status_code == 416:
+                    # the partial file does not match the server any more
+                    _remove_files(part_path, state_path)
+                msm = f"Failed to download {url}. Status code: {response.status_code}" # noqa E501
+                logger(log, "e", msm)
+                error = 'error'
+                return False, error
 
-        # apply the 'text/html' check only if it's not a known .htm/.html URL
-        if not is_html_page and 'text' in content_type and 'html' in content_type:  # noqa E501
-            msm = f"Failed to download {url}. The URL returned a HTML page, likely an error page."  # noqa E501
+            # stream the body into the .part file
+            size = offset
+            chunk_size = _adaptive_chunk_size(expected_size)
+            try:
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                        session.add_bytes(len(chunk))
+            except requests.RequestException as e:
+                attempt += 1
+                if attempt > session.max_retries:
+                    raise
+                msm = f"Download of {url} interrupted at byte {size}: {e}. Resuming."  # noqa E501
+                logger(log, "w", msm)
+                continue
+            if expected_size is not None and size < expected_size and \
+                    attempt < session.max_retries:
+                # the connection was closed early, resume from the .part file
+                attempt += 1
+                msm = f"Download of {url} closed at byte {size} of {expected_size}. Resuming."  # noqa E501
+                logger(log, "w", msm)
+                continue
+            break
+
+        # check the length before the file is handed to the parser
+        if expected_size is not None and size != expected_size:
+            msm = f"Incomplete download of {url}: {size} of {expected_size} bytes. The partial file was kept to resume." # noqa E501
             logger(log, "e", msm)
-            error = 'no_file'
+            error = 'error'
             return False, error
 
-        if response.status_code == 200:
-            with open(path, 'wb') as f:
-                content_length = 0
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-                    content_length += len(chunk)
+        # check if the downloaded file is too small
+        if size < 1024:
+            _remove_files(part_path, state_path)
+            msm = f"Downloaded file from {url} seems too small. Check if it's the expected file." # noqa E501
+            logger(log, "w", msm)
+            error = 'no_file'
+            return False, error
 
-                # check if the downloaded file is too small
-                if content_length < 1024:
-                    msm = f"Downloaded file from {url} seems too small. Check if it's the expected file." # noqa E501
-                    logger(log, "w", msm)
-                    error = 'no_file'
-                    return False, error
+        # publish the complete file atomically
+        os.replace(part_path, path)
+        _remove_files(state_path)
 
-            msm = f"Downloaded {url}"
-            logger(log, "s", msm)
-            return True, error
-        else:
-            msm = f"Failed to download {url}. Status code: {response.status_code}" # noqa E501
-            logger(log, "e", msm)
-            error = 'error'
-            return False, error
+        if cache is not None:
+            cache.store(url, response.headers, size, digest.hexdigest())
+        msm = f"Downloaded {url}"
+        logger(log, "s", msm)
+        return True, error
     except Exception as e:
         msm = f"Error downloading {url}: {str(e)}"
         logger(log, "e", msm)
         error = 'error'
         return False, error
+    finally:
+        if own_session:
+            session.close()
@@ -1,9 +1,20 @@
 import re
+import time
 import pandas as pd
 from abc import ABC, abstractmethod
 from django.db.models.query import QuerySet
-from nhanes.models import Variable, Data, Cycle, Dataset, Version, Rule
+from django.db import transaction
+from nhanes.models import (
+    Variable,
+    Data,
+    DataManifest,
+    Cycle,
+    Dataset,
+    Version,
+    Rule
+    )
 from nhanes.utils.logs import logger
+from nhanes.workprocess.data_storage import bump_data_generation
 
 
 class BaseTransformation(ABC):
@@ -85,6 +96,9 @@ class BaseTransformation(ABC):
         try:
             if set == 'in':
                 for variable in self.df_in.columns:
+                    # columns loaded from value_num are numeric already
+                    if pd.api.types.is_float_dtype(self.df_in[variable]):
+                        continue
                     inferred_type = self._infer_type(self.df_in[variable])
                     self.df_in[variable] = self._apply_conversion(
                         self.df_in[variable],
@@ -213,14 +227,27 @@ class BaseTransformation(ABC):
                 )
             }
 
+        v_time_start = time.perf_counter()
         normalized_data_instances = []
 
+        # numeric outputs also fill value_num; booleans and text do not
+        numeric_variables = {
+            name for name in self.df_out.columns
+            if pd.api.types.is_numeric_dtype(self.df_out[name])
+            and not pd.api.types.is_bool_dtype(self.df_out[name])
+        }
+
         for _, row in self.df_out.iterrows():
             cycle_instance = cycle_map[row['cycle']]
             dataset_instance = dataset_map[row['dataset']]
             version_instance = version_map[row['version']]
 
             for rule_variable in self.variable_out:
+                value = row[rule_variable.variable.variable]
+                value_num = None
+                if rule_variable.variable.variable in numeric_variables \
+                        and pd.notna(value):
+                    value_num = float(value)
                 normalized_data_instances.append(
                     Data(
                         version=version_instance,
@@ -229,15 +256,45 @@ class BaseTransformation(ABC):
                         variable=rule_variable.variable,
                         sample=row['sample'],
                         sequence=row['sequence'],
-                        value=row[rule_variable.variable.variable],
+                        value=value,
+                        value_num=value_num,
                         rule_id=self.rule,
                     )
                 )
         try:
-            Data.objects.bulk_create(normalized_data_instances)
+            with transaction.atomic():
+                Data.objects.bulk_create(normalized_data_instances)
+                self._save_manifest(
+                    version_map,
+                    cycle_map,
+                    dataset_map,
+                    time.perf_counter() - v_time_start
+                    )
         except Exception as e:
             msm = f"Failed to save data: {e}"
             logger(self.log, "e", msm)
             return False
+        # the query results cached before the output of the rule are stale
+        bump_data_generation()
 
         return True
+
+    def _save_manifest(self, version_map, cycle_map, dataset_map, load_time):
+        # one manifest row per version, cycle and dataset written by the rule
+        n_variables = len(self.variable_out)
+        manifest = []
+        groups = self.df_out.groupby(['version', 'cycle', 'dataset'])
+        for (version, cycle, dataset), df_group in groups:
+            manifest.append(
+                DataManifest(
+                    version=version_map[version],
+                    cycle=cycle_map[cycle],
+                    dataset=dataset_map[dataset],
+                    rule=self.rule,
+                    rows=len(df_group) * n_variables,
+                    n_samples=df_group['sample'].nunique(),
+                    n_variables=n_variables,
+                    load_time=load_time,
+                )
+            )
+        DataManifest.objects.bulk_create(manifest)
@@ -1,7 +1,15 @@
 import importlib
+import numpy as np
 import pandas as pd
-from nhanes.models import Rule, RuleVariable, Data, WorkProcessRule
+from nhanes.models import (
+    Rule,
+    RuleVariable,
+    DataManifest,
+    WorkProcessRule
+    )
 from nhanes.utils.logs import logger, start_logger
+from nhanes.workprocess.data_storage import read_data
+from nhanes.workprocess.ingestion_utils import MISSING_VALUE
 # from django.db.models.query import QuerySet
 
 
@@ -36,58 +44,62 @@ class TransformationManager:
 
     def _get_input_data(self, qs_variable_in):
         df_list = []
+        manifests = {}
 
-        # get data for each rule variable
+        # get data for each rule variable from the storage of each loaded
+        # partition of its version (and dataset)
         for rule_var in qs_variable_in:
-            # filter the Data model based on the (dataset, variable) pairs
+            qs_manifest = DataManifest.objects.filter(
+                version=rule_var.version
+                ).select_related('version', 'cycle', 'dataset')
             if rule_var.dataset:
-                qs_df = Data.objects.filter(
-                    version=rule_var.version,
-                    dataset=rule_var.dataset,
-                    variable=rule_var.variable
-                ).values(
-                    'version_id__version',
-                    'cycle_id__cycle',
-                    'dataset_id__dataset',
-                    'sample',
-                    'sequence',
-                    'variable_id__variable',
-                    'value',
-                )
-            else:
-                qs_df = Data.objects.filter(
-                    version=rule_var.version,
-                    variable=rule_var.variable
-                ).values(
-                    'version_id__version',
-                    'cycle_id__cycle',
-                    'dataset_id__dataset',
-                    'sample',
-                    'sequence',
-                    'variable_id__variable',
-                    'value',
+                qs_manifest = qs_manifest.filter(dataset=rule_var.dataset)
+            qs_manifest = list(qs_manifest)
+            manifests.update({m.id: m for m in qs_manifest})
+
+            df_list.append(
+                read_data(
+                    qs_manifest,
+                    {rule_var.variable.id: rule_var.variable.variable}
+                    ).assign(variable=rule_var.variable.variable)
                 )
 
-            # convert queryset to dataframe
-            data = list(qs_df)
-            if data:  # check if there is data
-                df = pd.DataFrame(data)
-                df_list.append(df)
-
-        # concatenate the dataframes
+        # collect the rows of all variables in a single dataframe
+        df_list = [df for df in df_list if not df.empty]
         if df_list:
             final_df = pd.concat(df_list, ignore_index=True)
-
-            # change columns manes
-            final_df.columns = [
+            manifest = final_df.pop('manifest')
+            final_df.insert(
+                0,
                 'version',
+                manifest.map({k: m.version.version for k, m in manifests.items()})  # noqa E501
+                )
+            final_df.insert(
+                1,
                 'cycle',
+                manifest.map({k: m.cycle.cycle for k, m in manifests.items()})
+                )
+            final_df.insert(
+                2,
                 'dataset',
-                'sample',
-                'sequence',
-                'variable',
-                'value'
-            ]
+                manifest.map({k: m.dataset.dataset for k, m in manifests.items()})  # noqa E501
+                )
+
+            # missing values are either stored as 'nan' or, for datasets
+            # loaded in sparse mode or in Parquet files, have no row at all
+            final_df['value'] = final_df['value'].replace(MISSING_VALUE, np.nan)
+
+            # variables with value_num for every value are loaded as floats,
+            # without parsing their strings again
+            final_df['value_num'] = final_df['value_num'].astype(float)
+            is_numeric = final_df['value'].isna() | final_df['value_num'].notna()
+            numeric_variables = is_numeric.groupby(final_df['variable']).all()
+            numeric_variables = numeric_variables[numeric_variables].index
+            numeric_rows = final_df['variable'].isin(numeric_variables)
+            final_df['value'] = final_df['value'].astype(object)
+            final_df.loc[numeric_rows, 'value'] = \
+                final_df.loc[numeric_rows, 'value_num']
+
             # Pivot DataFrame final
             pivot_df = final_df.pivot_table(
                 index=[
@@ -103,6 +115,14 @@ class TransformationManager:
             )
             pivot_df = pivot_df.reset_index()
             pivot_df.columns.name = None
+            for variable in numeric_variables:
+                if variable in pivot_df.columns:
+                    pivot_df[variable] = pivot_df[variable].astype(float)
+
+            # keep the columns of variables without any value
+            for rule_var in qs_variable_in:
+                if rule_var.variable.variable not in pivot_df.columns:
+                    pivot_df[rule_var.variable.variable] = np.nan
 
             return pivot_df
         else:
@@ -145,7 +165,7 @@ class TransformationManager:
                 continue
 
             # check if the rule is already load on Data model
-            if Data.objects.filter(rule_id=rule.id).first():
+            if DataManifest.objects.filter(rule=rule).exists():
                 self._update_work_process_rule(
                     work_process_rule,
                     'complete',
@@ -0,0 +1,111 @@
+"""
+Benchmark of the Data loader used by save_nhanes_data.
+
+Compares the previous path (one Data instance and one str() call per cell,
+bulk_create in chunks of 1,000) with the vectorized melt + executemany
+loader. Both run against a throwaway test database, never db.sqlite3.
+
+Run from the tests folder:
+    $ python benchmarks/bench_data_loader.py --rows 20000 --columns 40
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../mynhanes'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.db import connection, transaction  # noqa: E402
+from nhanes.models import (  # noqa: E402
+    Cycle,
+    Data,
+    Dataset,
+    Group,
+    Variable,
+    Version,
+    )
+from nhanes.utils.logs import LogBuffer  # noqa: E402
+from nhanes.workprocess import ingestion_utils  # noqa: E402
+
+
+def _make_frame(n_rows, n_columns):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        rng.normal(50, 10, size=(n_rows, n_columns)).round(2),
+        columns=[f"BENCH{i:03d}" for i in range(n_columns)],
+        )
+    df.iloc[::7, ::3] = np.nan
+    df.insert(0, 'SEQN', np.arange(100000, 100000 + n_rows))
+    df['sequence'] = 0
+    return df
+
+
+def _orm_insert(df, version, cycle, dataset, variable):
+    # previous implementation of save_nhanes_data
+    with transaction.atomic():
+        to_create = [
+            Data(
+                version=version,
+                cycle=cycle,
+                dataset=dataset,
+                variable=variable[col_name],
+                sample=df['SEQN'][index],
+                sequence=df['sequence'][index],
+                value=str(value)
+            )
+            for col_name in (set(df.columns) - {'SEQN', 'sequence'})
+            if col_name in variable
+            for index, value in df[col_name].items()
+        ]
+        for i in range(0, len(to_create), 1000):
+            Data.objects.bulk_create(to_create[i:i + 1000])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--columns', type=int, default=40)
+    args = parser.parse_args()
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        version = Version.objects.create(version='nhanes')
+        cycle = Cycle.objects.create(cycle='2017-2018', year_code='J')
+        group = Group.objects.create(group='Benchmark')
+        dataset = Dataset.objects.create(dataset='BENCH', group=group)
+
+        df = _make_frame(args.rows, args.columns)
+        Variable.objects.bulk_create(
+            [Variable(variable=col) for col in df.columns if col != 'sequence']
+            )
+        variable = ingestion_utils._get_data_variables(df.columns)
+        n_cells = args.rows * args.columns
+
+        v_start = time.perf_counter()
+        _orm_insert(df, version, cycle, dataset, variable)
+        orm_time = time.perf_counter() - v_start
+        Data.objects.all().delete()
+
+        v_start = time.perf_counter()
+        ingestion_utils.save_nhanes_data(LogBuffer(), df, cycle.id, dataset.id)
+        new_time = time.perf_counter() - v_start
+        assert Data.objects.count() == n_cells
+
+        print(f"{n_cells} rows ({args.rows} samples x {args.columns} variables)")  # noqa E501
+        print(f"ORM bulk_create : {orm_time:7.2f}s {n_cells / orm_time:12,.0f} rows/s")  # noqa E501
+        print(f"melt+executemany: {new_time:7.2f}s {n_cells / new_time:12,.0f} rows/s")  # noqa E501
+        print(f"speedup         : {orm_time / new_time:7.2f}x")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
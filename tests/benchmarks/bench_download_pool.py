@@ -0,0 +1,148 @@
+"""
+Benchmark of the ingestion download pool against a local stand-in for the
+CDC server.
+
+The server adds a fixed latency to every response to mimic the network wait
+of wwwn.cdc.gov. The serial run reproduces the previous behaviour (one file at
+a time with a random sleep before each request).
+
+Run from the tests folder:
+    $ python benchmarks/bench_download_pool.py --jobs 40 --latency 0.3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../mynhanes'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from nhanes.utils.logs import LogBuffer  # noqa: E402
+from nhanes.workprocess import (  # noqa: E402
+    ingestion_download,
+    ingestion_pipeline,
+    ingestion_utils
+    )
+
+
+class SlowHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.3
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def guess_type(self, path):
+        if str(path).endswith('.XPT'):
+            return 'application/octet-stream'
+        return 'text/html'
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _make_jobs(base_url, target_dir, n_jobs):
+    return [
+        {
+            'name_file': f"DS{i:04d}",
+            'data_url': f"{base_url}/DS{i:04d}.XPT",
+            'doc_url': f"{base_url}/DS{i:04d}.htm",
+            'data_file': target_dir / f"DS{i:04d}.XPT",
+            'doc_file': target_dir / f"DS{i:04d}.htm",
+        }
+        for i in range(n_jobs)
+    ]
+
+
+def _clean(target_dir):
+    for file in target_dir.iterdir():
+        file.unlink()
+
+
+def run_serial(jobs):
+    log = LogBuffer()
+    for job in jobs:
+        for url, file_name in [
+            (job['data_url'], job['data_file']),
+            (job['doc_url'], job['doc_file']),
+        ]:
+            time.sleep(np.random.rand())
+            ingestion_utils.download_nhanes_file(log, url, file_name)
+
+
+def run_pool(jobs, workers, rate):
+    # download stage of the ingestion pipeline only: nothing to parse
+    session = ingestion_download.DownloadSession(pool_size=workers)
+    ingestion_pipeline.run_ingestion_pipeline(
+        LogBuffer(),
+        jobs,
+        lambda job: None,
+        lambda job, parsed: None,
+        download_workers=workers,
+        requests_per_second=rate,
+        session=session,
+        parse_workers=0,
+        queue_size=workers,
+        )
+    stats = session.stats()
+    session.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.3)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=10)
+    parser.add_argument('--size', type=int, default=256 * 1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source_dir = Path(tmp) / 'source'
+        target_dir = Path(tmp) / 'target'
+        source_dir.mkdir()
+        target_dir.mkdir()
+        payload = os.urandom(args.size)
+        for i in range(args.jobs):
+            (source_dir / f"DS{i:04d}.XPT").write_bytes(payload)
+            (source_dir / f"DS{i:04d}.htm").write_bytes(b'<html>' + payload)
+
+        SlowHandler.latency = args.latency
+        handler = partial(SlowHandler, directory=str(source_dir))
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        jobs = _make_jobs(base_url, target_dir, args.jobs)
+        start = time.perf_counter()
+        run_serial(jobs)
+        serial_time = time.perf_counter() - start
+        _clean(target_dir)
+
+        jobs = _make_jobs(base_url, target_dir, args.jobs)
+        start = time.perf_counter()
+        stats = run_pool(jobs, args.workers, args.rate)
+        pool_time = time.perf_counter() - start
+        server.shutdown()
+
+    n_files = args.jobs * 2
+    print(f"files: {n_files}, latency: {args.latency}s")
+    print(f"serial + random sleep: {serial_time:8.2f}s ({n_files / serial_time:6.2f} files/s)")  # noqa E501
+    print(f"pool ({args.workers} workers, {args.rate} req/s): {pool_time:8.2f}s ({n_files / pool_time:6.2f} files/s)")  # noqa E501
+    print(f"pool session: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Benchmark of the QueryStructure export with the pandas and duckdb engines.
+
+Loads a few cycles of a synthetic dataset and exports a query over all of
+them with --variables variables, once with each engine (query.engine), and
+checks both CSV files hold the same table. The pandas engine is the current
+path: rows through the ORM and the pivot in _create_pivot_table (Dask). The
+test database is a file, so DuckDB attaches it when its sqlite extension is
+available; otherwise the rows are handed over as Arrow, as printed.
+
+Run from the tests folder:
+    $ python benchmarks/bench_duckdb_query.py --samples 5000 --variables 25
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../mynhanes'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.db import connection  # noqa: E402
+from core.parameters import config  # noqa: E402
+from nhanes.models import (  # noqa: E402
+    Cycle,
+    Dataset,
+    Group,
+    QueryColumns,
+    QueryFilter,
+    QueryStructure,
+    Variable,
+    Version,
+    )
+from nhanes.reports import query, query_duckdb  # noqa: E402
+from nhanes.utils.logs import LogBuffer  # noqa: E402
+from nhanes.workprocess.data_storage import get_data_storage  # noqa: E402
+
+
+class ModelAdmin:
+    def message_user(self, request, message, level=None):
+        print(f"{level}: {message}")
+
+
+def _make_frame(n_rows, n_columns, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        rng.normal(50, 10, size=(n_rows, n_columns)).round(2),
+        columns=[f"BENCH{i:03d}" for i in range(n_columns)],
+        )
+    df.iloc[::7, ::3] = np.nan
+    df.insert(0, 'SEQN', np.arange(100000, 100000 + n_rows))
+    df['sequence'] = 0
+    return df
+
+
+def _export(engine, structure):
+    with mock.patch.dict(config, {'query': {'engine': engine}}):
+        start = time.perf_counter()
+        response = query.download_data_report(
+            ModelAdmin(),
+            None,
+            QueryStructure.objects.filter(id=structure.id)
+            )
+        elapsed = time.perf_counter() - start
+    df = pd.read_csv(
+        io.BytesIO(response.content),
+        header=[0, 1],
+        index_col=[0, 1, 2]
+        )
+    df.index = df.index.set_names(['Cycle', 'sample', 'sequence'])
+    return df.sort_index().sort_index(axis=1), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=5000)
+    parser.add_argument('--variables', type=int, default=25)
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--storage', default='db', choices=['db', 'parquet'])
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    config['workprocess']['download_path'] = tmp.name
+    old_name = connection.settings_dict['NAME']
+    connection.settings_dict['TEST']['NAME'] = os.path.join(tmp.name, 'bench.sqlite3')  # noqa E501
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        Version.objects.create(version='nhanes')
+        group = Group.objects.create(group='Benchmark')
+        dataset = Dataset.objects.create(dataset='BENCH', group=group)
+        storage = get_data_storage(args.storage)
+        for n in range(args.cycles):
+            df = _make_frame(args.samples, args.variables, n)
+            if not n:
+                Variable.objects.bulk_create([
+                    Variable(variable=col)
+                    for col in df.columns if col != 'sequence'
+                    ])
+            cycle = Cycle.objects.create(
+                cycle=f"{2001 + 2 * n}-{2002 + 2 * n}",
+                year_code=chr(ord('B') + n)
+                )
+            storage.save(LogBuffer(), df, cycle.id, dataset.id)
+
+        columns = [
+            QueryColumns.objects.create(
+                column_name=name,
+                internal_data_key=key,
+                column_description=''
+                )
+            for name, key in [
+                ('Cycle', 'cycle__cycle'),
+                ('Dataset Code', 'dataset__dataset'),
+                ('Variable Code', 'variable__variable'),
+                ]
+            ]
+        structure = QueryStructure.objects.create(structure_name='bench')
+        structure.columns.set(columns)
+        QueryFilter.objects.create(
+            query_structure=structure,
+            filter_name='dataset__dataset',
+            operator='eq',
+            value='BENCH'
+            )
+
+        pandas_df, pandas_time = _export('pandas', structure)
+        with mock.patch.object(
+            query_duckdb.DuckDBQueryEngine,
+            '__exit__',
+            lambda self, *exc: print(f"duckdb source: {self.source}") or self.con.close()  # noqa E501
+        ):
+            duckdb_df, duckdb_time = _export('duckdb', structure)
+        pd.testing.assert_frame_equal(pandas_df, duckdb_df)
+
+        n_cells = args.samples * args.variables * args.cycles
+        print(f"{n_cells} values ({args.cycles} cycles x {args.samples} samples x {args.variables} variables, {args.storage} storage)")  # noqa E501
+        print(f"pandas/Dask pivot: {pandas_time:7.2f}s")
+        print(f"duckdb pivot     : {duckdb_time:7.2f}s")
+        print(f"speedup          : {pandas_time / duckdb_time:7.2f}x")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
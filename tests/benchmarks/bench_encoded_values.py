@@ -0,0 +1,170 @@
+"""
+Benchmark of the dictionary-encoded storage of categorical values.
+
+Loads the same categorical columns twice, once with the values in
+Data.value and once encoded as VariableCode codes, and compares the space
+taken by the Data table and the time to scan the values back (with the
+decode of the codes). Both run against a throwaway test database, never
+db.sqlite3.
+
+Run from the tests folder:
+    $ python benchmarks/bench_encoded_values.py --rows 20000 --columns 20
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../mynhanes'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.db import connection  # noqa: E402
+from nhanes.models import (  # noqa: E402
+    Cycle,
+    Data,
+    DataManifest,
+    Dataset,
+    Group,
+    Variable,
+    VariableCode,
+    VariableCycle,
+    Version,
+    )
+from nhanes.utils.logs import LogBuffer  # noqa: E402
+from nhanes.workprocess import ingestion_utils  # noqa: E402
+from nhanes.workprocess.ingestion_codes import decode_values  # noqa: E402
+
+LABELS = [
+    'Yes',
+    'No',
+    'Refused',
+    "Don't know",
+    'Less than 9th grade',
+    'High school graduate/GED or equivalent',
+    'College graduate or above',
+    ]
+
+
+def _make_frame(n_rows, n_columns):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        rng.choice(LABELS, size=(n_rows, n_columns)),
+        columns=[f"BENCH{i:03d}" for i in range(n_columns)],
+        )
+    df.insert(0, 'SEQN', np.arange(100000, 100000 + n_rows))
+    df['sequence'] = 0
+    return df
+
+
+def _database_bytes():
+    # pages in use by the database, freed pages excluded
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA page_size")
+        page_size = cursor.fetchone()[0]
+        cursor.execute("PRAGMA page_count")
+        page_count = cursor.fetchone()[0]
+        cursor.execute("PRAGMA freelist_count")
+        freelist_count = cursor.fetchone()[0]
+    return page_size * (page_count - freelist_count)
+
+
+def _load(df, cycle, dataset, encoded):
+    Data.objects.all().delete()
+    DataManifest.objects.all().delete()
+    VariableCode.objects.all().delete()
+    with connection.cursor() as cursor:
+        cursor.execute("VACUUM")
+    size = _database_bytes()
+    start = time.perf_counter()
+    ingestion_utils.save_nhanes_data(
+        LogBuffer(),
+        df,
+        cycle.id,
+        dataset.id,
+        encoded=encoded
+        )
+    load_time = time.perf_counter() - start
+    return _database_bytes() - size, load_time
+
+
+def _scan():
+    start = time.perf_counter()
+    df = pd.DataFrame.from_records(
+        Data.objects.values_list(
+            'variable_id',
+            'sample',
+            'sequence',
+            'value',
+            'value_code'
+            ),
+        columns=['variable', 'sample', 'sequence', 'value', 'value_code']
+        )
+    df = decode_values(df, 'variable')
+    return df, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--columns', type=int, default=20)
+    args = parser.parse_args()
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        version = Version.objects.create(version='nhanes')
+        cycle = Cycle.objects.create(cycle='2017-2018', year_code='J')
+        group = Group.objects.create(group='Benchmark')
+        dataset = Dataset.objects.create(dataset='BENCH', group=group)
+
+        df = _make_frame(args.rows, args.columns)
+        Variable.objects.bulk_create(
+            [Variable(variable=col) for col in df.columns if col != 'sequence']
+            )
+        value_table = json.dumps([
+            {'Code or Value': str(n), 'Value Description': label}
+            for n, label in enumerate(LABELS)
+        ])
+        VariableCycle.objects.bulk_create([
+            VariableCycle(
+                version=version,
+                variable=variable,
+                cycle=cycle,
+                dataset=dataset,
+                value_table=value_table
+                )
+            for variable in Variable.objects.filter(variable__startswith='BENCH')  # noqa E501
+        ])
+        n_cells = args.rows * args.columns
+
+        results = {}
+        frames = {}
+        for encoded in [False, True]:
+            size, load_time = _load(df, cycle, dataset, encoded)
+            frames[encoded], scan_time = _scan()
+            results[encoded] = (size, load_time, scan_time)
+        key = ['variable', 'sample', 'sequence']
+        pd.testing.assert_frame_equal(
+            frames[False].sort_values(key, ignore_index=True),
+            frames[True].sort_values(key, ignore_index=True),
+            )
+
+        print(f"{n_cells} rows ({args.rows} samples x {args.columns} categorical variables)")  # noqa E501
+        for encoded, name in [(False, 'plain  '), (True, 'encoded')]:
+            size, load_time, scan_time = results[encoded]
+            print(f"{name}: {size / 2**20:8.2f} MB  load {load_time:6.2f}s  scan+decode {scan_time:6.2f}s")  # noqa E501
+        print(f"size ratio     : {results[True][0] / results[False][0]:6.2f}")
+        print(f"scan speedup   : {results[False][2] / results[True][2]:6.2f}x")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of the execution backends of the report pivots.
+
+Runs --exports pivots of the same long table, as consecutive admin exports
+would, with:
+  - a new Dask cluster per export (the previous behaviour),
+  - the local backend (one Dask cluster for the whole process),
+  - the pandas backend (in-process).
+
+Run from the tests folder:
+    $ python benchmarks/bench_execution_backend.py --rows 200000 --exports 5
+"""
+import argparse
+import os
+import sys
+import time
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../mynhanes'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from core.parameters import config  # noqa: E402
+from nhanes.reports.query import _create_pivot_table  # noqa: E402
+from nhanes.utils import execution  # noqa: E402
+
+
+def _make_frame(n_rows, n_variables=50):
+    rng = np.random.default_rng(0)
+    n_samples = n_rows // n_variables
+    return pd.DataFrame({
+        'Cycle': '2017-2018',
+        'sample': np.repeat(np.arange(93703, 93703 + n_samples), n_variables),  # noqa E501
+        'sequence': 0,
+        'Variable Code': np.tile(
+            [f"VAR{i:03d}" for i in range(n_variables)],
+            n_samples
+            ),
+        'value': rng.integers(1, 10, n_samples * n_variables).astype(str),
+    })
+
+
+def _pivot(df):
+    return _create_pivot_table(
+        df.copy(),
+        index_columns=['Cycle', 'sample', 'sequence'],
+        pivot_columns=['Variable Code']
+        )
+
+
+def _run(df, n_exports, per_export_cluster=False):
+    start = time.perf_counter()
+    for _ in range(n_exports):
+        _pivot(df)
+        if per_export_cluster:
+            execution.close_dask_client()
+    execution.close_dask_client()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--exports', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    df = _make_frame(args.rows)
+    settings = {
+        'backend': 'local',
+        'dask_min_rows': 0,
+        'n_workers': args.workers,
+        'dashboard_address': ':0',
+        }
+    print(f"{args.exports} exports of {len(df)} rows")
+    with mock.patch.dict(config, {'execution': settings}):
+        times = [
+            ('new cluster per export', _run(df, args.exports, True)),
+            ('shared local cluster', _run(df, args.exports)),
+            ]
+        settings['backend'] = 'pandas'
+        times.append(('pandas', _run(df, args.exports)))
+    for name, elapsed in times:
+        print(f"{name:24}: {elapsed:7.2f}s ({elapsed / args.exports:.2f}s per export)")  # noqa E501
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark of the file outputs of the ingestion: csv against the parquet and
+feather load types.
+
+Writes a synthetic dataset shaped as an XPT file (SEQN, numeric variables
+with missing values and a few character variables) with write_output_file,
+then reads it back as a notebook would (pd.read_csv, pd.read_parquet,
+pd.read_feather) and prints the times, the file sizes and whether the
+column types survive the round trip.
+
+Run from the tests folder:
+    $ python benchmarks/bench_output_formats.py --rows 100000 --variables 100
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../mynhanes'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from nhanes.workprocess import ingestion_files  # noqa: E402
+
+READERS = {
+    'csv': lambda path: pd.read_csv(path, index_col=0),
+    'parquet': pd.read_parquet,
+    'feather': pd.read_feather,
+    }
+
+
+def _make_frame(n_rows, n_columns, seed=0):
+    rng = np.random.default_rng(seed)
+    # NHANES values are mostly small codes and rounded measures
+    df = pd.DataFrame(
+        rng.integers(1, 10, size=(n_rows, n_columns)).astype(float),
+        columns=[f"VAR{i:03d}" for i in range(n_columns)],
+        )
+    df.iloc[:, n_columns // 2:] += rng.normal(0, 1, size=(n_rows, n_columns - n_columns // 2)).round(1)  # noqa E501
+    df = df.mask(rng.random(df.shape) < 0.3)
+    for i in range(max(n_columns // 20, 1)):
+        df[f"TXT{i:03d}"] = rng.choice(['Retail', 'Sales', None], n_rows)
+    df.insert(0, 'SEQN', np.arange(93703, 93703 + n_rows, dtype=float))
+    df['sequence'] = 0
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--variables', type=int, default=100)
+    args = parser.parse_args()
+
+    df = _make_frame(args.rows, args.variables)
+    print(f"{args.rows} rows x {df.shape[1]} columns")
+    print(f"{'format':8} {'write':>8} {'read':>8} {'size MB':>9}  types kept")
+    with tempfile.TemporaryDirectory() as tmp:
+        for file_format in ingestion_files.FILE_FORMATS:
+            path = Path(tmp) / f"BENCH_data.{file_format}"
+            start = time.perf_counter()
+            entry = ingestion_files.write_output_file(df, path, file_format)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            df_read = READERS[file_format](path)
+            read_time = time.perf_counter() - start
+
+            kept = df_read['SEQN'].dtype == np.int64 \
+                and df_read['sequence'].dtype == np.int64 \
+                and (df_read.dtypes.iloc[1:-1] == df.dtypes.iloc[1:-1]).all()
+            print(f"{file_format:8} {write_time:7.2f}s {read_time:7.2f}s {entry['bytes'] / 1024 ** 2:9.1f}  {kept}")  # noqa E501
+
+
+if __name__ == '__main__':
+    main()
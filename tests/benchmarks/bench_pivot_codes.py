@@ -0,0 +1,133 @@
+"""
+Benchmark of the pivot of _create_pivot_table on integer codes against the
+previous pivot on string keys.
+
+The previous pivot concatenated Cycle, sample and sequence into a string key
+per row, joined the pivot columns with a Python call per row and split the
+keys back after pandas.pivot_table. It is kept here as reference; both
+pivots are written with _download_query_results_as_csv and the CSV files
+have to be identical.
+
+Run from the tests folder:
+    $ python benchmarks/bench_pivot_codes.py --rows 10000000
+"""
+import argparse
+import os
+import sys
+import time
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../mynhanes'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from core.parameters import config  # noqa: E402
+from nhanes.reports.query import (  # noqa: E402
+    _create_pivot_table,
+    _download_query_results_as_csv,
+    )
+
+INDEX_COLUMNS = ['Cycle', 'sample', 'sequence']
+PIVOT_COLUMNS = ['Dataset Code', 'Variable Code']
+
+
+def _string_key_pivot(df, index_columns, pivot_columns):
+    # the previous in-process pivot of _create_pivot_table
+    df['unique_index'] = df['Cycle'].astype(str) + \
+        '___' + df['sample'].astype(str) + \
+        '___' + df['sequence'].astype(str)
+    df['unique_index'] = df['unique_index'].astype('category')
+    df['unique_column'] = df[pivot_columns].apply(
+        lambda row: '___'.join(row.values.astype(str)),
+        axis=1
+        )
+    df['unique_column'] = df['unique_column'].astype('category')
+    df.drop(columns=index_columns + pivot_columns, inplace=True)
+    pivot_df = df.pivot_table(
+        index='unique_index',
+        columns='unique_column',
+        values='value',
+        aggfunc='first',
+        observed=True,
+        dropna=False
+    )
+    pivot_df.columns = pd.MultiIndex.from_tuples(
+        [col.split('___') for col in pivot_df.columns]
+        )
+    pivot_df[index_columns] = pivot_df.index.to_series().str.split('___', expand=True)  # noqa E501
+    pivot_df.reset_index(inplace=True)
+    pivot_df.drop(columns=['unique_index'], inplace=True)
+    pivot_df.set_index(index_columns, inplace=True)
+    return pivot_df
+
+
+def _make_frame(n_rows, n_variables, n_cycles=3):
+    rng = np.random.default_rng(0)
+    n_samples = n_rows // (n_variables * n_cycles)
+    n = n_samples * n_variables * n_cycles
+    # SEQN of different widths, as in the first and the last cycles
+    samples = np.tile(np.repeat(np.arange(1, n_samples + 1) * 7, n_variables), n_cycles)  # noqa E501
+    values = rng.integers(1, 10, n).astype(str).astype(object)
+    values[rng.random(n) < 0.2] = np.nan
+    return pd.DataFrame({
+        'Cycle': np.repeat([f"{1999 + 2 * c}-{2000 + 2 * c}" for c in range(n_cycles)], n_samples * n_variables),  # noqa E501
+        'sample': samples,
+        'sequence': 0,
+        'Dataset Code': np.tile(
+            np.repeat(['DEMO', 'LAB'], [n_variables // 2, n_variables - n_variables // 2]),  # noqa E501
+            n_samples * n_cycles
+            ),
+        'Variable Code': np.tile(
+            [f"VAR{i:03d}" for i in range(n_variables)],
+            n_samples * n_cycles
+            ),
+        'value': values,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--variables', type=int, default=100)
+    parser.add_argument(
+        '--no-reference',
+        action='store_true',
+        help='skip the string key pivot (it needs several times the memory)'
+        )
+    args = parser.parse_args()
+
+    df = _make_frame(args.rows, args.variables)
+    print(f"{len(df)} long rows, {args.variables} variables")
+
+    if not args.no_reference:
+        start = time.perf_counter()
+        before = _string_key_pivot(df.copy(), INDEX_COLUMNS, PIVOT_COLUMNS)
+        before_time = time.perf_counter() - start
+
+    # in-process, whatever the execution backend of parameters.yml
+    with mock.patch.dict(config, {'execution': {'backend': 'pandas'}}):
+        start = time.perf_counter()
+        after = _create_pivot_table(
+            df.copy(),
+            index_columns=INDEX_COLUMNS,
+            pivot_columns=PIVOT_COLUMNS
+            )
+        after_time = time.perf_counter() - start
+
+    print(f"integer codes: {after_time:7.2f}s")
+    if args.no_reference:
+        return
+    same = _download_query_results_as_csv(None, before).content == \
+        _download_query_results_as_csv(None, after).content
+    print(f"string keys  : {before_time:7.2f}s")
+    print(f"speedup      : {before_time / after_time:7.2f}x")
+    print(f"same CSV     : {same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Benchmark of the result cache of the QueryStructure export.
+
+Loads --cycles cycles of a synthetic dataset and exports a query over all
+of them with query.cache on: the first export (miss) reads and pivots the
+data and stores the result, the next --repeat exports (hits) read it back
+from the cache. After a new data generation the export is a miss again.
+Prints the time of each export and the size of the cache, and checks that
+all the CSV files are equal.
+
+Run from the tests folder:
+    $ python benchmarks/bench_query_cache.py --cycles 4 --samples 5000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../mynhanes'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.db import connection  # noqa: E402
+from core.parameters import config  # noqa: E402
+from nhanes.models import (  # noqa: E402
+    Cycle,
+    Dataset,
+    Group,
+    QueryColumns,
+    QueryFilter,
+    QueryStructure,
+    Variable,
+    Version,
+    )
+from nhanes.reports import query  # noqa: E402
+from nhanes.reports.query_cache import get_query_cache  # noqa: E402
+from nhanes.utils.logs import LogBuffer  # noqa: E402
+from nhanes.workprocess.data_storage import (  # noqa: E402
+    bump_data_generation,
+    get_data_storage
+    )
+
+
+class ModelAdmin:
+    def message_user(self, request, message, level=None):
+        print(f"{level}: {message}")
+
+
+def _make_frame(n_rows, n_columns, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        rng.integers(1, 10, size=(n_rows, n_columns)).astype(float),
+        columns=[f"BENCH{i:03d}" for i in range(n_columns)],
+        )
+    df.insert(0, 'SEQN', np.arange(100000, 100000 + n_rows) + seed * n_rows)
+    df['sequence'] = 0
+    return df
+
+
+def _export(structure):
+    start = time.perf_counter()
+    response = query.download_data_report(
+        ModelAdmin(),
+        None,
+        QueryStructure.objects.filter(id=structure.id)
+        )
+    return response.content, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cycles', type=int, default=4)
+    parser.add_argument('--samples', type=int, default=5000)
+    parser.add_argument('--variables', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    config['workprocess']['download_path'] = tmp.name
+    config['query'] = {'engine': 'pandas', 'cache': True}
+    config['execution'] = {'backend': 'pandas'}
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        Version.objects.create(version='nhanes')
+        group = Group.objects.create(group='Benchmark')
+        dataset = Dataset.objects.create(dataset='BENCH', group=group)
+        storage = get_data_storage('db')
+        for n in range(args.cycles):
+            df = _make_frame(args.samples, args.variables, n)
+            if not n:
+                Variable.objects.bulk_create([
+                    Variable(variable=col)
+                    for col in df.columns if col != 'sequence'
+                    ])
+            cycle = Cycle.objects.create(
+                cycle=f"{2001 + 2 * n}-{2002 + 2 * n}",
+                year_code=chr(ord('B') + n)
+                )
+            storage.save(LogBuffer(), df, cycle.id, dataset.id)
+
+        columns = [
+            QueryColumns.objects.create(
+                column_name=name,
+                internal_data_key=key,
+                column_description=''
+                )
+            for name, key in [
+                ('Cycle', 'cycle__cycle'),
+                ('Variable Code', 'variable__variable'),
+                ]
+            ]
+        structure = QueryStructure.objects.create(structure_name='bench')
+        structure.columns.set(columns)
+        QueryFilter.objects.create(
+            query_structure=structure,
+            filter_name='dataset__dataset',
+            operator='eq',
+            value='BENCH'
+            )
+
+        print(f"{args.cycles} cycles x {args.samples} samples x {args.variables} variables")  # noqa E501
+        contents = []
+        runs = ['miss'] + ['hit'] * args.repeat + ['new generation']
+        for name in runs:
+            if name == 'new generation':
+                bump_data_generation()
+            content, total_time = _export(structure)
+            contents.append(content)
+            print(f"{name:15} {total_time:7.2f}s")
+        cache = get_query_cache()
+        print(f"CSV {len(contents[0]) / 1024 ** 2:.1f} MB, cache {cache.total_size() / 1024 ** 2:.1f} MB in {len(cache.entries)} results")  # noqa E501
+        print(f"same CSV: {all(c == contents[0] for c in contents)}")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmark of the QueryStructure export, buffered against streaming.
+
+Loads --cycles cycles of a synthetic dataset and exports a query over all
+of them, once buffered and once with query.streaming, measuring the peak
+of the memory allocated by Python (tracemalloc), the time to the first
+bytes of the response and the total time. The peak of the streaming export
+grows with the largest cycle, not with the number of cycles.
+
+Run from the tests folder:
+    $ python benchmarks/bench_streaming_export.py --cycles 6 --samples 5000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../mynhanes'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.db import connection  # noqa: E402
+from core.parameters import config  # noqa: E402
+from nhanes.models import (  # noqa: E402
+    Cycle,
+    Dataset,
+    Group,
+    QueryColumns,
+    QueryFilter,
+    QueryStructure,
+    Variable,
+    Version,
+    )
+from nhanes.reports import query  # noqa: E402
+from nhanes.utils.logs import LogBuffer  # noqa: E402
+from nhanes.workprocess.data_storage import get_data_storage  # noqa: E402
+
+
+class ModelAdmin:
+    def message_user(self, request, message, level=None):
+        print(f"{level}: {message}")
+
+
+def _make_frame(n_rows, n_columns, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        rng.integers(1, 10, size=(n_rows, n_columns)).astype(float),
+        columns=[f"BENCH{i:03d}" for i in range(n_columns)],
+        )
+    df.insert(0, 'SEQN', np.arange(100000, 100000 + n_rows) + seed * n_rows)
+    df['sequence'] = 0
+    return df
+
+
+def _export(structure, streaming):
+    settings = {'engine': 'pandas', 'streaming': streaming}
+    with mock.patch.dict(config, {'query': settings}):
+        tracemalloc.start()
+        start = time.perf_counter()
+        response = query.download_data_report(
+            ModelAdmin(),
+            None,
+            QueryStructure.objects.filter(id=structure.id)
+            )
+        if streaming:
+            chunks = iter(response.streaming_content)
+            size = len(next(chunks))
+            first_time = time.perf_counter() - start
+            size += sum(len(chunk) for chunk in chunks)
+        else:
+            first_time = time.perf_counter() - start
+            size = len(response.content)
+        total_time = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return size, first_time, total_time, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cycles', type=int, default=6)
+    parser.add_argument('--samples', type=int, default=5000)
+    parser.add_argument('--variables', type=int, default=20)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    config['workprocess']['download_path'] = tmp.name
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        Version.objects.create(version='nhanes')
+        group = Group.objects.create(group='Benchmark')
+        dataset = Dataset.objects.create(dataset='BENCH', group=group)
+        storage = get_data_storage('db')
+        for n in range(args.cycles):
+            df = _make_frame(args.samples, args.variables, n)
+            if not n:
+                Variable.objects.bulk_create([
+                    Variable(variable=col)
+                    for col in df.columns if col != 'sequence'
+                    ])
+            cycle = Cycle.objects.create(
+                cycle=f"{2001 + 2 * n}-{2002 + 2 * n}",
+                year_code=chr(ord('B') + n)
+                )
+            storage.save(LogBuffer(), df, cycle.id, dataset.id)
+
+        columns = [
+            QueryColumns.objects.create(
+                column_name=name,
+                internal_data_key=key,
+                column_description=''
+                )
+            for name, key in [
+                ('Cycle', 'cycle__cycle'),
+                ('Variable Code', 'variable__variable'),
+                ]
+            ]
+        structure = QueryStructure.objects.create(structure_name='bench')
+        structure.columns.set(columns)
+        QueryFilter.objects.create(
+            query_structure=structure,
+            filter_name='dataset__dataset',
+            operator='eq',
+            value='BENCH'
+            )
+
+        print(f"{args.cycles} cycles x {args.samples} samples x {args.variables} variables")  # noqa E501
+        print(f"{'export':10} {'MB':>6} {'first bytes':>12} {'total':>8} {'peak MB':>8}")  # noqa E501
+        for name, streaming in [('buffered', False), ('streaming', True)]:
+            size, first_time, total_time, peak = _export(structure, streaming)
+            print(f"{name:10} {size / 1024 ** 2:6.1f} {first_time:11.2f}s {total_time:7.2f}s {peak / 1024 ** 2:8.1f}")  # noqa E501
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Setup shared by the tests of the QueryStructure export.
+"""
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+from django.test import TestCase
+from core.parameters import config
+from nhanes.models import (
+    QueryColumns,
+    QueryFilter,
+    QueryStructure,
+    Variable
+    )
+from nhanes.reports import query
+
+
+class ModelAdmin:
+    def __init__(self):
+        self.messages = []
+
+    def message_user(self, request, message, level=None):
+        self.messages.append((level, message))
+
+
+def demo_frame():
+    # a small DEMO file: a numeric variable with a missing value and a text
+    # one, with a sample of two rows
+    return pd.DataFrame({
+        'SEQN': [93703.0, 93704.0, 93704.0, 93705.0],
+        'sequence': [0, 0, 1, 0],
+        'RIDAGEYR': [2.0, np.nan, 62.0, 30.5],
+        'OCD240': ['Retail', '', 'Sales', 'Retail'],
+    })
+
+
+class QueryTestCase(TestCase):
+    """
+    Variables of demo_frame() and a download path in a temporary folder;
+    the tests load the data they need.
+    """
+    fixtures = [
+        'tests/fixtures/version_fixture.json',
+        'tests/fixtures/cycle_fixture.json',
+        'tests/fixtures/group_fixture.json',
+        'tests/fixtures/dataset_fixture.json',
+        ]
+    variables = ['SEQN', 'RIDAGEYR', 'OCD240']
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.dict(
+            config['workprocess'],
+            {'download_path': self.tmp.name}
+            )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        for name in self.variables:
+            Variable.objects.create(variable=name)
+        self.df = demo_frame()
+
+    def create_structure(self, operator='eq', value='DEMO'):
+        """
+        Query structure with the Cycle, Dataset Code and Variable Code
+        columns and a filter on the dataset.
+        """
+        columns = [
+            QueryColumns.objects.create(
+                column_name=name,
+                internal_data_key=key,
+                column_description=''
+                )
+            for name, key in [
+                ('Cycle', 'cycle__cycle'),
+                ('Dataset Code', 'dataset__dataset'),
+                ('Variable Code', 'variable__variable'),
+                ]
+            ]
+        self.structure = QueryStructure.objects.create(structure_name='demo')
+        self.structure.columns.set(columns)
+        QueryFilter.objects.create(
+            query_structure=self.structure,
+            filter_name='dataset__dataset',
+            operator=operator,
+            value=value
+            )
+        return self.structure
+
+    def download(self, **options):
+        """
+        Export self.structure with the query options given (the pandas
+        engine by default).
+
+        Returns:
+            tuple: The response and the messages sent to the admin.
+        """
+        modeladmin = ModelAdmin()
+        with mock.patch.dict(config, {
+            'query': {'engine': 'pandas', **options},
+            'execution': {'backend': 'pandas'},
+        }):
+            response = query.download_data_report(
+                modeladmin,
+                None,
+                QueryStructure.objects.filter(id=self.structure.id)
+                )
+        return response, modeladmin.messages
@@ -0,0 +1,50 @@
+from django.contrib.admin.sites import AdminSite
+from django.test import RequestFactory, TestCase
+from nhanes.admin import DataAdmin
+from nhanes.models import Data, Variable, VariableCode
+
+
+class DataAdminTest(TestCase):
+    fixtures = [
+        'tests/fixtures/version_fixture.json',
+        'tests/fixtures/cycle_fixture.json',
+        'tests/fixtures/group_fixture.json',
+        'tests/fixtures/dataset_fixture.json',
+        ]
+
+    def setUp(self):
+        self.admin = DataAdmin(Data, AdminSite())
+        self.request = RequestFactory().get('/')
+        variable = Variable.objects.create(variable='OCD240')
+        VariableCode.objects.create(variable=variable, code=1, value='Retail')
+        for sample, value, value_code in [
+            (93703, '', 1),
+            (93704, 'Sales', None),
+        ]:
+            Data.objects.create(
+                version_id=1,
+                cycle_id=10,
+                dataset_id=1,
+                variable=variable,
+                sample=sample,
+                value=value,
+                value_code=value_code
+                )
+
+    def test_encoded_values(self):
+        queryset = self.admin.get_queryset(self.request).order_by('sample')
+        self.assertEqual(
+            [self.admin.decoded_value(row) for row in queryset],
+            ['Retail', 'Sales']
+            )
+
+        for term, samples in [('retail', [93703]), ('Sales', [93704])]:
+            results, _ = self.admin.get_search_results(
+                self.request,
+                queryset.filter(cycle_id=10),
+                term
+                )
+            self.assertEqual(
+                sorted(results.values_list('sample', flat=True)),
+                samples
+                )
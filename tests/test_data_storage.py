@@ -0,0 +1,180 @@
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import pandas as pd
+from django.db import IntegrityError, transaction
+from django.test import TestCase
+from core.parameters import config
+from nhanes.models import Data, DataManifest, Rule, Variable, Version
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import data_storage
+from nhanes.workprocess.transformation_manager import TransformationManager
+
+
+class DataStorageTest(TestCase):
+    fixtures = [
+        'tests/fixtures/version_fixture.json',
+        'tests/fixtures/cycle_fixture.json',
+        'tests/fixtures/group_fixture.json',
+        'tests/fixtures/dataset_fixture.json',
+        ]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # Parquet files under a temporary download path
+        patcher = mock.patch.dict(
+            config['workprocess'],
+            {'download_path': self.tmp.name}
+            )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.parquet = data_storage.ParquetStorage()
+        for name in ['SEQN', 'RIDAGEYR', 'OCD240']:
+            Variable.objects.create(variable=name)
+        self.df = pd.DataFrame({
+            'SEQN': [93703.0, 93704.0, 93704.0, 93705.0],
+            'sequence': [0, 0, 1, 0],
+            'RIDAGEYR': [2.0, np.nan, 62.0, 30.5],
+            'OCD240': ['Retail', '', 'Sales', 'Retail'],
+        })
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _read(self, storage, variables=None, value_filters=()):
+        manifests = DataManifest.objects.filter(storage=storage.name)
+        df = storage.read(
+            list(manifests.select_related('version', 'cycle', 'dataset')),
+            variables,
+            value_filters
+            )
+        # the missing values of a dense database load are 'nan' rows
+        df = df[df['value'] != 'nan']
+        return df.drop(columns=['manifest']).sort_values(
+            ['variable', 'sample', 'sequence'],
+            ignore_index=True
+            )
+
+    def _load_both(self):
+        # same file in both storages, one dataset each
+        self.assertTrue(
+            data_storage.DatabaseStorage().save(LogBuffer(), self.df, 10, 1)
+            )
+        self.assertTrue(self.parquet.save(LogBuffer(), self.df, 10, 2))
+
+    def test_parquet_reads_as_db(self):
+        self._load_both()
+        manifest = DataManifest.objects.get(dataset_id=2)
+        self.assertEqual(manifest.storage, 'parquet')
+        self.assertEqual(manifest.rows, 7)
+        self.assertTrue(self.parquet.manifest_path(manifest).exists())
+        self.assertFalse(Data.objects.filter(dataset_id=2).exists())
+
+        pd.testing.assert_frame_equal(
+            self._read(data_storage.DatabaseStorage()),
+            self._read(self.parquet)
+            )
+
+        # projection and value filters
+        age = Variable.objects.get(variable='RIDAGEYR')
+        occupation = Variable.objects.get(variable='OCD240')
+        for variables, value_filters in [
+            ({age.id: 'RIDAGEYR'}, ()),
+            (None, [{'value_num__gt': 10.0}]),
+            (None, [{'value_num__range': [1.0, 40.0]}]),
+            (None, [{'value__in': ['Retail', '62.0']}]),
+            ({occupation.id: 'OCD240'}, [{'value__istartswith': 're'}]),
+        ]:
+            db = self._read(
+                data_storage.DatabaseStorage(),
+                variables,
+                value_filters
+                )
+            self.assertFalse(db.empty)
+            pd.testing.assert_frame_equal(
+                db,
+                self._read(self.parquet, variables, value_filters)
+                )
+
+    def test_database_reads_only_its_partitions(self):
+        storage = data_storage.DatabaseStorage()
+        for cycle_id, dataset_id in [(10, 1), (10, 2), (9, 1), (9, 2)]:
+            self.assertTrue(
+                storage.save(LogBuffer(), self.df, cycle_id, dataset_id)
+                )
+        manifests = [
+            DataManifest.objects.get(cycle_id=10, dataset_id=1),
+            DataManifest.objects.get(cycle_id=9, dataset_id=2),
+            ]
+        _, query = storage._query(manifests, None, ())
+        # not the other two partitions of the same cycles and datasets
+        self.assertEqual(
+            Data.objects.filter(query).count(),
+            sum(m.rows for m in manifests)
+            )
+        df = storage.read(manifests)
+        self.assertEqual(
+            sorted(df['manifest'].unique()),
+            sorted(m.id for m in manifests)
+            )
+
+    def test_input_data_from_both_storages(self):
+        self._load_both()
+        version = Version.objects.get(version='nhanes')
+        rule_variables = [
+            SimpleNamespace(
+                version=version,
+                dataset=None,
+                variable=Variable.objects.get(variable=name)
+                )
+            for name in ['RIDAGEYR', 'OCD240']
+        ]
+        df = TransformationManager(rules=[])._get_input_data(rule_variables)
+        self.assertEqual(sorted(df['dataset'].unique()), ['DEMO', 'HDL'])
+        frames = [
+            part.drop(columns=['dataset']).reset_index(drop=True)
+            for _, part in df.groupby('dataset')
+            ]
+        pd.testing.assert_frame_equal(*frames)
+        self.assertEqual(df['RIDAGEYR'].dtype, float)
+
+    def test_parquet_delta_and_delete(self):
+        self.assertTrue(self.parquet.save(LogBuffer(), self.df, 10, 1, source_hash='a'))  # noqa E501
+        df_new = self.df.iloc[:2].assign(OCD240=['Retail', 'Sales'])
+        changes = self.parquet.apply_delta(
+            LogBuffer(),
+            df_new,
+            10,
+            1,
+            source_hash='b'
+            )
+        self.assertEqual(changes, {'inserted': 0, 'updated': 1, 'deleted': 4})
+        self.assertEqual(len(self._read(self.parquet)), 3)
+
+        # a dataset stays in the storage it was loaded in
+        self.assertIsNone(
+            data_storage.DatabaseStorage().apply_delta(LogBuffer(), self.df, 10, 1)  # noqa E501
+            )
+
+        manifest = DataManifest.objects.get()
+        path = self.parquet.manifest_path(manifest)
+        self.assertEqual(
+            data_storage.delete_data(DataManifest.objects.all()),
+            3
+            )
+        self.assertFalse(path.exists())
+        self.assertFalse(DataManifest.objects.exists())
+
+    def test_manifest_unique_per_partition(self):
+        DataManifest.objects.create(version_id=1, cycle_id=10, dataset_id=1)
+        # a second raw load of the partition, although rule is NULL
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            DataManifest.objects.create(version_id=1, cycle_id=10, dataset_id=1)  # noqa E501
+
+        # the outputs of a rule are a partition of their own, once
+        rule, = Rule.objects.bulk_create([Rule(rule='rule_1', version='0.0.1')])  # noqa E501
+        DataManifest.objects.create(version_id=1, cycle_id=10, dataset_id=1, rule=rule)  # noqa E501
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            DataManifest.objects.create(version_id=1, cycle_id=10, dataset_id=1, rule=rule)  # noqa E501
+        self.assertEqual(DataManifest.objects.count(), 2)
@@ -0,0 +1,122 @@
+from unittest import mock
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase
+from core.parameters import config
+from nhanes.reports.query import _create_pivot_table
+from nhanes.utils import execution
+
+
+class ExecutionBackendTest(SimpleTestCase):
+
+    def setUp(self):
+        # a small local cluster of threads, closed after each test
+        patcher = mock.patch.dict(config, {'execution': {
+            'backend': 'local',
+            'dask_min_rows': 4,
+            'n_workers': 1,
+            'memory_limit': '512MB',
+            'dashboard_address': ':0',
+            }})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(execution.close_dask_client)
+
+    def _frame(self):
+        return pd.DataFrame({
+            'Cycle': ['2017-2018'] * 4 + ['2015-2016'],
+            'sample': [93703, 93703, 93704, 93704, 83732],
+            'sequence': [0, 0, 0, 0, 0],
+            'Dataset Code': ['DEMO', 'DEMO', 'DEMO', 'DEMO', 'DEMO'],
+            'Variable Code': ['RIDAGEYR', 'OCD240', 'RIDAGEYR', 'OCD240', 'DMDEDUC'],  # noqa E501
+            'value': ['2.0', 'Retail', '62.0', np.nan, np.nan],
+        })
+
+    def _pivot(self):
+        return _create_pivot_table(
+            self._frame(),
+            index_columns=['Cycle', 'sample', 'sequence'],
+            pivot_columns=['Dataset Code', 'Variable Code']
+            )
+
+    def test_backend_by_input_size(self):
+        self.assertTrue(execution.use_dask(4))
+        self.assertFalse(execution.use_dask(3))
+        with mock.patch.dict(config['execution'], {'backend': 'pandas'}):
+            self.assertFalse(execution.use_dask(10 ** 9))
+        with mock.patch.dict(config['execution'], {'backend': 'spark'}):
+            self.assertRaises(ValueError, execution.use_dask, 10)
+
+    def test_pandas_and_dask_pivots_match(self):
+        with mock.patch.dict(config['execution'], {'backend': 'pandas'}):
+            pandas_df = self._pivot()
+        dask_df = self._pivot()
+        # the cluster is started once and reused by the next pivots
+        client = execution.get_dask_client()
+        self._pivot()
+        self.assertIs(execution.get_dask_client(), client)
+
+        def normalize(df):
+            df = df.sort_index().sort_index(axis=1)
+            df.columns = df.columns.map(tuple)
+            return df.astype(object).where(df.notna(), None)
+
+        pd.testing.assert_frame_equal(normalize(pandas_df), normalize(dask_df))  # noqa E501
+        self.assertEqual(
+            pandas_df.loc[('2017-2018', '93703', '0'), ('DEMO', 'OCD240')],
+            'Retail'
+            )
+        # a variable without values keeps its column
+        self.assertIn(('DEMO', 'DMDEDUC'), list(pandas_df.columns))
+
+        execution.close_dask_client()
+        self.assertIsNot(execution.get_dask_client(), client)
+
+
+class PivotTableTest(SimpleTestCase):
+
+    def test_pivot_on_integer_codes(self):
+        df = pd.DataFrame({
+            'Cycle': ['1999-2000'] * 5 + ['2017-2018'],
+            'sample': [140, 14, 14, 14, 9, 9],
+            'sequence': [0, 0, 0, 0, 0, 0],
+            'Variable Code': ['RIDAGEYR', 'RIDAGEYR', 'RIDAGEYR', 'OCD240', 'OCD240', 'DMDEDUC'],  # noqa E501
+            'value': ['40.0', np.nan, '12.0', 'Retail', 'Sales', np.nan],
+        })
+        with mock.patch.dict(config, {'execution': {'backend': 'pandas'}}):
+            pivot_df = _create_pivot_table(
+                df,
+                index_columns=['Cycle', 'sample', 'sequence'],
+                pivot_columns=['Variable Code']
+                )
+        # rows in the order of their text keys ('140___' before '14___'),
+        # the first value that is not missing of each cell and a column for
+        # a variable without values
+        self.assertEqual(
+            list(pivot_df.index),
+            [
+                ('1999-2000', '140', '0'),
+                ('1999-2000', '14', '0'),
+                ('1999-2000', '9', '0'),
+                ('2017-2018', '9', '0'),
+                ]
+            )
+        self.assertEqual(list(pivot_df.columns), ['DMDEDUC', 'OCD240', 'RIDAGEYR'])  # noqa E501
+        self.assertEqual(pivot_df.loc[('1999-2000', '14', '0'), 'RIDAGEYR'], '12.0')  # noqa E501
+        self.assertTrue(pivot_df['DMDEDUC'].isna().all())
+
+    def test_pivot_keeps_first_of_duplicate_cells(self):
+        df = pd.DataFrame({
+            'Cycle': ['2017-2018'] * 20,
+            'sample': [93703] * 20,
+            'sequence': [0] * 20,
+            'Variable Code': ['RIDAGEYR'] * 20,
+            'value': [np.nan] + [str(n) for n in range(19)],
+        })
+        with mock.patch.dict(config, {'execution': {'backend': 'pandas'}}):
+            pivot_df = _create_pivot_table(
+                df,
+                index_columns=['Cycle', 'sample', 'sequence'],
+                pivot_columns=['Variable Code']
+                )
+        self.assertEqual(pivot_df.iloc[0, 0], '0')
@@ -0,0 +1,54 @@
+import os
+import tempfile
+from django.test import TestCase
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import ingestion_bulk
+
+
+class BulkLoadTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.tmp.name, 'bulk_indexes.json')
+        self.indexes = {
+            index['name'] for index in ingestion_bulk._get_data_indexes()
+            }
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _index_names(self):
+        return {index['name'] for index in ingestion_bulk._get_data_indexes()}
+
+    def test_indexes_rebuilt_after_load(self):
+        with ingestion_bulk.bulk_load(LogBuffer(), self.state_file):
+            remaining = ingestion_bulk._get_data_indexes()
+            self.assertEqual(
+                [index['columns'] for index in remaining],
+                [['dataset_id']]
+                )
+            self.assertTrue(os.path.exists(self.state_file))
+        self.assertEqual(self._index_names(), self.indexes)
+        self.assertFalse(os.path.exists(self.state_file))
+
+    def test_indexes_rebuilt_after_failure(self):
+        with self.assertRaises(RuntimeError):
+            with ingestion_bulk.bulk_load(LogBuffer(), self.state_file):
+                raise RuntimeError("load failed")
+        self.assertEqual(self._index_names(), self.indexes)
+
+    def test_recover_interrupted_run(self):
+        # a run killed after dropping the indexes leaves only the state file
+        ingestion_bulk.drop_data_indexes(LogBuffer(), self.state_file)
+        self.assertNotEqual(self._index_names(), self.indexes)
+
+        rebuilt = ingestion_bulk.recover_data_indexes(
+            LogBuffer(),
+            self.state_file
+            )
+        self.assertEqual(rebuilt, len(self.indexes) - 1)
+        self.assertEqual(self._index_names(), self.indexes)
+        self.assertEqual(
+            ingestion_bulk.recover_data_indexes(LogBuffer(), self.state_file),
+            0
+            )
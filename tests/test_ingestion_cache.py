@@ -0,0 +1,235 @@
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+from django.test import SimpleTestCase
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import ingestion_utils
+from nhanes.workprocess.ingestion_cache import (
+    CodebookCache,
+    DownloadCache,
+    file_sha256
+    )
+from nhanes.workprocess.ingestion_download import DownloadSession
+from nhanes.workprocess.ingestion_utils import download_nhanes_file
+
+DOC_FILE = os.path.join(
+    os.path.dirname(__file__),
+    'fixtures',
+    'htm',
+    'DEMO_J.htm'
+    )
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    payload = os.urandom(2048)
+    n_full = 0
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        ETagHandler.n_full += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Drops the connection halfway through the first full download and
+    serves Range requests afterwards, of at most max_range bytes each.
+    """
+    protocol_version = 'HTTP/1.1'
+    payload = os.urandom(300 * 1024)
+    ranges = []
+    max_range = None
+
+    def do_GET(self):
+        value = self.headers.get('Range')
+        RangeHandler.ranges.append(value)
+        total = len(self.payload)
+        if value:
+            start = int(value[len('bytes='):-1])
+            end = total if self.max_range is None else min(total, start + self.max_range)  # noqa E501
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end - 1}/{total}")
+            self.send_header('Content-Length', str(end - start))
+        else:
+            start = 0
+            self.send_response(200)
+            self.send_header('Content-Length', str(total))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        if value:
+            self.wfile.write(self.payload[start:end])
+        else:
+            self.wfile.write(self.payload[:total // 2])
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _add(self, cache, url, size):
+        path = cache.path(url)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return cache.store(url, {'ETag': '"a"'}, size, file_sha256(path))
+
+    def test_store_and_reload(self):
+        cache = DownloadCache(self.cache_dir)
+        url = "https://wwwn.cdc.gov/Nchs/Nhanes/2017-2018/DEMO_J.XPT"
+        self._add(cache, url, 10)
+        self.assertTrue(str(cache.path(url)).endswith('.XPT'))
+
+        cache = DownloadCache(self.cache_dir)
+        self.assertEqual(cache.get(url)['size'], 10)
+        self.assertEqual(cache.conditional_headers(url), {'If-None-Match': '"a"'})
+
+    def test_evict_least_recently_used(self):
+        cache = DownloadCache(self.cache_dir, max_size=25)
+        urls = [f"http://host/FILE_{i}.XPT" for i in range(3)]
+        for url in urls:
+            self._add(cache, url, 10)
+            time.sleep(0.01)
+        cache.touch(urls[0])
+
+        self.assertEqual(cache.evict(), 1)
+        self.assertIsNone(cache.get(urls[1]))
+        self.assertIsNotNone(cache.get(urls[0]))
+        self.assertEqual(cache.total_size(), 20)
+
+    def test_conditional_get(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), ETagHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/DEMO_J.XPT"
+        ETagHandler.n_full = 0
+
+        cache = DownloadCache(self.cache_dir)
+        session = DownloadSession(pool_size=1, timeout=5)
+        for _ in range(2):
+            status, _ = download_nhanes_file(
+                LogBuffer(), url, cache.path(url), session=session, cache=cache
+                )
+            self.assertTrue(status)
+        session.close()
+
+        self.assertEqual(ETagHandler.n_full, 1)
+        self.assertEqual(
+            cache.get(url)['sha256'],
+            file_sha256(cache.path(url))
+            )
+
+        # a cached copy changed on disk is downloaded again on a 304
+        with open(cache.path(url), 'r+b') as f:
+            f.write(b'corrupt')
+        session = DownloadSession(pool_size=1, timeout=5)
+        status, _ = download_nhanes_file(
+            LogBuffer(), url, cache.path(url), session=session, cache=cache
+            )
+        session.close()
+        server.shutdown()
+        server.server_close()
+
+        self.assertTrue(status)
+        self.assertEqual(ETagHandler.n_full, 2)
+        with open(cache.path(url), 'rb') as f:
+            self.assertEqual(f.read(), ETagHandler.payload)
+
+    def test_resume_dropped_download(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/PAXMIN_G.XPT"
+        RangeHandler.ranges = []
+
+        cache = DownloadCache(self.cache_dir)
+        session = DownloadSession(pool_size=1, timeout=5)
+        status, _ = download_nhanes_file(
+            LogBuffer(), url, cache.path(url), session=session, cache=cache
+            )
+        session.close()
+        server.shutdown()
+        server.server_close()
+
+        self.assertTrue(status)
+        # the second request resumes from the bytes kept in the .part file
+        self.assertEqual(len(RangeHandler.ranges), 2)
+        self.assertIsNone(RangeHandler.ranges[0])
+        self.assertTrue(RangeHandler.ranges[1].startswith('bytes='))
+        with open(cache.path(url), 'rb') as f:
+            self.assertEqual(f.read(), RangeHandler.payload)
+        self.assertFalse(os.path.exists(f"{cache.path(url)}.part"))
+        self.assertTrue(cache.verify(url))
+
+    def test_resume_short_ranges(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/PAXMIN_G.XPT"
+        RangeHandler.ranges = []
+        RangeHandler.max_range = 64 * 1024
+        self.addCleanup(setattr, RangeHandler, 'max_range', None)
+
+        cache = DownloadCache(self.cache_dir)
+        session = DownloadSession(pool_size=1, timeout=5)
+        status, _ = download_nhanes_file(
+            LogBuffer(), url, cache.path(url), session=session, cache=cache
+            )
+        session.close()
+        server.shutdown()
+        server.server_close()
+
+        # the 150 KB left after the drop come in three short ranges
+        self.assertTrue(status)
+        self.assertEqual(len(RangeHandler.ranges), 4)
+        with open(cache.path(url), 'rb') as f:
+            self.assertEqual(f.read(), RangeHandler.payload)
+        self.assertTrue(cache.verify(url))
+
+
+class CodebookCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = CodebookCache(self.tmp.name)
+        self.doc_hash = file_sha256(DOC_FILE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cached_codebook_matches_parse(self):
+        self.assertIsNone(self.cache.get(self.doc_hash, 'DEMO'))
+        variable_df, json_tables = ingestion_utils.parse_htm_codebook(
+            LogBuffer(),
+            'DEMO',
+            DOC_FILE
+            )
+        self.cache.store(self.doc_hash, 'DEMO', variable_df, json_tables)
+
+        # a new cache instance, as in the next ingestion run
+        cache = CodebookCache(self.tmp.name)
+        cached_df, cached_tables = cache.get(self.doc_hash, 'DEMO')
+        pd.testing.assert_frame_equal(cached_df, variable_df)
+        self.assertEqual(cached_tables, json_tables)
+        self.assertIsNone(cache.get(self.doc_hash, 'DEMO_OTHER'))
@@ -0,0 +1,129 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.test import SimpleTestCase
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess.ingestion_utils import download_nhanes_file
+from nhanes.workprocess.ingestion_download import (
+    TokenBucket,
+    HostRateLimiter,
+    DownloadSession,
+    _retry_after_seconds,
+)
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Answers 503 with Retry-After to the first request of each path.
+    """
+    protocol_version = 'HTTP/1.1'
+    seen = set()
+    payload = os.urandom(4096)
+
+    def do_GET(self):
+        if self.path not in self.seen:
+            self.seen.add(self.path)
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TokenBucketTest(SimpleTestCase):
+
+    def test_token_bucket_limits_rate(self):
+        bucket = TokenBucket(rate=20, capacity=1)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        # first token is free, the other five wait 1/20 s each
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_token_bucket_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0)
+
+
+class HostRateLimiterTest(SimpleTestCase):
+
+    def test_one_bucket_per_host(self):
+        limiter = HostRateLimiter(requests_per_second=5)
+        limiter.wait("https://wwwn.cdc.gov/Nchs/Nhanes/2017-2018/DEMO_J.XPT")
+        limiter.wait("https://wwwn.cdc.gov/Nchs/Nhanes/2017-2018/DEMO_J.htm")
+        limiter.wait("http://127.0.0.1:8000/DEMO_J.XPT")
+        self.assertEqual(
+            sorted(limiter.buckets),
+            ["127.0.0.1:8000", "wwwn.cdc.gov"]
+            )
+
+
+class DownloadSessionTest(SimpleTestCase):
+
+    def setUp(self):
+        FlakyHandler.seen = set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(_retry_after_seconds("3"), 3.0)
+        self.assertEqual(
+            _retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT"),
+            0.0
+            )
+        self.assertIsNone(_retry_after_seconds("soon"))
+        self.assertIsNone(_retry_after_seconds(None))
+
+    def test_retry_and_connection_reuse(self):
+        session = DownloadSession(pool_size=1, timeout=5, backoff_factor=0)
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ['A.XPT', 'B.XPT']:
+                path = os.path.join(tmp, name)
+                status, error = download_nhanes_file(
+                    LogBuffer(),
+                    f"{self.base_url}/{name}",
+                    path,
+                    session=session
+                    )
+                self.assertTrue(status)
+                self.assertEqual(os.path.getsize(path), 4096)
+        stats = session.stats()
+        session.close()
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['reused'], 3)
+        self.assertEqual(stats['bytes'], 2 * 4096)
+
+    def test_retries_wait_for_the_limiter(self):
+        limiter = HostRateLimiter(requests_per_second=100)
+        session = DownloadSession(pool_size=1, timeout=5, backoff_factor=0)
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(limiter, 'wait', wraps=limiter.wait) as wait:  # noqa E501
+            status, _ = download_nhanes_file(
+                LogBuffer(),
+                f"{self.base_url}/A.XPT",
+                os.path.join(tmp, 'A.XPT'),
+                session=session,
+                limiter=limiter
+                )
+        session.close()
+        self.assertTrue(status)
+        # the first request and its retry after the 503
+        self.assertEqual(wait.call_count, 2)
@@ -0,0 +1,82 @@
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase
+from nhanes.workprocess import ingestion_files
+
+
+class IngestionFilesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.base_dir = Path(self.tmp.name)
+        # as read from an XPT file: SEQN as float, a character variable
+        self.df = pd.DataFrame({
+            'SEQN': [93703.0, 93704.0, 93704.0, 93705.0],
+            'RIDAGEYR': [2.0, np.nan, 62.0, 30.5],
+            'OCD240': ['Retail', None, 'Sales', 'Retail'],
+            'sequence': [0, 0, 1, 0],
+        })
+        self.df_metadata = pd.DataFrame({
+            'VariableName': ['RIDAGEYR', 'OCD240'],
+            'Type': ['Numeric', None],
+            'CodeTables': ['[]', '[{"Code or Value":"1"}]'],
+        })
+
+    def test_formats_keep_types(self):
+        readers = {
+            'parquet': pd.read_parquet,
+            'feather': pd.read_feather,
+            }
+        for file_format, read in readers.items():
+            # streaming mode writes the rows chunk by chunk
+            entry = ingestion_files.write_dataset_files(
+                iter([self.df.iloc[:2], self.df.iloc[2:]]),
+                self.df_metadata,
+                self.base_dir,
+                'DEMO_J',
+                file_format,
+                cycle='2017-2018',
+                dataset='DEMO'
+                )
+            self.assertEqual(entry['data']['rows'], 4)
+            df = read(self.base_dir / f"DEMO_J_data.{file_format}")
+            self.assertEqual(df['SEQN'].dtype, np.int64)
+            self.assertEqual(df['sequence'].dtype, np.int64)
+            self.assertEqual(df['RIDAGEYR'].dtype, np.float64)
+            self.assertTrue(pd.isna(df.loc[1, 'OCD240']))
+            pd.testing.assert_frame_equal(
+                df.astype({'SEQN': float}),
+                self.df
+                )
+            meta = read(self.base_dir / f"DEMO_J_meta.{file_format}")
+            pd.testing.assert_frame_equal(meta, self.df_metadata)
+
+    def test_output_manifest(self):
+        for name_file, file_format in [('DEMO_J', 'csv'), ('HDL_J', 'parquet')]:  # noqa E501
+            ingestion_files.write_dataset_files(
+                self.df,
+                self.df_metadata,
+                self.base_dir,
+                name_file,
+                file_format
+                )
+        # a dataset written again replaces its entry
+        ingestion_files.write_dataset_files(
+            self.df.iloc[:1],
+            self.df_metadata,
+            self.base_dir,
+            'DEMO_J',
+            'feather'
+            )
+        outputs = ingestion_files.read_output_manifest(self.base_dir)
+        self.assertEqual(list(outputs), ['DEMO_J', 'HDL_J'])
+        self.assertEqual(outputs['DEMO_J']['data']['file'], 'DEMO_J_data.feather')  # noqa E501
+        self.assertEqual(outputs['DEMO_J']['data']['rows'], 1)
+        self.assertEqual(outputs['HDL_J']['meta']['compression'], 'zstd')
+        for entry in outputs.values():
+            for output in (entry['data'], entry['meta']):
+                path = self.base_dir / output['file']
+                self.assertEqual(path.stat().st_size, output['bytes'])
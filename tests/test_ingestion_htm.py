@@ -0,0 +1,63 @@
+import os
+import tempfile
+import pandas as pd
+from django.test import SimpleTestCase
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import ingestion_utils
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'htm')
+
+
+class CodebookParserTest(SimpleTestCase):
+
+    def _assert_same_parse(self, source_code, docfile):
+        variable_df, code_table = ingestion_utils._parse_nhanes_html_docfile(
+            LogBuffer(),
+            source_code,
+            docfile
+            )
+        expected_df, expected_table = \
+            ingestion_utils._parse_nhanes_html_docfile_bs4(
+                LogBuffer(),
+                source_code,
+                docfile
+                )
+
+        # the bs4 parser read the file with its newlines doubled
+        expected_df = expected_df.replace('\n\n', '\n', regex=True)
+        pd.testing.assert_frame_equal(variable_df, expected_df, check_like=True)
+        self.assertEqual(code_table.keys(), expected_table.keys())
+        for name, table in code_table.items():
+            pd.testing.assert_frame_equal(table, expected_table[name])
+        return variable_df, code_table
+
+    def test_fixtures_match_bs4_parser(self):
+        for file_name in sorted(os.listdir(FIXTURES_DIR)):
+            with self.subTest(file_name=file_name):
+                self._assert_same_parse(
+                    os.path.splitext(file_name)[0],
+                    os.path.join(FIXTURES_DIR, file_name)
+                    )
+
+    def test_demo_codebook(self):
+        variable_df, code_table = self._assert_same_parse(
+            'DEMO_J',
+            os.path.join(FIXTURES_DIR, 'DEMO_J.htm')
+            )
+        self.assertEqual(
+            list(variable_df.VariableName),
+            ['SEQN', 'SDDSRVYR', 'RIAGENDR', 'RIDAGEYR', 'WTINT2YR']
+            )
+        self.assertEqual(variable_df.loc['RIDAGEYR_DEMO_J', 'VariableNameLong'], 'AgeInYearsAtScreening')  # noqa E501
+        self.assertEqual(list(code_table['RIAGENDR']['Count']), [4557, 4697, 0])
+
+    def test_parse_errors_are_logged(self):
+        # a variable section without its dl of attributes
+        with tempfile.TemporaryDirectory() as tmp:
+            docfile = os.path.join(tmp, 'BROKEN.htm')
+            with open(docfile, 'w') as f:
+                f.write('<html><body><div><h3 class="vartitle" id="X">X</h3></div></body></html>')  # noqa E501
+            log = LogBuffer()
+            ingestion_utils._parse_nhanes_html_docfile(log, 'BROKEN', docfile)  # noqa E501
+        self.assertEqual(log.records[0][0], 'w')
+        self.assertIn('lxml', log.records[0][1])
@@ -0,0 +1,212 @@
+import os
+import shutil
+import tempfile
+import threading
+from functools import partial
+from unittest import mock
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+import pyreadstat
+from django.test import SimpleTestCase
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import (
+    ingestion_download,
+    ingestion_pipeline,
+    ingestion_utils
+    )
+from nhanes.workprocess.ingestion_cache import DownloadCache
+
+DOC_FILE = os.path.join(
+    os.path.dirname(__file__),
+    'fixtures',
+    'htm',
+    'DEMO_J.htm'
+    )
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def guess_type(self, path):
+        if str(path).endswith('.XPT'):
+            return 'application/octet-stream'
+        return 'text/html'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class IngestionPipelineTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        site = os.path.join(self.tmp.name, 'site')
+        os.makedirs(site)
+        self.frames = {}
+        for i in range(3):
+            name = f"DS{i}"
+            df = pd.DataFrame({
+                'SEQN': [93703.0 + n for n in range(50)],
+                'RIDAGEYR': [float(n % 80) for n in range(50)],
+                'RIAGENDR': [float(1 + n % 2) for n in range(50)],
+            })
+            pyreadstat.write_xport(df, os.path.join(site, f"{name}.XPT"))
+            shutil.copy(DOC_FILE, os.path.join(site, f"{name}.htm"))
+            self.frames[name] = ingestion_utils.get_data_from_xpt(
+                LogBuffer(),
+                os.path.join(site, f"{name}.XPT")
+                )[0]
+
+        handler = partial(QuietHandler, directory=site)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.cache = DownloadCache(os.path.join(self.tmp.name, 'cache'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def _jobs(self, names):
+        jobs = []
+        for name in names:
+            data_url = f"{self.base_url}/{name}.XPT"
+            doc_url = f"{self.base_url}/{name}.htm"
+            jobs.append({
+                'name_file': name,
+                'data_url': data_url,
+                'doc_url': doc_url,
+                'data_file': self.cache.path(data_url),
+                'doc_file': self.cache.path(doc_url),
+            })
+        return jobs
+
+    def _make_task(self, job):
+        return {
+            'name_file': job['name_file'],
+            'dataset': job['name_file'],
+            'data_file': str(job['data_file']),
+            'doc_file': str(job['doc_file']),
+            'data_url': job['data_url'],
+            'doc_url': job['doc_url'],
+            'data_sha256': self.cache.get(job['data_url'])['sha256'],
+            'doc_sha256': self.cache.get(job['doc_url'])['sha256'],
+            'encoding': None,
+            'chunk_size': 0,
+            'parse_codebook': True,
+        }
+
+    def _run(
+            self,
+            names,
+            parse_workers,
+            make_task=None,
+            log=None,
+            requests_per_second=100
+            ):
+        written = {}
+
+        def write(job, parsed):
+            written[job['name_file']] = (job, parsed)
+
+        stats = ingestion_pipeline.run_ingestion_pipeline(
+            log or LogBuffer(),
+            self._jobs(names),
+            make_task or self._make_task,
+            write,
+            download_workers=2,
+            requests_per_second=requests_per_second,
+            cache=self.cache,
+            parse_workers=parse_workers,
+            queue_size=1,
+            )
+        return written, stats
+
+    def _check(self, written, stats):
+        self.assertEqual(set(written), set(self.frames))
+        for name, (job, parsed) in written.items():
+            self.assertTrue(job['status'])
+            self.assertTrue(parsed['status'])
+            self.assertEqual(parsed['encoding'], 'utf-8')
+            pd.testing.assert_frame_equal(parsed['df'], self.frames[name])
+            variable_df, json_tables = parsed['codebook']
+            self.assertIn('RIAGENDR', json_tables)
+        for stage in ['download', 'parse', 'write']:
+            self.assertEqual(stats[stage].items, 3)
+
+    def test_pipeline_in_thread(self):
+        self._check(*self._run(sorted(self.frames), parse_workers=0))
+
+    def test_pipeline_in_processes(self):
+        self._check(*self._run(sorted(self.frames), parse_workers=2))
+
+    def test_failed_download_reaches_writer(self):
+        written, stats = self._run(['MISSING'], parse_workers=0)
+        job, parsed = written['MISSING']
+        self.assertFalse(job['status'])
+        self.assertIsNone(parsed)
+        self.assertEqual(stats['parse'].items, 0)
+
+    def test_failed_parse_only_fails_its_job(self):
+        def make_task(job):
+            if job['name_file'] == 'DS1':
+                raise RuntimeError("workprocess not found")
+            return self._make_task(job)
+
+        def parse_htm_codebook(log, dataset, doc_file):
+            if dataset == 'DS2':
+                raise ValueError("broken codebook")
+            return parse(log, dataset, doc_file)
+
+        parse = ingestion_utils.parse_htm_codebook
+        with mock.patch.object(
+            ingestion_utils,
+            'parse_htm_codebook',
+            parse_htm_codebook
+        ):
+            written, stats = self._run(
+                sorted(self.frames),
+                parse_workers=0,
+                make_task=make_task
+                )
+        self.assertEqual(set(written), set(self.frames))
+        self.assertTrue(written['DS0'][1]['status'])
+        self.assertFalse(written['DS1'][1]['status'])
+        self.assertIsNone(written['DS1'][1]['error_url'])
+        self.assertFalse(written['DS2'][1]['status'])
+        self.assertTrue(written['DS2'][1]['error_url'].endswith('DS2.htm'))
+        self.assertEqual(stats['write'].items, 3)
+
+    def test_revalidation_is_not_logged_as_download(self):
+        for run in range(2):
+            log = LogBuffer()
+            written, _ = self._run(
+                ['DS0'],
+                parse_workers=0,
+                make_task=lambda job: None,
+                log=log
+                )
+            self.assertTrue(written['DS0'][0]['status'])
+        # the second run only revalidates the cached copies
+        messages = [
+            message for _, message in log.records
+            if not message.startswith('Pipeline stage')
+            ]
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(all('not modified' in m for m in messages))
+
+    def test_download_without_rate_limit(self):
+        # a download_rate of 0 turns the limiter off
+        with mock.patch.object(
+            ingestion_download,
+            'HostRateLimiter',
+            side_effect=AssertionError
+        ):
+            written, _ = self._run(
+                ['DS0'],
+                parse_workers=0,
+                make_task=lambda job: None,
+                requests_per_second=0
+                )
+        self.assertTrue(written['DS0'][0]['status'])
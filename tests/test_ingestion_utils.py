@@ -0,0 +1,433 @@
+import os
+import tempfile
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pyreadstat
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from nhanes.models import (
+    Data,
+    DataManifest,
+    DatasetCycle,
+    Variable,
+    VariableCode,
+    VariableCycle,
+    Version
+    )
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import ingestion_utils
+from nhanes.workprocess.ingestion_codes import decode_values
+from nhanes.workprocess.transformation_manager import TransformationManager
+
+
+class XptChunkReaderTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.datafile = os.path.join(self.tmp.name, 'PAXMIN_G.XPT')
+        # several rows per SEQN so the sequence crosses chunk boundaries
+        df = pd.DataFrame({
+            'SEQN': [62161.0] * 4 + [62162.0] * 3 + [62163.0] * 2,
+            'PAXMTSM': [0.5, 1.0, None, 2.5, 3.0, 0.0, 1.5, 2.0, 4.0],
+            'PAXPREDM': ['1', '2', '2', '3', '1', '1', '2', '3', '3'],
+        })
+        pyreadstat.write_xport(df, self.datafile, table_name='PAXMIN_G')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_chunks_match_full_read(self):
+        df, meta_df = ingestion_utils.get_data_from_xpt(LogBuffer(), self.datafile)
+        reader = ingestion_utils.XptChunkReader(LogBuffer(), self.datafile, 2)
+        chunks = list(reader)
+
+        self.assertEqual(len(chunks), 5)
+        pd.testing.assert_frame_equal(pd.concat(chunks), df)
+        self.assertEqual(reader.rows, 9)
+        self.assertEqual(reader.samples, 3)
+        pd.testing.assert_frame_equal(
+            ingestion_utils.get_metadata_from_xpt(LogBuffer(), self.datafile),
+            meta_df
+            )
+
+    def test_detect_encoding(self):
+        buffer = LogBuffer()
+        encoding, avoided = ingestion_utils.detect_xpt_encoding(
+            buffer,
+            self.datafile
+            )
+        self.assertEqual(encoding, 'utf-8')
+        self.assertEqual(avoided, 0)
+
+        # latin1 character values fail utf-8 on the character columns scan
+        datafile = os.path.join(self.tmp.name, 'OCQ_G.XPT')
+        df = pd.DataFrame({'SEQN': [1.0, 2.0], 'OCD240': ['Caf\xe9', 'Ma\xe7a']})
+        pyreadstat.write_xport(df, datafile, table_name='OCQ_G')
+        with open(datafile, 'rb') as f:
+            content = f.read()
+        with open(datafile, 'wb') as f:
+            f.write(content.replace('é'.encode(), b'\xe9 '))
+        encoding, avoided = ingestion_utils.detect_xpt_encoding(
+            LogBuffer(),
+            datafile
+            )
+        self.assertEqual(encoding, 'latin1')
+        self.assertEqual(avoided, 1)
+
+
+class SaveNhanesDataTest(TestCase):
+    fixtures = [
+        'tests/fixtures/version_fixture.json',
+        'tests/fixtures/cycle_fixture.json',
+        'tests/fixtures/group_fixture.json',
+        'tests/fixtures/dataset_fixture.json',
+        ]
+
+    def setUp(self):
+        for name in ['SEQN', 'RIDAGEYR', 'OCD240']:
+            Variable.objects.create(variable=name)
+        self.df = pd.DataFrame({
+            'SEQN': [93703, 93704, 93704],
+            'sequence': [0, 0, 1],
+            'RIDAGEYR': [2.0, None, 5.397605346934028e-79],
+            'OCD240': ['Retail', '', None],
+        })
+
+    def test_values_match_str(self):
+        self.assertTrue(
+            ingestion_utils.save_nhanes_data(LogBuffer(), self.df, 10, 1)
+            )
+        rows = Data.objects.filter(cycle_id=10, dataset_id=1)
+        self.assertEqual(rows.count(), 6)
+        for row in rows.select_related('variable'):
+            match = self.df[
+                (self.df['SEQN'] == row.sample) &
+                (self.df['sequence'] == row.sequence)
+                ]
+            self.assertEqual(
+                row.value,
+                str(match[row.variable.variable].iloc[0])
+                )
+            self.assertEqual(row.version.version, 'nhanes')
+            self.assertIsNone(row.rule_id)
+
+    def test_value_num_of_numeric_columns(self):
+        ingestion_utils.save_nhanes_data(LogBuffer(), self.df, 10, 1)
+        value_num = dict(
+            Data.objects.filter(variable__variable='RIDAGEYR').values_list(
+                'sample',
+                'value_num'
+                ).filter(sequence=0)
+            )
+        self.assertEqual(value_num, {93703: 2.0, 93704: None})
+        self.assertEqual(
+            Data.objects.filter(
+                variable__variable='RIDAGEYR',
+                value_num__gt=1e-80,
+                value_num__lt=1
+                ).count(),
+            1
+            )
+        self.assertFalse(
+            Data.objects.filter(
+                variable__variable='OCD240',
+                value_num__isnull=False
+                ).exists()
+            )
+
+    def test_failure_rolls_back(self):
+        def chunks():
+            yield self.df
+            raise ValueError("broken chunk")
+
+        self.assertFalse(
+            ingestion_utils.save_nhanes_data(LogBuffer(), chunks(), 10, 1)
+            )
+        self.assertFalse(Data.objects.filter(cycle_id=10, dataset_id=1).exists())
+        self.assertFalse(DataManifest.objects.exists())
+
+    def test_manifest_records_load(self):
+        self.assertTrue(
+            ingestion_utils.save_nhanes_data(
+                LogBuffer(),
+                self.df,
+                10,
+                1,
+                source_hash='abc'
+                )
+            )
+        manifest = DataManifest.objects.get(cycle_id=10, dataset_id=1)
+        self.assertEqual(manifest.rows, 6)
+        self.assertEqual(manifest.n_samples, 2)
+        self.assertEqual(manifest.n_variables, 2)
+        self.assertEqual(manifest.source_hash, 'abc')
+        self.assertIsNone(manifest.rule)
+
+        # the second load is answered by the manifest, without touching Data
+        with CaptureQueriesContext(connection) as queries:
+            ingestion_utils.save_nhanes_data(LogBuffer(), self.df, 10, 1)
+        self.assertFalse(
+            any('nhanes_data"' in q['sql'] for q in queries.captured_queries)
+            )
+        self.assertEqual(Data.objects.count(), 6)
+
+    def test_sparse_skips_missing(self):
+        self.assertTrue(
+            ingestion_utils.save_nhanes_data(
+                LogBuffer(),
+                self.df,
+                10,
+                1,
+                sparse=True
+                )
+            )
+        # RIDAGEYR of 93704/0 and OCD240 of 93704/1 are missing
+        self.assertEqual(Data.objects.count(), 4)
+        self.assertFalse(Data.objects.filter(value__in=['nan', 'None']).exists())
+        manifest = DataManifest.objects.get(cycle_id=10, dataset_id=1)
+        self.assertEqual(manifest.rows, 4)
+        self.assertEqual(manifest.skipped_rows, 2)
+        self.assertGreater(manifest.skipped_bytes, 0)
+
+    def test_sparse_reads_as_dense(self):
+        version = Version.objects.get(version='nhanes')
+        rule_variables = [
+            SimpleNamespace(
+                version=version,
+                dataset=None,
+                variable=Variable.objects.get(variable=name)
+                )
+            for name in ['RIDAGEYR', 'OCD240']
+        ]
+        # pyreadstat reads missing numbers as NaN, as stored in dense mode
+        df = self.df.fillna(np.nan)
+        manager = TransformationManager(rules=[])
+        frames = []
+        for sparse in [False, True]:
+            Data.objects.all().delete()
+            DataManifest.objects.all().delete()
+            ingestion_utils.save_nhanes_data(
+                LogBuffer(),
+                df,
+                10,
+                1,
+                sparse=sparse
+                )
+            frames.append(manager._get_input_data(rule_variables))
+        pd.testing.assert_frame_equal(*frames, check_like=True)
+
+    def _set_code_tables(self):
+        # OCD240 is categorical, RIDAGEYR continuous
+        tables = {
+            'RIDAGEYR': '[{"Code or Value":"0 to 79","Value Description":"Range of Values"}]',  # noqa E501
+            'OCD240': '[{"Code or Value":"Retail","Value Description":"Retail"}]',  # noqa E501
+        }
+        version = Version.objects.get(version='nhanes')
+        for name, value_table in tables.items():
+            VariableCycle.objects.create(
+                version=version,
+                variable=Variable.objects.get(variable=name),
+                cycle_id=10,
+                dataset_id=1,
+                value_table=value_table
+                )
+
+    def test_encoded_values_decode(self):
+        self._set_code_tables()
+        self.assertTrue(
+            ingestion_utils.save_nhanes_data(
+                LogBuffer(),
+                self.df,
+                10,
+                1,
+                encoded=True
+                )
+            )
+        encoded = Data.objects.filter(value_code__isnull=False)
+        self.assertEqual(
+            set(encoded.values_list('variable__variable', flat=True)),
+            {'OCD240'}
+            )
+        self.assertFalse(encoded.exclude(value='').exists())
+        self.assertEqual(
+            VariableCode.objects.filter(variable__variable='OCD240').count(),
+            3
+            )
+        encoded_rows = self._stored_rows()
+
+        # decoded rows are the rows of the plain storage
+        Data.objects.all().delete()
+        DataManifest.objects.all().delete()
+        ingestion_utils.save_nhanes_data(LogBuffer(), self.df, 10, 1)
+        self.assertEqual(encoded_rows, self._stored_rows())
+
+    def test_encoded_delta(self):
+        self._set_code_tables()
+        ingestion_utils.save_nhanes_data(
+            LogBuffer(),
+            self.df,
+            10,
+            1,
+            encoded=True
+            )
+        df_new = pd.DataFrame({
+            'SEQN': [93703, 93705],
+            'sequence': [0, 0],
+            'RIDAGEYR': [3.0, 7.0],
+            'OCD240': ['Sales', 'Retail'],
+        })
+        changes = ingestion_utils.apply_nhanes_data_delta(
+            LogBuffer(),
+            df_new,
+            10,
+            1,
+            source_hash='new',
+            encoded=True
+            )
+        self.assertEqual(changes, {'inserted': 2, 'updated': 2, 'deleted': 4})
+        self.assertEqual(
+            set(
+                VariableCode.objects.filter(
+                    variable__variable='OCD240'
+                    ).values_list('value', flat=True)
+                ),
+            {'Retail', '', 'None', 'Sales'}
+            )
+        delta_rows = self._stored_rows()
+
+        Data.objects.all().delete()
+        DataManifest.objects.all().delete()
+        ingestion_utils.save_nhanes_data(LogBuffer(), df_new, 10, 1)
+        self.assertEqual(delta_rows, self._stored_rows())
+
+    def _stored_rows(self):
+        df = pd.DataFrame.from_records(
+            Data.objects.values_list(
+                'variable__variable',
+                'variable_id',
+                'sample',
+                'sequence',
+                'value',
+                'value_code'
+                ),
+            columns=['name', 'variable', 'sample', 'sequence', 'value', 'value_code']  # noqa E501
+            )
+        df = decode_values(df, 'variable').drop(columns=['variable'])
+        return set(df.itertuples(index=False, name=None))
+
+    def test_delta_applies_only_changes(self):
+        ingestion_utils.save_nhanes_data(LogBuffer(), self.df, 10, 1)
+
+        # republished file: one value fixed, one sample gone, one new sample
+        df_new = pd.DataFrame({
+            'SEQN': [93703, 93705],
+            'sequence': [0, 0],
+            'RIDAGEYR': [3.0, 7.0],
+            'OCD240': ['Retail', 'Sales'],
+        })
+        changes = ingestion_utils.apply_nhanes_data_delta(
+            LogBuffer(),
+            df_new,
+            10,
+            1,
+            source_hash='new'
+            )
+        self.assertEqual(
+            changes,
+            {'inserted': 2, 'updated': 1, 'deleted': 4}
+            )
+        delta_rows = self._stored_rows()
+
+        # same rows as a full reload of the new file
+        Data.objects.all().delete()
+        DataManifest.objects.all().delete()
+        ingestion_utils.save_nhanes_data(LogBuffer(), df_new, 10, 1)
+        self.assertEqual(delta_rows, self._stored_rows())
+
+    def test_delta_skips_unchanged_file(self):
+        ingestion_utils.save_nhanes_data(
+            LogBuffer(),
+            self.df,
+            10,
+            1,
+            source_hash='abc'
+            )
+        changes = ingestion_utils.apply_nhanes_data_delta(
+            LogBuffer(),
+            self.df,
+            10,
+            1,
+            source_hash='abc'
+            )
+        self.assertEqual(changes, {'inserted': 0, 'updated': 0, 'deleted': 0})
+
+
+class ProcessAndSaveMetadataTest(TestCase):
+    fixtures = [
+        'tests/fixtures/version_fixture.json',
+        'tests/fixtures/cycle_fixture.json',
+        'tests/fixtures/group_fixture.json',
+        'tests/fixtures/dataset_fixture.json',
+        ]
+
+    def _metadata(self, n_variables, label='Label'):
+        names = [f"TEST{i:03d}" for i in range(n_variables)]
+        return pd.DataFrame({
+            'VariableName': names,
+            'SASLabel': [f"{label} {name}" for name in names],
+            'EnglishText': ['Text'] * n_variables,
+            'Target': ['Both males and females'] * n_variables,
+            'Type': ['double'] * n_variables,
+            'CodeTables': ['[{"Code or Value":"1"}]'] * n_variables,
+        })
+
+    def _save(self, df):
+        return ingestion_utils.process_and_save_metadata(
+            LogBuffer(),
+            df,
+            dataset_id=1,
+            cycle_id=10,
+            dataset_cycle_url='https://example.org/DEMO_J.htm',
+            )
+
+    def test_query_count_does_not_grow_with_variables(self):
+        # the previous row by row version ran about 1,000 queries for a
+        # 300 variable codebook; now new variables take a fixed number:
+        # 3 lookups, 1 Variable read and insert, 1 DatasetCycle update,
+        # 1 VariableCycle read and insert and 2 savepoint queries for the
+        # transaction inside the test transaction
+        with self.assertNumQueries(10):
+            self.assertTrue(self._save(self._metadata(5)))
+        # SQLite caps the parameters of a statement, so the inserts of a
+        # large codebook are split into a few batches
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self._save(self._metadata(300, label='Big')))
+        self.assertLessEqual(len(queries), 15)
+        self.assertEqual(
+            VariableCycle.objects.filter(dataset_id=1, cycle_id=10).count(),
+            300
+            )
+
+    def test_unchanged_and_changed_variables(self):
+        self.assertTrue(self._save(self._metadata(50)))
+
+        # nothing changed: reads and the DatasetCycle update only
+        with self.assertNumQueries(8):
+            self.assertTrue(self._save(self._metadata(50)))
+
+        # changed labels: one bulk update
+        with self.assertNumQueries(9):
+            self.assertTrue(self._save(self._metadata(50, label='New')))
+        variable_cycle = VariableCycle.objects.get(
+            variable__variable='TEST007',
+            dataset_id=1,
+            cycle_id=10
+            )
+        self.assertEqual(variable_cycle.sas_label, 'New TEST007')
+        self.assertEqual(variable_cycle.value_table, '[{"Code or Value":"1"}]')
+        self.assertEqual(
+            DatasetCycle.objects.get(dataset_id=1, cycle_id=10).metadata_url,
+            'https://example.org/DEMO_J.htm'
+            )
@@ -0,0 +1,112 @@
+from unittest import mock
+import numpy as np
+import pandas as pd
+from django.db import transaction
+from django.test import TransactionTestCase
+from nhanes.models import QueryFilter, Variable
+from nhanes.reports import query
+from nhanes.reports.query_cache import QueryResultCache, query_cache_key
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import data_storage
+from tests.query_base import QueryTestCase
+
+
+class QueryCacheTest(QueryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        data_storage.DatabaseStorage().save(LogBuffer(), self.df, 10, 1)
+        self.create_structure()
+
+    def _export(self, **options):
+        return self.download(**options)[0].content
+
+    def test_cache_hit_until_data_changes(self):
+        content = self._export()
+        self.assertEqual(self._export(cache=True), content)
+
+        # the second export is read from the cache, without the data
+        with mock.patch.object(query, 'read_data', side_effect=AssertionError):  # noqa E501
+            self.assertEqual(self._export(cache=True), content)
+
+        # a new generation of the data is a miss
+        data_storage.bump_data_generation()
+        with mock.patch.object(query, 'read_data', wraps=query.read_data) as read:  # noqa E501
+            self.assertEqual(self._export(cache=True), content)
+        read.assert_called_once()
+
+    def test_cache_key(self):
+        key = query_cache_key(self.structure, 1)
+        QueryFilter.objects.create(
+            query_structure=self.structure,
+            filter_name='cycle__cycle',
+            operator='eq',
+            value='2017-2018'
+            )
+        with_cycle = query_cache_key(self.structure, 1)
+        self.assertNotEqual(key, with_cycle)
+        self.assertNotEqual(with_cycle, query_cache_key(self.structure, 2))
+
+        # the order of the filters does not change the key
+        self.structure.filters.filter(filter_name='dataset__dataset').delete()
+        QueryFilter.objects.create(
+            query_structure=self.structure,
+            filter_name='dataset__dataset',
+            operator='eq',
+            value='DEMO'
+            )
+        self.assertEqual(with_cycle, query_cache_key(self.structure, 1))
+
+        self.structure.no_multi_index = True
+        self.assertNotEqual(with_cycle, query_cache_key(self.structure, 1))
+
+    def test_lru_eviction(self):
+        pivot_df = pd.DataFrame(
+            np.array([['2.0', np.nan]], dtype=object),
+            index=pd.MultiIndex.from_tuples(
+                [('2017-2018', 93703, 0)],
+                names=['Cycle', 'sample', 'sequence']
+                ),
+            columns=pd.Index(['RIDAGEYR', 'OCD240'], name='unique_column')
+            )
+        cache = QueryResultCache(self.tmp.name + '/query_cache')
+        size = cache.store('a', pivot_df)['size']
+        cache.max_size = int(size * 2.5)
+        cache.store('b', pivot_df)
+        with mock.patch('time.time', return_value=cache.entries['b']['last_access'] + 1):  # noqa E501
+            pd.testing.assert_frame_equal(cache.get('a'), pivot_df)
+        with mock.patch('time.time', return_value=cache.entries['a']['last_access'] + 1):  # noqa E501
+            cache.store('c', pivot_df)
+
+        # 'b' was the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(
+            sorted(QueryResultCache(cache.cache_dir).entries),
+            ['a', 'c']
+            )
+
+
+class MetadataGenerationTest(TransactionTestCase):
+
+    def test_metadata_edits_bump_once_per_transaction(self):
+        generation = data_storage.get_data_generation()
+        with transaction.atomic():
+            for name in ['SEQN', 'RIDAGEYR', 'OCD240']:
+                Variable.objects.create(variable=name)
+            Variable.objects.filter(variable='OCD240').delete()
+            # not before the commit
+            self.assertEqual(data_storage.get_data_generation(), generation)
+        self.assertEqual(data_storage.get_data_generation(), generation + 1)
+
+        # in autocommit mode, at once
+        variable = Variable.objects.get(variable='RIDAGEYR')
+        variable.description = 'Age in years at screening'
+        variable.save()
+        self.assertEqual(data_storage.get_data_generation(), generation + 2)
+
+        # nothing is left pending by a rolled back transaction
+        with self.assertRaises(ValueError), transaction.atomic():
+            variable.save()
+            raise ValueError
+        variable.save()
+        self.assertEqual(data_storage.get_data_generation(), generation + 3)
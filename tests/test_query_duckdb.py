@@ -0,0 +1,123 @@
+import importlib.util
+from unittest import skipUnless
+import pandas as pd
+from django.db import connection
+from nhanes.models import Data, DataManifest, Variable
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import data_storage
+from nhanes.workprocess.ingestion_utils import MISSING_VALUE
+from tests.query_base import QueryTestCase
+
+
+@skipUnless(importlib.util.find_spec('duckdb'), "duckdb is not installed")
+class DuckDBQueryEngineTest(QueryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # one cycle in the Data table, one in a Parquet file
+        data_storage.DatabaseStorage().save(LogBuffer(), self.df, 10, 1)
+        data_storage.ParquetStorage().save(LogBuffer(), self.df, 9, 1)
+
+    def _pivot(self, variables=None, value_filters=()):
+        from nhanes.reports.query_duckdb import DuckDBQueryEngine
+        with DuckDBQueryEngine() as engine:
+            reader = engine.pivot(
+                DataManifest.objects.all(),
+                variables,
+                value_filters,
+                ['dataset__dataset', 'variable__variable']
+                )
+            df = reader.read_pandas()
+        return df.set_index(['Cycle', 'sample', 'sequence']).sort_index(axis=1)  # noqa E501
+
+    def _expected(self, variables=None, value_filters=()):
+        df = data_storage.read_data(
+            DataManifest.objects.all(),
+            variables,
+            value_filters
+            )
+        manifests = DataManifest.objects.in_bulk()
+        names = dict(Variable.objects.values_list('id', 'variable'))
+        df['Cycle'] = df['manifest'].map(
+            lambda m: manifests[m].cycle.cycle
+            )
+        df['column'] = df['manifest'].map(
+            lambda m: manifests[m].dataset.dataset
+            ) + '___' + df['variable'].map(names)
+        df['value'] = df['value'].replace(MISSING_VALUE, None)
+        # first value that is not missing of each cell, as the pandas engine
+        pivot = df.groupby(
+            ['Cycle', 'sample', 'sequence', 'column']
+            )['value'].first().unstack('column')
+        pivot.columns.name = None
+        return pivot.sort_index(axis=1)
+
+    def _assert_same(self, result, expected):
+        # cells without a value are null in both
+        pd.testing.assert_frame_equal(
+            result.astype(object).where(result.notna(), None),
+            expected.astype(object).where(expected.notna(), None),
+            check_index_type=False,
+            check_names=False
+            )
+
+    def test_pivot_matches_pandas(self):
+        self._assert_same(self._pivot(), self._expected())
+        self.assertEqual(
+            self._pivot().loc[('2017-2018', 93704, 1), 'DEMO___RIDAGEYR'],
+            '62.0'
+            )
+
+    def test_pivot_with_filters(self):
+        age = Variable.objects.get(variable='RIDAGEYR')
+        for variables, value_filters in [
+            ({age.id: 'RIDAGEYR'}, []),
+            (None, [{'value_num__gte': 30.5}]),
+            (None, [{'value__icontains': 'ETA'}]),
+        ]:
+            self._assert_same(
+                self._pivot(variables, value_filters),
+                self._expected(variables, value_filters)
+                )
+
+    def test_pivot_duplicate_cells(self):
+        # the cells of the database partition in a second version: a later
+        # value of a cell is dropped, unless the first one is missing
+        rows = list(Data.objects.filter(cycle_id=10, dataset_id=1))
+        for row in rows:
+            row.pk = None
+            row.version_id = 2
+            row.value = {'2.0': '99.0'}.get(row.value, 'Zoo')
+        Data.objects.bulk_create(rows)
+        manifest = DataManifest.objects.get(cycle_id=10, dataset_id=1)
+        manifest.pk = None
+        manifest.version_id = 2
+        manifest.save()
+
+        result = self._pivot()
+        self._assert_same(result, self._expected())
+        self.assertEqual(
+            result.loc[('2017-2018', 93703, 0), 'DEMO___RIDAGEYR'],
+            '2.0'
+            )
+        self.assertEqual(
+            result.loc[('2017-2018', 93704, 0), 'DEMO___RIDAGEYR'],
+            'Zoo'
+            )
+
+    def test_sqlite_query_reads_one_cycle(self):
+        from nhanes.reports.query_duckdb import _sqlite_rows_sql
+        # a second cycle of the dataset in the Data table
+        data_storage.DatabaseStorage().save(LogBuffer(), self.df, 8, 1)
+        manifest = DataManifest.objects.get(cycle_id=10, dataset_id=1)
+        age = Variable.objects.get(variable='RIDAGEYR')
+        with connection.cursor() as cursor:
+            cursor.execute(_sqlite_rows_sql([manifest], {age.id: 'RIDAGEYR'}))  # noqa E501
+            columns = [c[0] for c in cursor.description]
+            rows = pd.DataFrame(cursor.fetchall(), columns=columns)
+        self.assertEqual(rows['cycle'].unique().tolist(), [10])
+        self.assertEqual(rows['variable'].unique().tolist(), [age.id])
+        self.assertEqual(
+            len(rows),
+            Data.objects.filter(cycle_id=10, variable=age).count()
+            )
@@ -0,0 +1,85 @@
+from unittest import mock
+from nhanes.models import (
+    Data,
+    DataManifest,
+    QueryFilter,
+    Variable,
+    VariableCycle,
+    Version
+    )
+from nhanes.reports import query
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import data_storage
+from tests.query_base import QueryTestCase
+
+
+class SQLPivotTest(QueryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # OCD240 is categorical: stored as codes with encoded=True
+        VariableCycle.objects.create(
+            version=Version.objects.get(version='nhanes'),
+            variable=Variable.objects.get(variable='OCD240'),
+            cycle_id=10,
+            dataset_id=1,
+            value_table='[{"Code or Value":"Retail","Value Description":"Retail"}]'  # noqa E501
+            )
+        storage = data_storage.DatabaseStorage()
+        storage.save(LogBuffer(), self.df, 10, 1, encoded=True)
+        storage.save(LogBuffer(), self.df.assign(SEQN=self.df['SEQN'] + 7), 10, 2)  # noqa E501
+        storage.save(LogBuffer(), self.df.assign(SEQN=self.df['SEQN'] - 10000), 9, 1, sparse=True)  # noqa E501
+        self.create_structure('in', 'DEMO,HDL')
+
+    def _export(self, engine, **options):
+        return self.download(engine=engine, **options)[0].content
+
+    def test_sql_pivot_matches_pandas(self):
+        content = self._export('sql')
+        self.assertEqual(content, self._export('pandas'))
+        lines = content.decode().splitlines()
+        self.assertEqual(lines[1], ',,,OCD240,RIDAGEYR,OCD240,RIDAGEYR')
+        self.assertIn('2017-2018,93703,0,Retail,2.0,,', lines)
+
+        # with a value filter
+        QueryFilter.objects.create(
+            query_structure=self.structure,
+            filter_name='value',
+            operator='eq',
+            value='Retail'
+            )
+        self.assertEqual(self._export('sql'), self._export('pandas'))
+
+    def test_sql_pivot_duplicate_cells(self):
+        # the same cells in a second version, with values that MAX would
+        # pick over the first ones
+        rows = list(Data.objects.filter(cycle_id=10, dataset_id=1))
+        for row in rows:
+            row.pk = None
+            row.version_id = 2
+            row.value = {'2.0': '99.0'}.get(row.value, 'Zoo')
+            row.value_code = None
+        Data.objects.bulk_create(rows)
+        manifest = DataManifest.objects.get(cycle_id=10, dataset_id=1)
+        manifest.pk = None
+        manifest.version_id = 2
+        manifest.save()
+
+        content = self._export('sql')
+        self.assertEqual(content, self._export('pandas'))
+        self.assertIn('2017-2018,93703,0,Retail,2.0,,', content.decode().splitlines())  # noqa E501
+
+    def test_sql_pivot_fallback(self):
+        with mock.patch.object(
+            query,
+            'sql_pivot_rows',
+            side_effect=AssertionError
+        ):
+            # above the column threshold
+            self.assertEqual(
+                self._export('sql', sql_pivot_max_columns=3),
+                self._export('pandas')
+                )
+            # a partition in a Parquet file
+            data_storage.ParquetStorage().save(LogBuffer(), self.df, 8, 1)
+            self.assertEqual(self._export('sql'), self._export('pandas'))
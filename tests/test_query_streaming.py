@@ -0,0 +1,49 @@
+import gzip
+from django.http import StreamingHttpResponse
+from nhanes.utils.logs import LogBuffer
+from nhanes.workprocess import data_storage
+from tests.query_base import QueryTestCase
+
+
+class StreamingExportTest(QueryTestCase):
+    variables = QueryTestCase.variables + ['DMDEDUC']
+
+    def setUp(self):
+        super().setUp()
+        df = self.df
+        # a cycle in the Data table and one in a Parquet file, with a
+        # variable only in the second one
+        data_storage.DatabaseStorage().save(LogBuffer(), df, 10, 1)
+        data_storage.ParquetStorage().save(
+            LogBuffer(),
+            df.assign(SEQN=df['SEQN'] - 10000, DMDEDUC=[1.0, 2.0, 3.0, 4.0]),  # noqa E501
+            9,
+            1
+            )
+        self.create_structure()
+
+    def test_streaming_matches_buffered(self):
+        buffered, _ = self.download()
+        streamed, _ = self.download(streaming=True)
+        self.assertIsInstance(streamed, StreamingHttpResponse)
+        content = b''.join(streamed.streaming_content)
+        self.assertEqual(content, buffered.content)
+        # header once, then the rows of both cycles
+        lines = content.decode().splitlines()
+        self.assertEqual(lines[:2], [',,,DEMO,DEMO,DEMO', ',,,DMDEDUC,OCD240,RIDAGEYR'])  # noqa E501
+        self.assertEqual(sum(line.startswith('Cycle,') for line in lines), 1)
+        self.assertEqual(len(lines), 3 + 8)
+
+        compressed, _ = self.download(streaming=True, streaming_gzip=True)
+        self.assertEqual(compressed['Content-Type'], 'application/gzip')
+        self.assertIn('demo.csv.gz', compressed['Content-Disposition'])
+        self.assertEqual(
+            gzip.decompress(b''.join(compressed.streaming_content)),
+            content
+            )
+
+    def test_streaming_without_data(self):
+        self.structure.filters.update(value='HDL')
+        response, messages = self.download(streaming=True)
+        self.assertIsNone(response)
+        self.assertEqual(messages[0][0], 'error')